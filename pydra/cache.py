@@ -0,0 +1,97 @@
+"""
+Maintenance of the cache locations::
+
+    python -m pydra.cache usage CACHE_DIR
+    python -m pydra.cache gc CACHE_DIR --max-bytes 100G [--max-entries N] [--dry-run]
+    python -m pydra.cache pin CACHE_DIR CHECKSUM [CHECKSUM ...]
+    python -m pydra.cache unpin CACHE_DIR CHECKSUM [CHECKSUM ...]
+"""
+import argparse
+import sys
+
+from .engine.cache import CacheManager, CACHE_GC_MIN_AGE
+
+_UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+
+
+def parse_size(size):
+    """Parses size in bytes with an optional unit (e.g. 512M, 10G)"""
+    size = size.strip().upper().rstrip("B")
+    unit = size[-1:] if size[-1:] in _UNITS else ""
+    try:
+        return int(float(size[: len(size) - len(unit)]) * _UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size {size!r}")
+
+
+def format_size(nbytes):
+    for unit in ["", "K", "M", "G"]:
+        if nbytes < 1024:
+            break
+        nbytes /= 1024
+    else:
+        unit = "T"
+    return f"{nbytes:.1f}{unit}B"
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m pydra.cache", description="Maintenance of pydra cache locations"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    usage = subparsers.add_parser("usage", help="size and number of cached entries")
+    usage.add_argument("location")
+    gc = subparsers.add_parser("gc", help="remove least recently used entries")
+    gc.add_argument("location")
+    gc.add_argument("--max-bytes", type=parse_size, help="size limit, e.g. 100G")
+    gc.add_argument("--max-entries", type=int, help="limit of the number of entries")
+    gc.add_argument(
+        "--min-age",
+        type=float,
+        default=CACHE_GC_MIN_AGE,
+        help="entries used within the time (in seconds) are kept",
+    )
+    gc.add_argument(
+        "--stale-locks",
+        type=float,
+        metavar="AGE",
+        help="remove lock files of killed tasks older than AGE seconds",
+    )
+    gc.add_argument("--dry-run", action="store_true", help="only list the entries")
+    for command in ["pin", "unpin"]:
+        pin = subparsers.add_parser(command, help=f"{command} entries")
+        pin.add_argument("location")
+        pin.add_argument("checksums", nargs="+")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.command == "gc":
+        manager = CacheManager(
+            args.location,
+            max_bytes=args.max_bytes,
+            max_entries=args.max_entries,
+            min_age=args.min_age,
+        )
+        if args.stale_locks is not None:
+            for lockfile in manager.remove_stale_locks(args.stale_locks):
+                print(f"removed stale lock {lockfile}")
+        removed = manager.gc(dry_run=args.dry_run)
+        for entry in removed:
+            print(f"{'would remove' if args.dry_run else 'removed'} {entry.checksum}")
+        print(f"{len(removed)} entries, {format_size(sum(e.nbytes for e in removed))}")
+    else:
+        manager = CacheManager(args.location)
+        if args.command == "usage":
+            nbytes, nentries = manager.usage()
+            print(f"{nentries} entries, {format_size(nbytes)}")
+        elif args.command == "pin":
+            manager.pin(*args.checksums)
+        else:
+            manager.unpin(*args.checksums)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,11 @@
+import pytest
+
+from .engine import helpers_file
+
+
+@pytest.fixture(autouse=True)
+def _hash_index_in_tmpdir(tmp_path_factory):
+    """Keeps the file hash index used by the tests in the temporary directory"""
+    helpers_file.set_hash_index(tmp_path_factory.getbasetemp() / "file_hashes.sqlite")
+    yield
+    helpers_file.set_hash_index(None)
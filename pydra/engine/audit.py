@@ -78,6 +78,21 @@ class Audit:
                 AuditFlag.PROV,
             )
 
+    def audit_save(self, metadata):
+        """Audits serialization (compression ratio and time) of the saved objects"""
+        if self.audit_check(AuditFlag.PROV):
+            for name, entity in metadata.items():
+                entity = dict(entity)
+                entity.update(
+                    **{
+                        "@id": "uid:{}".format(gen_uuid()),
+                        "@type": "saved",
+                        "object": name,
+                        "prov:wasGeneratedBy": self.aid,
+                    }
+                )
+                self.audit_message(entity, AuditFlag.PROV)
+
     def audit_message(self, message, flags=None):
         if self.develop:
             with open(
@@ -950,8 +950,13 @@ def combine_final_groups(combiner, groups, groups_stack, keys):
 
 
 def map_splits(split_iter, inputs):
+    # flattening every input only once, not for every state
+    inputs_flat = {}
     for split in split_iter:
-        yield {k: list(flatten(ensure_list(inputs[k])))[v] for k, v in split.items()}
+        for k in split:
+            if k not in inputs_flat:
+                inputs_flat[k] = list(flatten(ensure_list(inputs[k])))
+        yield {k: inputs_flat[k][v] for k, v in split.items()}
 
 
 """ Functions for merging and completing splitters in states.
@@ -0,0 +1,410 @@
+"""Caching of task results and cache locations within a process"""
+from collections import OrderedDict
+import os
+from pathlib import Path
+import threading
+import time
+
+# default size limit of the process result cache (set to 0 to disable the cache)
+RESULT_CACHE_MAX_BYTES = 256 * 2 ** 20
+# minimal time (in seconds) between checks of an indexed location for new entries
+CACHE_INDEX_REFRESH = 1.0
+# entries used within the time (in seconds) are never removed by the garbage collection
+CACHE_GC_MIN_AGE = 600.0
+
+
+class ResultCache:
+    """
+    LRU cache of deserialized results bounded by their uncompressed size.
+
+    Results are kept together with the identity of the file they were read from
+    (size, mtime_ns, inode), so a rewritten result file is never served from
+    the cache. Results returned by the cache are shared, and shouldn't be modified.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, key, identity):
+        """
+        Returns the cached result if it was read from a file with the same identity
+
+        Parameters
+        ----------
+        key : tuple
+            e.g. checksum and path of the result file
+        identity : tuple
+            Signature of the result file
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != identity:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, identity, result, nbytes):
+        """Adds a result to the cache and evicts the least recently used results"""
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[2]
+            self._entries[key] = (identity, result, nbytes)
+            self._nbytes += nbytes
+            self._evict()
+
+    def grow(self, key, identity, nbytes):
+        """
+        Adds to the size of a cached result that was used again,
+        e.g. after its output field was loaded (see ``stores.result_from_entries``)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != identity:
+                return
+            if entry[2] + nbytes > self.max_bytes:
+                del self._entries[key]
+                self._nbytes -= entry[2]
+                self.evictions += 1
+                return
+            self._entries[key] = (identity, entry[1], entry[2] + nbytes)
+            self._entries.move_to_end(key)
+            self._nbytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self._nbytes > self.max_bytes:
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self._nbytes -= size
+            self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """Counters that can be used to tune the size of the cache"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "nbytes": self._nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class CacheLocationIndex:
+    """
+    Index of entries (checksums) present in the registered cache locations.
+
+    Entries of a location are read with a single ``os.scandir`` when the location
+    is used for the first time. Lookups of entries that are not in the index
+    (misses) don't touch the filesystem for ``refresh_interval`` seconds,
+    after that the modification time of the location is checked and the location
+    is scanned again only if it has changed. Entries saved by the current
+    process are added immediately (see ``add``).
+
+    Only locations registered with ``register`` are indexed; it's meant for
+    additional cache locations that are only read by the tasks. Locations used
+    as a cache directory by any task of the process are never indexed
+    (see ``set_writable``), since they are written by the workers.
+    """
+
+    def __init__(self, refresh_interval=CACHE_INDEX_REFRESH):
+        self.refresh_interval = refresh_interval
+        # location -> [entries, mtime_ns of the location, time of the last check]
+        self._locations = {}
+        self._writable = set()
+        self._lock = threading.Lock()
+
+    def register(self, location):
+        """Starts indexing the location (the location is scanned lazily)"""
+        location = Path(location)
+        with self._lock:
+            if location.resolve() not in self._writable:
+                self._locations.setdefault(location, None)
+
+    def set_writable(self, location):
+        """Marks location as a cache directory of a task, so it is not indexed"""
+        location = Path(location).resolve()
+        with self._lock:
+            if location in self._writable:
+                return
+            self._writable.add(location)
+            for loc in list(self._locations):
+                if loc.resolve() == location:
+                    del self._locations[loc]
+
+    def is_indexed(self, location):
+        return Path(location) in self._locations
+
+    def _scan(self, location):
+        try:
+            mtime_ns = os.stat(location).st_mtime_ns
+            with os.scandir(location) as it:
+                entries = {entry.name for entry in it}
+        except OSError:
+            mtime_ns, entries = None, set()
+        return [entries, mtime_ns, time.monotonic()]
+
+    def contains(self, location, name):
+        """Checks if the location contains the entry"""
+        location = Path(location)
+        with self._lock:
+            index = self._locations.get(location)
+            if index is None:
+                index = self._locations[location] = self._scan(location)
+            if name in index[0]:
+                return True
+            now = time.monotonic()
+            if now - index[2] < self.refresh_interval:
+                return False
+            index[2] = now
+            try:
+                mtime_ns = os.stat(location).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            if mtime_ns != index[1]:
+                index = self._locations[location] = self._scan(location)
+            return name in index[0]
+
+    def add(self, location, name):
+        """Adds a new entry to an indexed location"""
+        with self._lock:
+            index = self._locations.get(Path(location))
+            if index is not None:
+                index[0].add(name)
+
+    def discard(self, location, name):
+        """Removes an entry from an indexed location"""
+        with self._lock:
+            index = self._locations.get(Path(location))
+            if index is not None:
+                index[0].discard(name)
+
+    def clear(self):
+        with self._lock:
+            self._locations = {loc: None for loc in self._locations}
+
+
+class CompletionRegistry:
+    """
+    Checksums of the results known to be saved in the cache locations.
+
+    The registry is owned by a submitter, which records the checksums
+    as the worker futures resolve, so the completion of the tasks
+    (``TaskBase.done``) is checked without loading the results.
+    The locations are checked only for checksums that are not recorded
+    (e.g. results of other processes), and the found checksums are recorded.
+    """
+
+    def __init__(self):
+        self._completed = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._completed)
+
+    def add(self, location, checksums):
+        location = Path(location)
+        with self._lock:
+            self._completed.update((location, checksum) for checksum in checksums)
+
+    def missing(self, checksums, locations):
+        """Returns the checksums not recorded for any of the locations"""
+        locations = [Path(location) for location in locations]
+        with self._lock:
+            return [
+                checksum
+                for checksum in checksums
+                if not any((loc, checksum) in self._completed for loc in locations)
+            ]
+
+    def available(self, checksums, locations):
+        """Returns the checksums with results saved in any of the locations"""
+        from .stores import get_result_store
+
+        missing = set(self.missing(checksums, locations))
+        available = set(checksums) - missing
+        for location in locations:
+            if not missing:
+                break
+            found = get_result_store(location).has_results(missing)
+            self.add(location, found)
+            available |= found
+            missing -= found
+        return available
+
+    def done(self, checksums, locations):
+        """Checks if results of all checksums are saved in any of the locations"""
+        return len(self.available(checksums, locations)) == len(set(checksums))
+
+
+result_cache = ResultCache()
+cache_index = CacheLocationIndex()
+
+
+class CacheManager:
+    """
+    Keeps size of a cache location within a budget by removing
+    the least recently used entries.
+
+    Access times of the entries are updated when results are loaded
+    (see ``stores.ResultStore.touch``). Entries are never removed if they are
+    pinned (see ``pin`` and ``pin_task``), locked by a running task or accessed
+    less than ``min_age`` seconds ago, so the garbage collection can run while
+    workflows are using the location.
+
+    Parameters
+    ----------
+    location : str or Path
+        Cache location (cache_dir of the tasks)
+    max_bytes : int
+        Size limit of the entries in the location
+    max_entries : int
+        Limit of the number of entries in the location
+    min_age : float
+        Entries accessed within ``min_age`` seconds are never removed
+    """
+
+    def __init__(
+        self, location, max_bytes=None, max_entries=None, min_age=CACHE_GC_MIN_AGE
+    ):
+        from .stores import get_result_store
+
+        self.location = Path(location)
+        self.store = get_result_store(self.location)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.min_age = min_age
+
+    def entries(self):
+        """Returns entries (``stores.CacheEntry``) of the location"""
+        return self.store.entries()
+
+    def usage(self):
+        """Returns total size and number of the entries"""
+        entries = self.entries()
+        return sum(entry.nbytes for entry in entries), len(entries)
+
+    def pin(self, *checksums):
+        for checksum in checksums:
+            self.store.pin(checksum)
+
+    def unpin(self, *checksums):
+        for checksum in checksums:
+            self.store.pin(checksum, pinned=False)
+
+    def pin_task(self, task):
+        """
+        Pins results of the task, for workflows the results of the nodes
+        connected to the workflow outputs are also pinned
+        """
+        checksums = task.checksum_states() if task.state else [task.checksum]
+        self.pin(*checksums)
+        if not hasattr(task, "graph"):
+            return
+        # inputs of the nodes are set like in the submitter to get the checksums
+        try:
+            for node in task.graph.sorted_nodes:
+                node.inputs.retrieve_values(task)
+            for _, lazy_field in task._connections:
+                node = getattr(task, lazy_field.name)
+                if node.cache_dir == self.location:
+                    self.pin_task(node)
+        finally:
+            task._reset()
+
+    def _lockfile(self, checksum):
+        return self.location / (checksum + ".lock")
+
+    def remove_stale_locks(self, max_age=0):
+        """
+        Removes lock files left by killed tasks (see ``locks.Lock.is_stale``)
+        that are older than ``max_age`` seconds
+        """
+        from .locks import get_lock, LockTimeout
+
+        removed = []
+        now = time.time()
+        for lockfile in self.location.glob("*.lock"):
+            try:
+                if now - lockfile.stat().st_mtime < max_age:
+                    continue
+                lock = get_lock(lockfile)
+                if not lock.is_stale():
+                    continue
+                # the lock file is removed on release
+                lock.acquire(timeout=0)
+                lock.release()
+                removed.append(lockfile.name)
+            except (OSError, LockTimeout):
+                pass
+        return removed
+
+    def gc(self, max_bytes=None, max_entries=None, dry_run=False):
+        """
+        Removes the least recently used entries until the location is
+        within the budget, returns the removed entries.
+        """
+        from .locks import get_lock, LockTimeout
+
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        max_entries = self.max_entries if max_entries is None else max_entries
+        entries = self.entries()
+        nbytes = sum(entry.nbytes for entry in entries)
+        nentries = len(entries)
+        removed = []
+        now = time.time()
+        for entry in sorted(entries, key=lambda entry: entry.accessed):
+            if (max_bytes is None or nbytes <= max_bytes) and (
+                max_entries is None or nentries <= max_entries
+            ):
+                break
+            if now - entry.accessed < self.min_age:
+                # all remaining entries are used by running workflows
+                break
+            if entry.pinned:
+                continue
+            lock = get_lock(self._lockfile(entry.checksum))
+            if lock.path.exists() and not lock.is_stale():
+                continue
+            if not dry_run:
+                # tasks computing the entry wait for the removal
+                try:
+                    lock.acquire(timeout=0)
+                except LockTimeout:
+                    continue
+                try:
+                    self.store.remove(entry.checksum)
+                finally:
+                    lock.release()
+            removed.append(entry)
+            nbytes -= entry.nbytes
+            nentries -= 1
+        return removed
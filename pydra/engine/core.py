@@ -1,5 +1,6 @@
 """Basic compute graph elements"""
 import abc
+import atexit
 import dataclasses as dc
 import json
 import logging
@@ -9,9 +10,9 @@ import typing as ty
 from copy import deepcopy
 
 import cloudpickle as cp
-from filelock import SoftFileLock
 import shutil
 from tempfile import mkdtemp
+import time
 
 from . import state
 from . import auxiliary as aux
@@ -21,6 +22,7 @@ from .helpers import (
     create_checksum,
     print_help,
     load_result,
+    results_available,
     save,
     ensure_list,
     record_error,
@@ -28,12 +30,38 @@ from .helpers import (
 )
 from .graph import DiGraph
 from .audit import Audit
+from .cache import cache_index
+from .stores import get_result_store
+from .locks import get_lock
 from ..utils.messenger import AuditFlag
 
 logger = logging.getLogger("pydra")
 
 develop = False
 
+# cache directory shared by all tasks of the process created without a cache_dir
+_session_cache_root = None
+
+
+def session_cache_root():
+    """
+    Returns the default cache directory of the tasks (created on the first use);
+    the directory is removed at the interpreter exit
+    """
+    global _session_cache_root
+    if _session_cache_root is None:
+        root = Path(mkdtemp(prefix="pydra-")).resolve()
+        atexit.register(_remove_session_cache_root, root, os.getpid())
+        cache_index.set_writable(root)
+        _session_cache_root = root
+    return _session_cache_root
+
+
+def _remove_session_cache_root(root, pid):
+    # forked processes (e.g. workers) inherit the handler, but not the directory
+    if os.getpid() == pid:
+        shutil.rmtree(root, ignore_errors=True)
+
 
 class TaskBase:
     _api_version: str = "0.0.1"  # Should generally not be touched by subclasses
@@ -51,7 +79,12 @@ class TaskBase:
     _runtime_requirements = RuntimeSpec()
     _runtime_hints = None
 
-    _cache_dir = None  # Working directory in which to operate
+    _cache_dir = None  # Working directory in which to operate (None: session root)
+    compression_threshold: ty.Optional[int] = None  # Compress larger results (bytes)
+    chunk_size = None  # State elements run in one worker job (int or "auto")
+    _completed = (
+        None  # Completion registry of the submitter (see cache.CompletionRegistry)
+    )
     _references = None  # List of references for a task
 
     # dj: do we need it??
@@ -125,6 +158,7 @@ class TaskBase:
         self.cache_locations = cache_locations
         self.allow_cache_override = True
         self._checksum = None
+        self._checksum_key = None
 
         self.plugin = None
         self.hooks = TaskHook()
@@ -134,6 +168,10 @@ class TaskBase:
 
     def __getstate__(self):
         state = self.__dict__.copy()
+        # the session cache root of this process is used by the workers
+        state["_cache_dir"] = self.cache_dir
+        # the registry is kept by the submitter
+        state.pop("_completed", None)
         state["input_spec"] = cp.dumps(state["input_spec"])
         state["output_spec"] = cp.dumps(state["output_spec"])
         state["inputs"] = dc.asdict(state["inputs"])
@@ -167,8 +205,13 @@ class TaskBase:
         """
         # if checksum is called before run the _graph_checksums is not ready
         if is_workflow(self) and self.inputs._graph_checksums is None:
-            self.inputs._graph_checksums = [nd.checksum for nd in self.graph_sorted]
+            self.inputs._graph_checksums = self.graph_checksums()
 
+        splitter = self.state.splitter if self.state is not None else None
+        checksum_key = (self._inputs_key(), str(splitter))
+        if self._checksum is not None and self._checksum_key == checksum_key:
+            return self._checksum
+        # inputs.hash is memoized by the spec until an input field changes
         input_hash = self.inputs.hash
         if self.state is None:
             self._checksum = create_checksum(self.__class__.__name__, input_hash)
@@ -178,8 +221,18 @@ class TaskBase:
             self._checksum = create_checksum(
                 self.__class__.__name__, hash_function([input_hash, splitter_hash])
             )
+        self._checksum_key = checksum_key
         return self._checksum
 
+    def _inputs_key(self):
+        """
+        Key changing with the inputs, the inputs are not hashed
+        unless they hold files or values that can't be tracked
+        (see ``BaseSpec.version_key``)
+        """
+        key = self.inputs.version_key()
+        return self.inputs.hash if key is None else key
+
     def checksum_states(self, state_index=None):
         """ calculating checksum for the specific state or all of the states
             replace lists in the inputs fields with a specific values for states
@@ -188,21 +241,50 @@ class TaskBase:
         if state_index is not None:
             if self.state is None:
                 raise Exception("can't use state_index if no splitter is used")
-            inputs_copy = deepcopy(self.inputs)
-            for key, ind in self.state.inputs_ind[state_index].items():
-                setattr(
-                    inputs_copy,
-                    key.split(".")[1],
-                    getattr(inputs_copy, key.split(".")[1])[ind],
-                )
-            input_hash = inputs_copy.hash
-            checksum_ind = create_checksum(self.__class__.__name__, input_hash)
-            return checksum_ind
+            return self._checksum_states_all()[state_index]
         else:
-            checksum_list = []
-            for ind in range(len(self.state.inputs_ind)):
-                checksum_list.append(self.checksum_states(state_index=ind))
-            return checksum_list
+            return list(self._checksum_states_all())
+
+    def _checksum_states_all(self):
+        """ calculating checksums of all states
+            every shared input and every element of the split inputs is hashed once,
+            and the hashes are combined for every state;
+            the list is cached in the state until inputs or the state indices change
+            (see ``_inputs_key``)
+        """
+        inputs_ind = self.state.inputs_ind
+        cache_key = (self._inputs_key(), len(inputs_ind))
+        if self.state.checksums_cache is not None:
+            if self.state.checksums_cache[0] == cache_key:
+                return self.state.checksums_cache[1]
+
+        fields = self.inputs._hashed_fields()
+        split_fields = {key.split(".")[1] for ind in inputs_ind for key in ind}
+        shared_hashes = {
+            field.name: self.inputs.hash_value(field, getattr(self.inputs, field.name))
+            for field in fields
+            if field.name not in split_fields
+        }
+        # hashes of the elements of the split inputs, {(field, index): hash}
+        element_hashes = {}
+        checksum_list = []
+        for state_ind in inputs_ind:
+            state_ind = {key.split(".")[1]: ind for key, ind in state_ind.items()}
+            field_hashes = {}
+            for field in fields:
+                if field.name in state_ind:
+                    el_key = (field.name, state_ind[field.name])
+                    if el_key not in element_hashes:
+                        element_hashes[el_key] = self.inputs.hash_value(
+                            field, getattr(self.inputs, field.name)[el_key[1]]
+                        )
+                    field_hashes[field.name] = element_hashes[el_key]
+                else:
+                    field_hashes[field.name] = shared_hashes[field.name]
+            input_hash = self.inputs.hash_fields(field_hashes)
+            checksum_list.append(create_checksum(self.__class__.__name__, input_hash))
+        self.state.checksums_cache = (cache_key, checksum_list)
+        return checksum_list
 
     def set_state(self, splitter, combiner=None):
         if splitter is not None:
@@ -229,6 +311,8 @@ class TaskBase:
 
     @property
     def cache_dir(self):
+        if self._cache_dir is None:
+            return session_cache_root()
         return self._cache_dir
 
     @cache_dir.setter
@@ -236,13 +320,13 @@ class TaskBase:
         if location is not None:
             self._cache_dir = Path(location).resolve()
             self._cache_dir.mkdir(parents=False, exist_ok=True)
+            cache_index.set_writable(self._cache_dir)
         else:
-            self._cache_dir = mkdtemp()
-            self._cache_dir = Path(self._cache_dir).resolve()
+            self._cache_dir = None
 
     @property
     def cache_locations(self):
-        return self._cache_locations + ensure_list(self._cache_dir)
+        return self._cache_locations + ensure_list(self.cache_dir)
 
     @cache_locations.setter
     def cache_locations(self, locations):
@@ -250,13 +334,16 @@ class TaskBase:
             self._cache_locations = [Path(loc) for loc in ensure_list(locations)]
         else:
             self._cache_locations = []
+        # additional locations are only read, so they can be indexed
+        for location in self._cache_locations:
+            cache_index.register(location)
 
     @property
     def output_dir(self):
         if self.state:
-            return [self._cache_dir / checksum for checksum in self.checksum_states()]
+            return [self.cache_dir / checksum for checksum in self.checksum_states()]
         else:
-            return self._cache_dir / self.checksum
+            return self.cache_dir / self.checksum
 
     def __call__(self, submitter=None, plugin=None, **kwargs):
         from .submitter import Submitter
@@ -284,7 +371,6 @@ class TaskBase:
         self.inputs = dc.replace(self.inputs, **kwargs)
         checksum = self.checksum
         lockfile = self.cache_dir / (checksum + ".lock")
-        # Eagerly retrieve cached
         """
         Concurrent execution scenarios
 
@@ -296,10 +382,18 @@ class TaskBase:
         4. two or more concurrent new processes get to start
         """
         self.hooks.pre_run(self)
-        # TODO add signal handler for processes killed after lock acquisition
-        with SoftFileLock(lockfile):
+        # Eagerly retrieve cached (results are published atomically,
+        # so they can be read without the lock), errored results are rerun
+        result = self.result()
+        if result is not None and not result.errored:
+            return result
+        # locks of killed processes are released (or reclaimed if stale)
+        lock = get_lock(lockfile)
+        with lock:
+            logger.debug("Waited %.3fs for the lock of %s", lock.wait_time, self.name)
+            # the result could be saved by another process in the meantime
             result = self.result()
-            if result is not None:
+            if result is not None and not result.errored:
                 return result
             # Let only one equivalent process run
             odir = self.output_dir
@@ -308,8 +402,11 @@ class TaskBase:
             cwd = os.getcwd()
             odir.mkdir(parents=False, exist_ok=True if self.can_resume else False)
             self.audit.start_audit(odir)
-            result = Result(output=None, runtime=None, errored=False)
+            result = Result(
+                output=None, runtime=None, errored=False, lock_wait=lock.wait_time
+            )
             self.hooks.pre_run_task(self)
+            start = time.monotonic()
             try:
                 self.audit.monitor()
                 self._run_task()
@@ -319,10 +416,19 @@ class TaskBase:
                 result.errored = True
                 raise
             finally:
+                result.duration = time.monotonic() - start
                 self.hooks.post_run_task(self, result)
                 self.audit.finalize_audit(result)
-                save(odir, result=result, task=self)
+                metadata = save(
+                    odir,
+                    result=result,
+                    task=self,
+                    compression_threshold=self.compression_threshold,
+                )
+                self.audit.audit_save(metadata)
+                logger.debug("Saved %s: %s", self.name, metadata)
                 os.chdir(cwd)
+                get_result_store(self.cache_dir).finalize_dir(odir)
         self.hooks.post_run(self, result)
         return result
 
@@ -346,6 +452,25 @@ class TaskBase:
         output = output_klass(**{f.name: None for f in dc.fields(output_klass)})
         return dc.replace(output, **run_output)
 
+    def set_requirements(self, cpus=None, mem_gb=None):
+        """
+        Declares resources used by the task, the workers run the tasks
+        only while the declared resources fit into their budget.
+
+        Parameters
+        ----------
+        cpus : int
+            Number of CPUs used by the task (1 by default)
+        mem_gb : float
+            Memory (in GB) used by the task
+        """
+        requirements = {"cpus": cpus, "mem_gb": mem_gb}
+        self._runtime_requirements = dc.replace(
+            self._runtime_requirements,
+            **{key: val for key, val in requirements.items() if val is not None},
+        )
+        return self
+
     def split(self, splitter, **kwargs):
         if kwargs:
             self.inputs = dc.replace(self.inputs, **kwargs)
@@ -392,28 +517,45 @@ class TaskBase:
             inputs_dict = {inp: getattr(self.inputs, inp) for inp in self.input_names}
             return None, inputs_dict
 
-    def to_job(self, ind):
-        """ running interface one element generated from node_state."""
+    def to_job(self, ind, checksum=None):
+        """ running interface one element generated from node_state.
+
+        The state and the inputs with all elements of the split fields are
+        detached while the task is copied, only the inputs of the element
+        are copied; ``checksum`` of the element is used if it's already known
+        (see ``checksum_states``).
+        """
         # logger.debug("Run interface el, name={}, ind={}".format(self.name, ind))
-        el = deepcopy(self)
-        el.state = None
-        # dj might be needed
-        # el._checksum = None
         _, inputs_dict = self.get_input_el(ind)
-        el.inputs = dc.replace(el.inputs, **inputs_dict)
+        detached = {
+            name: self.__dict__.pop(name)
+            for name in ["state", "inputs", "state_inputs"]
+            if name in self.__dict__
+        }
+        self.__dict__["state"] = None
+        self.__dict__["inputs"] = dc.replace(detached["inputs"], **inputs_dict)
+        try:
+            el = deepcopy(self)
+        finally:
+            self.__dict__.update(detached)
+        if checksum is not None:
+            el._checksum = checksum
+            el._checksum_key = (el._inputs_key(), str(None))
         return el
 
     # checking if all outputs are saved
     @property
     def done(self):
-        if self.state:
-            # TODO: only check for needed state result
-            if self.result() and all(self.result()):
-                return True
-        else:
-            if self.result():
-                return True
-        return False
+        """
+        Checks if results of the task (all states) are saved; the completion
+        registry of the submitter is checked first, and the cache locations
+        only for results that are not recorded (results are not loaded).
+        Errored results are not counted.
+        """
+        checksums = self.checksum_states() if self.state else [self.checksum]
+        if self._completed is not None:
+            return self._completed.done(checksums, self.cache_locations)
+        return not (set(checksums) - results_available(checksums, self.cache_locations))
 
     def _combined_output(self):
         combined_results = []
@@ -543,6 +685,15 @@ class Workflow(TaskBase):
     def graph_sorted(self):
         return self.graph.sorted_nodes
 
+    def graph_checksums(self):
+        """checksums of the nodes and the output connections of the workflow"""
+        connections = [
+            f"{name}:{val.name}.{val.field}"
+            for name, val in (self._connections or [])
+            if isinstance(val, LazyField)
+        ]
+        return [nd.checksum for nd in self.graph_sorted] + connections
+
     def add(self, task):
         """adding a task to the workflow"""
         if not is_task(task):
@@ -586,11 +737,13 @@ class Workflow(TaskBase):
 
     async def _run(self, submitter=None, **kwargs):
         # self.inputs = dc.replace(self.inputs, **kwargs) don't need it?
+        # the input files could be modified since they were checked last time
+        self.inputs.invalidate_hash(files_only=True)
         checksum = self.checksum
         lockfile = self.cache_dir / (checksum + ".lock")
         # Eagerly retrieve cached
         result = self.result()
-        if result is not None:
+        if result is not None and not result.errored:
             return result
         # creating connections that were defined after adding tasks to the wf
         for task in self.graph.nodes:
@@ -605,9 +758,15 @@ class Workflow(TaskBase):
         3. no cache or other process -> start
         4. two or more concurrent new processes get to start
         """
-        # TODO add signal handler for processes killed after lock acquisition
         self.hooks.pre_run(self)
-        with SoftFileLock(lockfile):
+        # the lock is awaited without blocking the event loop
+        lock = get_lock(lockfile)
+        async with lock:
+            logger.debug("Waited %.3fs for the lock of %s", lock.wait_time, self.name)
+            # the result could be saved by another process in the meantime
+            result = self.result()
+            if result is not None and not result.errored:
+                return result
             # # Let only one equivalent process run
             odir = self.output_dir
             if not self.can_resume and odir.exists():
@@ -615,8 +774,11 @@ class Workflow(TaskBase):
             cwd = os.getcwd()
             odir.mkdir(parents=False, exist_ok=True if self.can_resume else False)
             self.audit.start_audit(odir=odir)
-            result = Result(output=None, runtime=None, errored=False)
+            result = Result(
+                output=None, runtime=None, errored=False, lock_wait=lock.wait_time
+            )
             self.hooks.pre_run_task(self)
+            start = time.monotonic()
             try:
                 self.audit.monitor()
                 await self._run_task(submitter)
@@ -626,10 +788,19 @@ class Workflow(TaskBase):
                 result.errored = True
                 raise
             finally:
+                result.duration = time.monotonic() - start
                 self.hooks.post_run_task(self, result)
                 self.audit.finalize_audit(result=result)
-                save(odir, result=result, task=self)
+                metadata = save(
+                    odir,
+                    result=result,
+                    task=self,
+                    compression_threshold=self.compression_threshold,
+                )
+                self.audit.audit_save(metadata)
+                logger.debug("Saved %s: %s", self.name, metadata)
                 os.chdir(cwd)
+                get_result_store(self.cache_dir).finalize_dir(odir)
         self.hooks.post_run(self, result)
         return result
 
@@ -665,6 +836,63 @@ class Workflow(TaskBase):
         return output
 
 
+class TaskChunk:
+    """
+    State elements (jobs) of a task run back to back in one worker job,
+    so the cheap elements don't pay the overhead of the submission each.
+    The elements are run with ``_run`` (each one is cached and locked
+    separately), and the results of all elements are returned.
+    """
+
+    plugin = None
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.name = jobs[0].name
+
+    @property
+    def checksum(self):
+        checksums = [job.checksum for job in self.jobs]
+        return create_checksum("Chunk", hash_function(checksums))
+
+    @property
+    def cache_dir(self):
+        return self.jobs[0].cache_dir
+
+    @property
+    def _runtime_requirements(self):
+        return self.jobs[0]._runtime_requirements
+
+    def __call__(self):
+        return self._run()
+
+    def _run(self):
+        """
+        Runs all elements, errors are raised after all elements are run;
+        the results are saved in a single batch (see ``ResultStore.batch``)
+        """
+        results, error = [], None
+        with get_result_store(self.cache_dir).batch():
+            for job in self.jobs:
+                try:
+                    results.append(job._run())
+                except Exception as e:
+                    results.append(None)
+                    error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def result(self):
+        results = [job.result() for job in self.jobs]
+        if any(result is None for result in results):
+            return None
+        return results
+
+    def __repr__(self):
+        return f"<TaskChunk {self.name} ({len(self.jobs)} elements)>"
+
+
 def is_task(obj):
     return hasattr(obj, "_run_task")
 
@@ -222,3 +222,19 @@ class DiGraph:
         for nm in first_nodes:
             self.max_paths[nm] = {}
             self._checking_path(node_name=nm, first_name=nm)
+
+    def calculate_critical_paths(self, weights=None):
+        """ calculate lengths of the longest (critical) paths from every node
+        to the nodes without successors, weights of the nodes (e.g. durations)
+        are summed along the paths (nodes without weights have weight 1)
+        """
+        weights = weights or {}
+        self.critical_paths = {}
+        for nd in reversed(self.sorted_nodes):
+            self.critical_paths[nd.name] = weights.get(nd.name, 1) + max(
+                [
+                    self.critical_paths[nd_out.name]
+                    for nd_out in self.successors[nd.name]
+                ],
+                default=0,
+            )
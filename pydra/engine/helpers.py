@@ -1,13 +1,16 @@
 import asyncio
 import asyncio.subprocess as asp
 import dataclasses as dc
-import cloudpickle as cp
-from pathlib import Path
+from pathlib import Path, PurePath
 import os
 import sys
+from functools import singledispatch
 from hashlib import sha256
 
-from .specs import Runtime
+from .specs import Runtime, TrackedDict, TrackedList
+from .helpers_file import hash_file, file_signature  # noqa: F401
+from .serialization import load_file
+from .stores import ResultStore, RESULT_STORES, get_result_store
 
 
 def ensure_list(obj):
@@ -46,18 +49,41 @@ def print_help(obj):
 
 
 def load_result(checksum, cache_locations):
+    """
+    Loads result from the first cache location containing the checksum
+
+    Every location is read by its result store (see ``stores.get_result_store``).
+    """
     if not cache_locations:
         return None
     for location in cache_locations:
-        if (location / checksum).exists():
-            result_file = location / checksum / "_result.pklz"
-            if result_file.exists() and result_file.stat().st_size > 0:
-                return cp.loads(result_file.read_bytes())
-            return None
+        store = get_result_store(location)
+        if not store.contains(checksum):
+            continue
+        result = store.load_result(checksum)
+        if result is None and not store.contains(checksum):
+            # entry removed after the location was indexed
+            continue
+        return result
     return None
 
 
-def save(task_path: Path, result=None, task=None):
+def results_available(checksums, cache_locations):
+    """Returns the checksums with results saved in any of the cache locations"""
+    missing = set(checksums)
+    available = set()
+    for location in cache_locations:
+        if not missing:
+            break
+        found = get_result_store(location).has_results(missing)
+        available |= found
+        missing -= found
+    return available
+
+
+def save(
+    task_path: Path, result=None, task=None, store=None, compression_threshold=None
+):
     """
     Save ``Task`` object and/or results.
 
@@ -69,16 +95,32 @@ def save(task_path: Path, result=None, task=None):
         Result to pickle and write
     task : Task
         Task to pickle and write
+    store : str or ResultStore
+        Store used to save the task and/or results, if None the store
+        of the cache location (``task_path.parent``) is used
+    compression_threshold : int
+        Pickles larger than the threshold (in bytes) are compressed,
+        if None ``serialization.COMPRESSION_THRESHOLD`` is used
+
+    Returns
+    -------
+    metadata : dict
+        Compression metadata of the saved result and/or task
     """
     if task is None and result is None:
         raise ValueError("Nothing to be saved")
-    task_path.mkdir(parents=True, exist_ok=True)
-    if result:
-        with (task_path / "_result.pklz").open("wb") as fp:
-            cp.dump(result, fp)
-    if task:
-        with (task_path / "_task.pklz").open("wb") as fp:
-            cp.dump(task, fp)
+    if store is None:
+        store = get_result_store(task_path.parent)
+    elif not isinstance(store, ResultStore):
+        store = RESULT_STORES[store](task_path.parent)
+    return store.save(
+        task_path.name, result=result, task=task, threshold=compression_threshold
+    )
+
+
+def load_task(task_pkl):
+    """Loads ``Task`` object saved by ``save``"""
+    return load_file(task_pkl)
 
 
 def task_hash(task_obj):
@@ -173,8 +215,7 @@ def create_checksum(name, inputs):
 
 
 def record_error(error_path, error):
-    with (error_path / "_error.pklz").open("wb") as fp:
-        cp.dump(error, fp)
+    get_result_store(error_path.parent).record_error(error_path.name, error)
 
 
 def get_open_loop():
@@ -218,13 +259,13 @@ def create_pyscript(script_path, checksum):
     if not task_pkl.exists() or not task_pkl.stat().st_size:
         raise Exception("Missing or empty task!")
 
-    content = f"""import cloudpickle as cp
-from pathlib import Path
+    content = f"""from pathlib import Path
+from pydra.engine.helpers import load_task
 
 
 cache_path = Path("{str(script_path)}")
 task_pkl = (cache_path / "_task.pklz")
-task = cp.loads(task_pkl.read_bytes())
+task = load_task(task_pkl)
 
 # submit task
 task()
@@ -241,23 +282,159 @@ task_pkl.unlink()
 
 
 def hash_function(obj):
-    return sha256(str(obj).encode()).hexdigest()
+    """
+    Computes sha256 hash of the structure of an object
+
+    The object is walked recursively and a canonical byte representation
+    of every element (see ``bytes_repr``) is fed to the hash, so no string
+    representation of the whole object is created.
+    """
+    crypto_obj = sha256()
+    buffer = bytearray()
+    for chunk in bytes_repr(obj):
+        if len(chunk) >= _HASH_BUFFER_SIZE:
+            # big buffers (e.g. arrays) are passed to the hash directly
+            crypto_obj.update(buffer)
+            buffer.clear()
+            crypto_obj.update(chunk)
+        else:
+            buffer += chunk
+            if len(buffer) >= _HASH_BUFFER_SIZE:
+                crypto_obj.update(buffer)
+                buffer.clear()
+    crypto_obj.update(buffer)
+    return crypto_obj.hexdigest()
+
+
+_HASH_BUFFER_SIZE = 2 ** 16
 
 
-def hash_file(afile, chunk_len=8192, crypto=sha256, raise_notfound=False):
+@singledispatch
+def bytes_repr(obj):
     """
-    Computes hash of a file using 'crypto' module
+    Yields canonical byte representation of an object used by ``hash_function``.
+
+    Representations of new types can be added with ``register_hasher``.
     """
-    if not os.path.isfile(afile):
-        if raise_notfound:
-            raise RuntimeError('File "%s" not found.' % afile)
-        return None
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(obj, (numpy.ndarray, numpy.generic)):
+        yield from _bytes_repr_numpy(obj)
+    elif dc.is_dataclass(obj) and not isinstance(obj, type):
+        yield f"dataclass:{_qualname(obj)}:".encode()
+        yield from bytes_repr({f.name: getattr(obj, f.name) for f in dc.fields(obj)})
+    else:
+        try:
+            view = memoryview(obj)
+        except TypeError:
+            # no structure known, using the string representation
+            yield f"obj:{_qualname(obj)}:".encode()
+            yield from bytes_repr(str(obj))
+        else:
+            yield f"buffer:{_qualname(obj)}:{view.format}:{view.shape}:".encode()
+            yield from _bytes_repr_buffer(view)
 
-    crypto_obj = crypto()
-    with open(afile, "rb") as fp:
-        while True:
-            data = fp.read(chunk_len)
-            if not data:
-                break
-            crypto_obj.update(data)
-    return crypto_obj.hexdigest()
+
+def register_hasher(cls, func=None):
+    """
+    Registers a function that yields byte representation of objects of type ``cls``
+
+    Can be used as a decorator. The function takes the object and yields
+    bytes, ``bytes_repr`` can be used for the nested objects, e.g.::
+
+        @register_hasher(Subject)
+        def bytes_repr_subject(obj):
+            yield b"Subject:"
+            yield from bytes_repr((obj.sid, obj.session))
+    """
+    if func is None:
+        return lambda func: register_hasher(cls, func)
+    bytes_repr.register(cls, func)
+    return func
+
+
+def _qualname(obj):
+    klass = type(obj)
+    return f"{klass.__module__}.{klass.__qualname__}"
+
+
+def _bytes_repr_buffer(view):
+    if not view.c_contiguous:
+        view = memoryview(view.tobytes())
+    view = view.cast("B")
+    yield f"{view.nbytes}:".encode()
+    yield view
+
+
+def _bytes_repr_numpy(obj):
+    import numpy as np
+
+    if obj.dtype.hasobject:
+        yield f"ndarray:{obj.dtype.str}:{obj.shape}:".encode()
+        yield from bytes_repr(obj.tolist())
+    else:
+        obj = np.ascontiguousarray(obj)
+        yield f"ndarray:{obj.dtype.str}:{obj.shape}:".encode()
+        yield from _bytes_repr_buffer(memoryview(obj.reshape(-1).view(np.uint8)))
+
+
+@bytes_repr.register(type(None))
+@bytes_repr.register(bool)
+@bytes_repr.register(int)
+@bytes_repr.register(float)
+@bytes_repr.register(complex)
+def _bytes_repr_scalar(obj):
+    # subclasses (e.g. numpy.float64) are represented as the builtin types
+    for base in (type(None), bool, int, float, complex):
+        if isinstance(obj, base):
+            yield f"{base.__name__}:{base.__repr__(obj)};".encode()
+            return
+
+
+@bytes_repr.register(str)
+def _bytes_repr_str(obj):
+    data = obj.encode()
+    yield f"str:{len(data)}:".encode()
+    yield data
+
+
+@bytes_repr.register(bytes)
+@bytes_repr.register(bytearray)
+def _bytes_repr_bytes(obj):
+    yield f"{type(obj).__name__}:{len(obj)}:".encode()
+    yield obj
+
+
+@bytes_repr.register(PurePath)
+def _bytes_repr_path(obj):
+    yield f"{type(obj).__name__}:".encode()
+    yield from bytes_repr(str(obj))
+
+
+@bytes_repr.register(list)
+@bytes_repr.register(tuple)
+def _bytes_repr_seq(obj):
+    # tracked containers of the inputs (see ``specs.track``) are hashed as plain ones
+    name = "list" if isinstance(obj, TrackedList) else type(obj).__name__
+    yield f"{name}:{len(obj)}:".encode()
+    for el in obj:
+        yield from bytes_repr(el)
+
+
+@bytes_repr.register(set)
+@bytes_repr.register(frozenset)
+def _bytes_repr_set(obj):
+    # order of elements is not defined, so sorting hashes of the elements
+    yield f"{type(obj).__name__}:{len(obj)}:".encode()
+    for el_hash in sorted(hash_function(el) for el in obj):
+        yield el_hash.encode()
+
+
+@bytes_repr.register(dict)
+def _bytes_repr_dict(obj):
+    # keys are sorted by their hashes, so keys of any type can be used
+    yield f"dict:{len(obj)}:".encode()
+    for key_hash, _, value in sorted(
+        ((hash_function(key), i, value) for i, (key, value) in enumerate(obj.items()))
+    ):
+        yield key_hash.encode()
+        yield from bytes_repr(value)
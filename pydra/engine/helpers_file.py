@@ -0,0 +1,526 @@
+"""Helpers for hashing files and keeping track of already computed file hashes"""
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import stat
+import threading
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .locks import SHARED_FILESYSTEMS, filesystem_type
+
+logger = logging.getLogger("pydra")
+
+# algorithm used to hash files (see ``hash_algorithm``) and size of the read buffer
+HASH_ALGORITHM = "sha256"
+HASH_CHUNK_LEN = 2 ** 20
+# number of threads used by ``hash_files`` (if None, depends on number of CPUs)
+HASH_MAX_WORKERS = None
+
+# location of the persistent hash index, if None the default location is used
+# (set to False to disable the index completely), see ``set_hash_index``
+HASH_INDEX_PATH = None
+# files modified less than RACY_WINDOW seconds ago are hashed but not indexed,
+# since a write within the timestamp granularity would not change their signature
+RACY_WINDOW = 2.0
+
+_hash_index = None
+_hash_index_lock = threading.Lock()
+
+
+def default_hash_index_path():
+    """
+    Default location of the hash index, within the session cache root
+    (see ``core.session_cache_root``); a location shared between sessions
+    is set with ``set_hash_index``
+    """
+    from .core import session_cache_root
+
+    return session_cache_root() / "file_hashes.sqlite"
+
+
+def file_signature(afile):
+    """
+    Stat signature of a file: (size, mtime_ns, inode)
+
+    Returns None if the file doesn't exist or ``afile`` is not a path.
+    """
+    try:
+        st = os.stat(afile)
+    except (OSError, TypeError, ValueError):
+        return None
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def sqlite_connection(local, path, timeout):
+    """
+    Returns a connection to the SQLite database for the current thread
+    and process, the connection is kept in ``local`` (``threading.local``).
+
+    The database uses the write-ahead log, except on the filesystems shared
+    between hosts (see ``locks.SHARED_FILESYSTEMS``), where the shared memory
+    of the log doesn't work and the rollback journal is used instead.
+    """
+    conn = getattr(local, "conn", None)
+    if conn is None or local.pid != os.getpid():
+        conn = sqlite3.connect(str(path), timeout=timeout)
+        if filesystem_type(Path(path).parent) in SHARED_FILESYSTEMS:
+            conn.execute("PRAGMA journal_mode=DELETE")
+        else:
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        local.conn = conn
+        local.pid = os.getpid()
+    return conn
+
+
+class FileHashIndex:
+    """
+    Persistent index of file hashes kept in a SQLite database.
+
+    A hash is stored together with the stat signature of the file
+    (size, mtime_ns, inode) it was computed for, and it is returned only
+    if the current signature of the file is identical.
+    Changed files are simply rehashed and their entries replaced.
+    Many processes can read and write the index concurrently
+    (see ``sqlite_connection``).
+    """
+
+    _schema = (
+        "CREATE TABLE IF NOT EXISTS file_hashes ("
+        "path TEXT NOT NULL, algorithm TEXT NOT NULL, size INTEGER NOT NULL, "
+        "mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, digest TEXT NOT NULL, "
+        "PRIMARY KEY (path, algorithm))",
+        # Merkle hashes of directories, signature is a digest of the subtree stats
+        "CREATE TABLE IF NOT EXISTS dir_hashes ("
+        "path TEXT NOT NULL, algorithm TEXT NOT NULL, signature TEXT NOT NULL, "
+        "digest TEXT NOT NULL, PRIMARY KEY (path, algorithm))",
+    )
+
+    def __init__(self, path, timeout=60.0):
+        self.path = Path(path)
+        self.timeout = timeout
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # hashes already seen by this process, saves the database queries
+        self._memo = {}
+        self._local = threading.local()
+        with self._connection() as conn:
+            for statement in self._schema:
+                conn.execute(statement)
+
+    def __getstate__(self):
+        return {"path": self.path, "timeout": self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connection(self):
+        return sqlite_connection(self._local, self.path, self.timeout)
+
+    def lookup(self, afile, algorithm, signature=None):
+        """
+        Returns the indexed hash of a file if the file hasn't changed since indexing.
+
+        Parameters
+        ----------
+        afile : str or Path
+            File path
+        algorithm : str
+            Name of the hash algorithm
+        signature : tuple
+            Current signature of the file, calculated if not provided
+        """
+        path = os.path.realpath(afile)
+        if signature is None:
+            signature = file_signature(path)
+        if signature is None:
+            return None
+        memo = self._memo.get((path, algorithm))
+        if memo is not None and memo[0] == signature:
+            return memo[1]
+        try:
+            row = (
+                self._connection()
+                .execute(
+                    "SELECT size, mtime_ns, inode, digest FROM file_hashes "
+                    "WHERE path=? AND algorithm=?",
+                    (path, algorithm),
+                )
+                .fetchone()
+            )
+        except sqlite3.Error as e:
+            logger.debug(f"Hash index lookup failed for {path}: {e}")
+            return None
+        if row is None or tuple(row[:3]) != signature:
+            return None
+        self._memo[(path, algorithm)] = (signature, row[3])
+        return row[3]
+
+    def store(self, afile, algorithm, digest, signature):
+        """
+        Adds a file hash to the index.
+
+        ``signature`` has to be the signature of the file before hashing,
+        the hash is not stored if the file was modified in the meantime
+        or if the modification is too recent to be detected reliably.
+        """
+        path = os.path.realpath(afile)
+        if signature is None or file_signature(path) != signature:
+            return False
+        if time.time() - signature[1] / 1e9 < RACY_WINDOW:
+            return False
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?)",
+                    (path, algorithm) + tuple(signature) + (digest,),
+                )
+        except sqlite3.Error as e:
+            logger.debug(f"Hash index update failed for {path}: {e}")
+            return False
+        self._memo[(path, algorithm)] = (signature, digest)
+        return True
+
+    def lookup_dir(self, dirpath, algorithm, signature):
+        """Returns the indexed Merkle hash of a directory with the subtree signature"""
+        path = os.path.realpath(dirpath)
+        memo = self._memo.get((path, algorithm, "dir"))
+        if memo is not None and memo[0] == signature:
+            return memo[1]
+        try:
+            row = (
+                self._connection()
+                .execute(
+                    "SELECT signature, digest FROM dir_hashes "
+                    "WHERE path=? AND algorithm=?",
+                    (path, algorithm),
+                )
+                .fetchone()
+            )
+        except sqlite3.Error as e:
+            logger.debug(f"Hash index lookup failed for {path}: {e}")
+            return None
+        if row is None or row[0] != signature:
+            return None
+        self._memo[(path, algorithm, "dir")] = (signature, row[1])
+        return row[1]
+
+    def store_dir(self, dirpath, algorithm, digest, signature):
+        """Adds a Merkle hash of a directory with the subtree signature to the index"""
+        path = os.path.realpath(dirpath)
+        try:
+            with self._connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO dir_hashes VALUES (?, ?, ?, ?)",
+                    (path, algorithm, signature, digest),
+                )
+        except sqlite3.Error as e:
+            logger.debug(f"Hash index update failed for {path}: {e}")
+            return False
+        self._memo[(path, algorithm, "dir")] = (signature, digest)
+        return True
+
+    def prune(self):
+        """Removes entries of files that no longer exist or have changed"""
+        conn = self._connection()
+        rows = conn.execute(
+            "SELECT path, algorithm, size, mtime_ns, inode FROM file_hashes"
+        ).fetchall()
+        stale = [
+            (path, algorithm)
+            for (path, algorithm, *signature) in rows
+            if file_signature(path) != tuple(signature)
+        ]
+        stale_dirs = [
+            (path, algorithm)
+            for (path, algorithm) in conn.execute(
+                "SELECT path, algorithm FROM dir_hashes"
+            ).fetchall()
+            if not os.path.isdir(path)
+        ]
+        with conn:
+            conn.executemany(
+                "DELETE FROM file_hashes WHERE path=? AND algorithm=?", stale
+            )
+            conn.executemany(
+                "DELETE FROM dir_hashes WHERE path=? AND algorithm=?", stale_dirs
+            )
+        self._memo.clear()
+        return len(stale) + len(stale_dirs)
+
+
+def set_hash_index(path):
+    """
+    Sets location of the persistent file hash index.
+
+    Parameters
+    ----------
+    path : str, Path, None or False
+        Location of the SQLite database, None for the default location
+        and False to disable the index
+    """
+    global HASH_INDEX_PATH, _hash_index
+    with _hash_index_lock:
+        HASH_INDEX_PATH = path
+        _hash_index = None
+
+
+def get_hash_index():
+    """Returns the hash index of this process, or None if the index is disabled"""
+    global _hash_index
+    if HASH_INDEX_PATH is False:
+        return None
+    with _hash_index_lock:
+        if _hash_index is None:
+            path = HASH_INDEX_PATH or default_hash_index_path()
+            try:
+                _hash_index = FileHashIndex(path)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Hash index {path} can't be used: {e}")
+                # not trying again until the location is changed
+                _hash_index = False
+        return _hash_index or None
+
+
+def hash_algorithm(name=None):
+    """
+    Returns name and constructor of a hash algorithm
+
+    Parameters
+    ----------
+    name : str or callable
+        Name of the algorithm (``HASH_ALGORITHM`` if None), algorithms from
+        hashlib (e.g. sha256, blake2b) and from xxhash (e.g. xxh3_128, xxh64)
+        if the package is installed can be used; a constructor of a hash object
+        (e.g. ``hashlib.md5``) is also accepted
+    """
+    if name is None:
+        name = HASH_ALGORITHM
+    if callable(name):
+        return name().name, name
+    if name in hashlib.algorithms_available:
+        return name, getattr(hashlib, name, partial(hashlib.new, name))
+    if name.startswith("xxh"):
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError(f"hash algorithm {name} requires xxhash package")
+        if hasattr(xxhash, name):
+            return name, getattr(xxhash, name)
+    raise ValueError(f"unknown hash algorithm {name}")
+
+
+def set_hash_algorithm(name, chunk_len=None):
+    """
+    Sets algorithm (and optionally the read buffer size) used to hash files
+
+    Note, that file hashes are part of the task checksums,
+    so tasks with file inputs get new checksums when the algorithm is changed.
+    """
+    global HASH_ALGORITHM, HASH_CHUNK_LEN
+    hash_algorithm(name)
+    HASH_ALGORITHM = name
+    if chunk_len is not None:
+        HASH_CHUNK_LEN = chunk_len
+
+
+def hash_file(afile, chunk_len=None, crypto=None, raise_notfound=False, use_index=True):
+    """
+    Computes hash of a file using 'crypto' module
+
+    ``crypto`` can be a name of the algorithm or a constructor of a hash object,
+    ``HASH_ALGORITHM`` is used by default, see ``hash_algorithm``.
+    If ``use_index`` is set, the persistent hash index is checked first
+    and the file is read only if it has changed since it was last hashed.
+    """
+    if not os.path.isfile(afile):
+        if raise_notfound:
+            raise RuntimeError('File "%s" not found.' % afile)
+        return None
+
+    algorithm, crypto = hash_algorithm(crypto)
+    index = get_hash_index() if use_index else None
+    if index is not None:
+        signature = file_signature(afile)
+        digest = index.lookup(afile, algorithm, signature=signature)
+        if digest is not None:
+            return digest
+
+    crypto_obj = crypto()
+    # reading into one preallocated buffer
+    buffer = bytearray(chunk_len or HASH_CHUNK_LEN)
+    view = memoryview(buffer)
+    with open(afile, "rb", buffering=0) as fp:
+        while True:
+            size = fp.readinto(buffer)
+            if not size:
+                break
+            crypto_obj.update(view[:size])
+    digest = crypto_obj.hexdigest()
+    if index is not None:
+        index.store(afile, algorithm, digest, signature)
+    return digest
+
+
+def hash_files(files, crypto=None, max_workers=None, **kwargs):
+    """
+    Computes hashes of many files using a pool of threads
+
+    Files found in the hash index are not read at all, the remaining files
+    are hashed concurrently (hash functions release the GIL while hashing).
+
+    Returns
+    -------
+    hashes : list
+        Hashes of the files in the same order as ``files``
+    """
+    files = list(files)
+    if max_workers is None:
+        max_workers = HASH_MAX_WORKERS or min(32, (os.cpu_count() or 1) + 4)
+    if len(files) < 2 or max_workers < 2:
+        return [hash_file(afile, crypto=crypto, **kwargs) for afile in files]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(
+            pool.map(lambda afile: hash_file(afile, crypto=crypto, **kwargs), files)
+        )
+
+
+def hash_dir(
+    dirpath, crypto=None, raise_notfound=False, use_index=True, return_signature=False
+):
+    """
+    Computes Merkle hash of a directory
+
+    The hash of a directory is calculated from the names and hashes
+    of its files and subdirectories. Every subtree hash is kept in the hash
+    index together with a digest of the stat signatures of the subtree,
+    so after a file is modified only the file is read again and only the hashes
+    of the directories on its path to the root are recalculated.
+    If ``return_signature`` is set, the stat signature of the tree collected
+    while hashing (see ``dir_signature``) is returned with the hash.
+    """
+    if not os.path.isdir(dirpath):
+        if raise_notfound:
+            raise RuntimeError('Directory "%s" not found.' % dirpath)
+        return (None, None) if return_signature else None
+    algorithm, _ = hash_algorithm(crypto)
+    index = get_hash_index() if use_index else None
+    digest, signature, _ = _hash_dir_tree(dirpath, algorithm, index, frozenset())
+    return (digest, signature) if return_signature else digest
+
+
+def dir_signature(dirpath):
+    """
+    Stat signature of a directory tree: a Merkle hash of the names and the stat
+    signatures of all entries (the files are not read)
+
+    Returns None if the directory doesn't exist.
+    """
+    if not os.path.isdir(dirpath):
+        return None
+    return _dir_stat_tree(dirpath, frozenset())
+
+
+def _dir_key(dirpath):
+    st = os.stat(dirpath)
+    return st.st_dev, st.st_ino
+
+
+def _dir_stat_tree(dirpath, ancestors):
+    from .helpers import hash_function
+
+    ancestors = ancestors | {_dir_key(dirpath)}
+    stat_items = []
+    for entry, kind, signature in _scan_dir(dirpath, ancestors):
+        if kind == "dir":
+            signature = _dir_stat_tree(entry.path, ancestors)
+        stat_items.append((entry.name, kind, signature))
+    return hash_function(stat_items)
+
+
+def _scan_dir(dirpath, ancestors):
+    """
+    Yields the entries of the directory (sorted by names) with their kind
+    and stat signature (None for the subdirectories)
+
+    Symbolic links are followed, except the links to the directories
+    on the path from the root (``ancestors`` are their device and inode numbers),
+    which would form loops, and the broken links;
+    the target of such a link is used as its signature.
+    """
+    for entry in sorted(os.scandir(dirpath), key=lambda entry: entry.name):
+        if entry.is_symlink():
+            try:
+                st = os.stat(entry.path)
+            except OSError:
+                yield entry, "link", os.readlink(entry.path)
+                continue
+            if not stat.S_ISDIR(st.st_mode):
+                yield entry, "file", (st.st_size, st.st_mtime_ns, st.st_ino)
+            elif (st.st_dev, st.st_ino) in ancestors:
+                yield entry, "link", os.readlink(entry.path)
+            else:
+                yield entry, "dir", None
+        elif entry.is_dir(follow_symlinks=False):
+            yield entry, "dir", None
+        else:
+            signature = file_signature(entry.path)
+            if signature is not None:
+                yield entry, "file", signature
+
+
+def _hash_dir_tree(dirpath, algorithm, index, ancestors):
+    """
+    Returns Merkle hash and stat signature of the subtree,
+    and whether the hash can be indexed
+    """
+    from .helpers import hash_function
+
+    now = time.time()
+    indexable = True
+    ancestors = ancestors | {_dir_key(dirpath)}
+    stat_items, subdirs, files = [], {}, []
+    for entry, kind, signature in _scan_dir(dirpath, ancestors):
+        if kind == "dir":
+            subdirs[entry.name] = _hash_dir_tree(
+                entry.path, algorithm, index, ancestors
+            )
+            signature = subdirs[entry.name][1]
+            indexable = indexable and subdirs[entry.name][2]
+        elif kind == "file":
+            files.append(entry)
+            # recently modified files are not indexed (see ``RACY_WINDOW``)
+            indexable = indexable and now - signature[1] / 1e9 >= RACY_WINDOW
+        stat_items.append((entry.name, kind, signature))
+    signature = hash_function(stat_items)
+    if index is not None:
+        digest = index.lookup_dir(dirpath, algorithm, signature)
+        if digest is not None:
+            return digest, signature, indexable
+
+    file_hashes = dict(
+        zip(
+            [entry.name for entry in files],
+            hash_files(
+                [entry.path for entry in files],
+                crypto=algorithm,
+                use_index=index is not None,
+            ),
+        )
+    )
+    tree = []
+    for name, kind, target in stat_items:
+        if kind == "dir":
+            tree.append((name, kind, subdirs[name][0]))
+        elif kind == "file":
+            tree.append((name, kind, file_hashes[name]))
+        else:
+            # links forming loops and broken links are hashed by their targets
+            tree.append((name, kind, target))
+    digest = hash_function((algorithm, tree))
+    if index is not None and indexable:
+        index.store_dir(dirpath, algorithm, digest, signature)
+    return digest, signature, indexable
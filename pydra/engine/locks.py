@@ -0,0 +1,360 @@
+"""Locks of the task checksums (only one equivalent task runs at a time)"""
+import abc
+import asyncio
+import json
+import logging
+import os
+from pathlib import Path
+import socket
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+logger = logging.getLogger("pydra")
+
+# backend used for the lock files: "auto" (flock on local disks, heartbeat on
+# shared filesystems), "flock" or "heartbeat"
+LOCK_BACKEND = "auto"
+# time (in seconds) between updates of the heartbeat of a held lock
+HEARTBEAT_INTERVAL = 10.0
+# heartbeat locks not updated within the time (in seconds) are stale
+HEARTBEAT_TIMEOUT = 60.0
+# maximal time (in seconds) between checks of a lock held by another process
+POLL_INTERVAL = 1.0
+
+# filesystem types shared between hosts (flock is unreliable or local-only there)
+SHARED_FILESYSTEMS = {
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smbfs",
+    "smb3",
+    "lustre",
+    "gpfs",
+    "beegfs",
+    "glusterfs",
+    "fuse.glusterfs",
+    "ceph",
+    "fuse.ceph",
+    "panfs",
+    "afs",
+    "fuse.sshfs",
+}
+
+
+class LockTimeout(TimeoutError):
+    """Raised when a lock is not acquired within the timeout"""
+
+
+# conditions notified by the releases of the locks held within the process,
+# {path: [condition, number of users]}
+_conditions = {}
+_conditions_lock = threading.Lock()
+
+
+class Lock(abc.ABC):
+    """
+    Base class of the lock files of the tasks.
+
+    Locks are not reentrant. The lock file is removed when the lock is released.
+    The time spent waiting for the last acquisition is kept in ``wait_time``.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.wait_time = None
+
+    @abc.abstractmethod
+    def _try_acquire(self, blocking):
+        """
+        Tries to acquire the lock, returns True if the lock is acquired.
+        If ``blocking`` is set, the method can wait for the release
+        (e.g. by the kernel), returning False means the lock has to be tried again.
+        """
+
+    @abc.abstractmethod
+    def _release(self):
+        """Releases the lock and removes the lock file"""
+
+    @abc.abstractmethod
+    def is_stale(self):
+        """Checks if the lock file is left by a holder that is not running anymore"""
+
+    def acquire(self, timeout=None):
+        """
+        Waits for the lock, ``timeout`` (in seconds) limits the waiting time,
+        ``LockTimeout`` is raised when the lock is not acquired in time.
+        """
+        start = time.monotonic()
+        delay = 0.005
+        with _condition(self.path) as condition:
+            while True:
+                remaining = (
+                    None if timeout is None else timeout - (time.monotonic() - start)
+                )
+                if self._try_acquire(blocking=timeout is None):
+                    break
+                if remaining is not None and remaining <= 0:
+                    raise LockTimeout(f"lock {self.path} is held by another task")
+                # woken up by the releases within the process,
+                # the lock files of other processes are checked with a backoff
+                delay = min(delay * 2, POLL_INTERVAL)
+                with condition:
+                    condition.wait(
+                        delay if remaining is None else min(delay, remaining)
+                    )
+        self.wait_time = time.monotonic() - start
+        return self
+
+    def release(self):
+        self._release()
+        with _conditions_lock:
+            entry = _conditions.get(self.path)
+        if entry is not None:
+            with entry[0]:
+                entry[0].notify_all()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    async def __aenter__(self):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.acquire)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class _condition:
+    """Context manager sharing a condition between the waiters for the lock file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        with _conditions_lock:
+            entry = _conditions.setdefault(self.path, [threading.Condition(), 0])
+            entry[1] += 1
+        return entry[0]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with _conditions_lock:
+            entry = _conditions[self.path]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _conditions[self.path]
+
+
+class FlockLock(Lock):
+    """
+    Lock file locked with ``flock`` (for local disks).
+
+    Waiting processes are woken up by the kernel when the lock is released,
+    and the lock is released by the kernel when the holder dies
+    (the lock file is left, but it doesn't block other tasks).
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._fd = None
+
+    def _try_acquire(self, blocking):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(
+                fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # the file could be removed by the previous holder before it was locked
+        try:
+            locked = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            locked = False
+        if not locked:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def _release(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def is_stale(self):
+        if not self.path.exists():
+            return False
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        finally:
+            os.close(fd)
+        return True
+
+
+class HeartbeatLock(Lock):
+    """
+    Lock file created exclusively and kept alive by a heartbeat
+    (for shared filesystems).
+
+    The lock file holds the host and the pid of the holder, and its mtime is
+    updated every ``interval`` seconds. Locks that are not updated within
+    ``timeout`` seconds or held by a dead process of the same host are stale,
+    and they are reclaimed by the waiting tasks.
+    """
+
+    def __init__(self, path, interval=None, timeout=None):
+        super().__init__(path)
+        self.interval = HEARTBEAT_INTERVAL if interval is None else interval
+        self.timeout = HEARTBEAT_TIMEOUT if timeout is None else timeout
+        self._id = None
+        self._stop = None
+        self._heartbeat = None
+
+    def _try_acquire(self, blocking):
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            if self._reclaim():
+                return self._try_acquire(blocking)
+            return False
+        self._id = uuid.uuid4().hex
+        holder = {"host": socket.gethostname(), "pid": os.getpid(), "id": self._id}
+        with os.fdopen(fd, "w") as fp:
+            json.dump(holder, fp)
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(
+            target=self._beat, args=(self._stop,), daemon=True
+        )
+        self._heartbeat.start()
+        return True
+
+    def _beat(self, stop):
+        while not stop.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                logger.warning(f"Lock {self.path} was removed while held")
+                return
+
+    def _release(self):
+        self._stop.set()
+        self._heartbeat.join()
+        if self._holder().get("id") == self._id:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        self._id = self._stop = self._heartbeat = None
+
+    def _holder(self, path=None):
+        try:
+            return json.loads(Path(path or self.path).read_text())
+        except (OSError, ValueError):
+            # e.g. lock files of other backends
+            return {}
+
+    def is_stale(self):
+        try:
+            mtime = self.path.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        if time.time() - mtime > self.timeout:
+            return True
+        holder = self._holder()
+        return holder.get("host") == socket.gethostname() and not _pid_alive(
+            holder.get("pid")
+        )
+
+    def _reclaim(self):
+        """Removes the lock file if it is stale, returns True if it was removed"""
+        if not self.is_stale():
+            return False
+        holder = self._holder()
+        # only one of the waiting tasks gets the stale lock file
+        stale_path = self.path.with_name(f"{self.path.name}.{uuid.uuid4().hex}")
+        try:
+            os.rename(self.path, stale_path)
+        except FileNotFoundError:
+            return False
+        reclaimed = self._holder(stale_path).get("id") == holder.get("id")
+        if reclaimed:
+            logger.warning(f"Reclaimed stale lock {self.path} of {holder}")
+        else:
+            # the lock was acquired again in the meantime
+            try:
+                os.link(stale_path, self.path)
+            except FileExistsError:
+                pass
+        os.unlink(stale_path)
+        return reclaimed
+
+
+def _pid_alive(pid):
+    if not isinstance(pid, int):
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_filesystems = {}
+
+
+def filesystem_type(path):
+    """Returns type of the filesystem of the path (None if not known)"""
+    path = Path(path).resolve()
+    if path not in _filesystems:
+        fstype, mount_len = None, -1
+        try:
+            with open("/proc/mounts") as fp:
+                mounts = [line.split()[1:3] for line in fp]
+        except OSError:
+            mounts = []
+        for mount, mount_type in mounts:
+            mount = mount.replace("\\040", " ")
+            if (path == Path(mount) or Path(mount) in path.parents) and len(
+                mount
+            ) > mount_len:
+                fstype, mount_len = mount_type, len(mount)
+        _filesystems[path] = fstype
+    return _filesystems[path]
+
+
+def get_lock(path, backend=None):
+    """Returns the lock of the lock file (see ``LOCK_BACKEND``)"""
+    backend = backend or LOCK_BACKEND
+    if backend == "auto":
+        if fcntl is None or filesystem_type(Path(path).parent) in SHARED_FILESYSTEMS:
+            backend = "heartbeat"
+        else:
+            backend = "flock"
+    if backend == "flock":
+        if fcntl is None:
+            raise ValueError("flock locks are not available on this platform")
+        return FlockLock(path)
+    elif backend == "heartbeat":
+        return HeartbeatLock(path)
+    raise ValueError(f"unknown lock backend {backend!r}")
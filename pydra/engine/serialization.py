@@ -0,0 +1,573 @@
+"""Serialization of the saved results and tasks"""
+import bz2
+from contextlib import contextmanager
+import io
+import lzma
+import mmap
+import os
+from pathlib import Path
+import pickle
+import sys
+import threading
+import time
+import zlib
+
+import cloudpickle as cp
+
+# codec used to compress saved results and tasks (None disables the compression)
+COMPRESSION = "gzip"
+# pickles smaller than the threshold (in bytes) are saved without compression
+COMPRESSION_THRESHOLD = 2 ** 16
+# compression level (the default level of the codec is used if None)
+COMPRESSION_LEVEL = None
+
+_READ_CHUNK_LEN = 2 ** 16
+
+
+class _LZ4Compressor:
+    """LZ4 frame compressor with the interface of ``zlib.compressobj``"""
+
+    def __init__(self, level):
+        import lz4.frame
+
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        header, self._header = self._header, b""
+        return header + self._compressor.compress(data)
+
+    def flush(self):
+        return self._header + self._compressor.flush()
+
+
+def _zstd_compressor(level):
+    import zstandard
+
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def _zstd_decompressor():
+    import zstandard
+
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _lz4_decompressor():
+    import lz4.frame
+
+    return lz4.frame.LZ4FrameDecompressor()
+
+
+# name: (magic bytes, compressor(level), decompressor(), default level)
+CODECS = {
+    "gzip": (
+        b"\x1f\x8b",
+        lambda level: zlib.compressobj(level, zlib.DEFLATED, 31),
+        lambda: zlib.decompressobj(31),
+        6,
+    ),
+    "bz2": (b"BZh", bz2.BZ2Compressor, bz2.BZ2Decompressor, 9),
+    "xz": (
+        b"\xfd7zXZ\x00",
+        lambda level: lzma.LZMACompressor(preset=level),
+        lzma.LZMADecompressor,
+        6,
+    ),
+    "zstd": (b"\x28\xb5\x2f\xfd", _zstd_compressor, _zstd_decompressor, 3),
+    "lz4": (b"\x04\x22\x4d\x18", _LZ4Compressor, _lz4_decompressor, 0),
+}
+
+
+def check_compression(name):
+    """Checks if the compression codec is known and its package is installed"""
+    if name is None:
+        return
+    if name not in CODECS:
+        raise ValueError(f"unknown compression {name}")
+    try:
+        CODECS[name][2]()
+    except ImportError:
+        raise ValueError(f"compression {name} requires {name} package")
+
+
+def set_compression(name, threshold=None, level=None):
+    """
+    Sets codec (and optionally the threshold and level) used to compress
+    the saved results and tasks. Available codecs: gzip, bz2, xz,
+    zstd (requires zstandard package) and lz4 (requires lz4 package),
+    None disables the compression.
+    Files are read correctly regardless of the current settings.
+    """
+    global COMPRESSION, COMPRESSION_THRESHOLD, COMPRESSION_LEVEL
+    check_compression(name)
+    COMPRESSION = name
+    COMPRESSION_LEVEL = level
+    if threshold is not None:
+        COMPRESSION_THRESHOLD = threshold
+
+
+class _CompressedWriter(io.RawIOBase):
+    """
+    Writes data to ``fp``, the data is kept uncompressed until it exceeds
+    the threshold, then the stream is compressed. Without compression
+    (or with an infinite threshold) the data are written straight through.
+    """
+
+    def __init__(self, fp, compression, level, threshold):
+        self.fp = fp
+        self.compression = compression
+        self.level = level
+        self.threshold = threshold
+        self.nbytes = 0
+        self.stored_nbytes = 0
+        self._buffer = bytearray()
+        self._compressor = None
+        if compression is None or threshold == float("inf"):
+            self._buffer = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        nbytes = memoryview(data).nbytes
+        self.nbytes += nbytes
+        if self._buffer is None and self._compressor is None:
+            self._write(data)
+            return nbytes
+        if self._compressor is None:
+            self._buffer += data
+            if len(self._buffer) < self.threshold:
+                return nbytes
+            _, compressor, _, default_level = CODECS[self.compression]
+            self._compressor = compressor(
+                default_level if self.level is None else self.level
+            )
+            data, self._buffer = self._buffer, None
+        self._write(self._compressor.compress(data))
+        return nbytes
+
+    def _write(self, data):
+        self.stored_nbytes += memoryview(data).nbytes
+        self.fp.write(data)
+
+    def close(self):
+        if not self.closed:
+            if self._compressor is None:
+                if self._buffer is not None:
+                    self._write(self._buffer)
+            else:
+                self._write(self._compressor.flush())
+        super().close()
+
+
+class _DecompressedReader(io.RawIOBase):
+    """Reads decompressed data from ``fp``"""
+
+    def __init__(self, fp, decompressor):
+        self.fp = fp
+        self._decompressor = decompressor
+        self._data = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._data:
+            chunk = self.fp.read(_READ_CHUNK_LEN)
+            if not chunk:
+                return 0
+            self._data = self._decompressor.decompress(chunk)
+        nbytes = min(len(buffer), len(self._data))
+        buffer[:nbytes] = self._data[:nbytes]
+        self._data = self._data[nbytes:]
+        return nbytes
+
+
+class Serializer:
+    """
+    Saves objects of a registered type in side files next to the pickle
+    (see ``register_serializer``), the pickle keeps only the name of the file.
+    """
+
+    name = None
+    suffix = ""
+
+    def accepts(self, obj, threshold):
+        """Checks if the object should be saved in a side file"""
+        return True
+
+    def save(self, obj, path):
+        raise NotImplementedError
+
+    def load(self, path):
+        raise NotImplementedError
+
+
+class NumpySerializer(Serializer):
+    """
+    Arrays are saved as ``.npy`` files and loaded as read-only memory maps,
+    so they are not copied while loading the results
+    """
+
+    name = "npy"
+    suffix = ".npy"
+
+    def accepts(self, obj, threshold):
+        return obj.nbytes >= threshold and not obj.dtype.hasobject
+
+    def save(self, obj, path):
+        import numpy as np
+
+        with open(path, "wb") as fp:
+            np.save(fp, obj, allow_pickle=False)
+
+    def load(self, path):
+        import numpy as np
+
+        return np.load(path, mmap_mode="r")
+
+
+class BytesSerializer(Serializer):
+    """Bytes are saved as raw files"""
+
+    name = "bytes"
+    suffix = ".bin"
+
+    def accepts(self, obj, threshold):
+        return len(obj) >= threshold
+
+    def save(self, obj, path):
+        with open(path, "wb") as fp:
+            fp.write(obj)
+
+    def load(self, path):
+        with open(path, "rb") as fp:
+            return fp.read()
+
+
+# objects (and buffers) larger than the threshold (in bytes) are saved in side files
+SIDE_FILE_THRESHOLD = 2 ** 20
+# protocol 5 allows to save buffers out-of-band (in side files)
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+_BUFFER_ALIGNMENT = 64
+
+# name: serializer, type: serializer
+SERIALIZERS = {}
+_serializers = {}
+
+
+def register_serializer(cls, serializer):
+    """
+    Registers serializer used to save objects of the type (subclasses are
+    not included) in side files, see ``NumpySerializer`` for an example
+    """
+    SERIALIZERS[serializer.name] = serializer
+    _serializers[cls] = serializer
+
+
+def _register_default_serializers():
+    if bytes not in _serializers:
+        register_serializer(bytes, BytesSerializer())
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and numpy.ndarray not in _serializers:
+        register_serializer(numpy.ndarray, NumpySerializer())
+        register_serializer(numpy.memmap, SERIALIZERS["npy"])
+
+
+@contextmanager
+def replaced(path):
+    """
+    Yields a temporary path that atomically replaces ``path`` at the end,
+    so other processes never read partially written files,
+    and the files memory mapped by other processes are never modified
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+class _Pickler(cp.CloudPickler):
+    """Pickler saving large objects in side files named by ``side_path``"""
+
+    def __init__(self, file, side_path, threshold):
+        self.side_path = Path(side_path)
+        self.threshold = threshold
+        self.side_files = []
+        self.buffers = []
+        if PROTOCOL >= 5:
+            super().__init__(file, protocol=PROTOCOL, buffer_callback=self._buffer)
+        else:
+            super().__init__(file, protocol=PROTOCOL)
+
+    def persistent_id(self, obj):
+        serializer = _serializers.get(type(obj))
+        if serializer is None or not serializer.accepts(obj, self.threshold):
+            return None
+        name = f"{self.side_path.name}.{len(self.side_files)}{serializer.suffix}"
+        with replaced(self.side_path.parent / name) as path:
+            serializer.save(obj, path)
+        self.side_files.append(name)
+        return serializer.name, name
+
+    def _buffer(self, buffer):
+        """Large buffers are saved out-of-band (returns False)"""
+        if buffer.raw().nbytes < self.threshold:
+            return True
+        self.buffers.append(buffer)
+        return False
+
+    def save_buffers(self):
+        """Saves the out-of-band buffers in a single aligned file"""
+        path = self.side_path.parent / f"{self.side_path.name}.buffers"
+        if not self.buffers:
+            if path.exists():
+                path.unlink()
+            return 0
+        with replaced(path) as tmp_path, open(tmp_path, "wb") as fp:
+            for buffer in self.buffers:
+                data = buffer.raw()
+                fp.write(data.nbytes.to_bytes(8, "little"))
+                fp.write(bytes(-fp.tell() % _BUFFER_ALIGNMENT))
+                fp.write(data)
+            return fp.tell()
+
+
+class _Unpickler(pickle.Unpickler):
+    """Unpickler loading objects saved in side files"""
+
+    def __init__(self, file, side_path):
+        self.side_path = side_path
+        kwargs = {}
+        if side_path is not None and PROTOCOL >= 5:
+            kwargs["buffers"] = _load_buffers(
+                side_path.parent / f"{side_path.name}.buffers"
+            )
+        super().__init__(file, **kwargs)
+
+    def persistent_load(self, pid):
+        if self.side_path is None:
+            raise pickle.UnpicklingError("object saved in a side file")
+        name, filename = pid
+        return SERIALIZERS[name].load(self.side_path.parent / filename)
+
+
+def _load_buffers(path):
+    """Returns the out-of-band buffers from the memory mapped file"""
+    try:
+        with open(path, "rb") as fp:
+            data = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, ValueError):
+        return None
+    buffers, offset = [], 0
+    while offset < len(data):
+        nbytes = int.from_bytes(data[offset : offset + 8], "little")
+        offset += 8 + (-(offset + 8) % _BUFFER_ALIGNMENT)
+        buffers.append(data[offset : offset + nbytes])
+        offset += nbytes
+    return buffers
+
+
+def dump(obj, fp, compression=None, threshold=None, level=None, side_path=None):
+    """
+    Pickles the object to the binary file ``fp``.
+
+    The pickle is compressed with ``compression`` (``COMPRESSION`` by default)
+    if its size exceeds ``threshold`` (``COMPRESSION_THRESHOLD`` by default).
+    If ``side_path`` is set, large objects of registered types (see
+    ``register_serializer``) and large buffers are saved uncompressed
+    in files next to the pickle (named by ``side_path``).
+    Returns metadata of the saved pickle: compression, size of the pickle
+    (nbytes), size of the saved data (stored_nbytes), compression ratio,
+    side files and time of the serialization in seconds.
+    """
+    if compression is None:
+        compression = COMPRESSION
+    if threshold is None:
+        threshold = COMPRESSION_THRESHOLD
+    if level is None:
+        level = COMPRESSION_LEVEL
+    start = time.perf_counter()
+    writer = _CompressedWriter(fp, compression, level, threshold)
+    side_files = []
+    if side_path is None:
+        cp.dump(obj, writer, protocol=PROTOCOL)
+    else:
+        _register_default_serializers()
+        pickler = _Pickler(writer, side_path, SIDE_FILE_THRESHOLD)
+        pickler.dump(obj)
+        side_files = pickler.side_files
+        if pickler.save_buffers():
+            side_files.append(f"{pickler.side_path.name}.buffers")
+    writer.close()
+    return {
+        "compression": compression if writer._compressor is not None else None,
+        "nbytes": writer.nbytes,
+        "stored_nbytes": writer.stored_nbytes,
+        "ratio": writer.nbytes / writer.stored_nbytes if writer.stored_nbytes else 1.0,
+        "side_files": side_files,
+        "time": time.perf_counter() - start,
+    }
+
+
+def dumps(obj, **kwargs):
+    """Returns serialized object and metadata (see ``dump``)"""
+    fp = io.BytesIO()
+    metadata = dump(obj, fp, **kwargs)
+    return fp.getvalue(), metadata
+
+
+def load(fp, side_path=None):
+    """Loads object from the binary file, the compression is detected"""
+    if side_path is not None:
+        side_path = Path(side_path)
+    if not isinstance(fp, io.BufferedReader):
+        fp = io.BufferedReader(fp)
+    head = fp.peek(8)
+    for magic, _, decompressor, _ in CODECS.values():
+        if head.startswith(magic):
+            fp = io.BufferedReader(
+                _DecompressedReader(fp, decompressor()), _READ_CHUNK_LEN
+            )
+            break
+    return _Unpickler(fp, side_path).load()
+
+
+def loads(data, side_path=None):
+    return load(io.BytesIO(data), side_path=side_path)
+
+
+def load_file(path):
+    """Loads object saved with ``dump`` in the file (with ``side_path`` without suffix)"""
+    path = Path(path)
+    with open(path, "rb") as fp:
+        return load(fp, side_path=path.parent / path.stem)
+
+
+ENTRIES_MAGIC = b"PYDRAENT"
+_OFFSET_LEN = 8
+
+
+def dump_entries(header, entries, fp, side_path=None, **kwargs):
+    """
+    Saves every entry as a separate pickle, so entries can be loaded one by one
+    (see ``EntriesReader``).
+
+    The file starts with ``ENTRIES_MAGIC`` followed by the pickled entries,
+    the index (``header`` and offsets, sizes and types of the entries) is saved
+    at the end together with its offset. Side files of the entries are named
+    by ``side_path`` and the name of the entry. Returns metadata of the saved
+    entries (see ``dump``).
+    """
+    start = time.perf_counter()
+    fp.write(ENTRIES_MAGIC)
+    index = {}
+    metadata = {"compression": None, "nbytes": 0, "stored_nbytes": 0, "side_files": []}
+    for name, obj in entries.items():
+        offset = fp.tell()
+        entry_side_path = None if side_path is None else f"{side_path}.{name}"
+        entry = dump(obj, fp, side_path=entry_side_path, **kwargs)
+        index[name] = {
+            "offset": offset,
+            "stored_nbytes": entry["stored_nbytes"],
+            "nbytes": entry["nbytes"],
+            "type": f"{type(obj).__module__}.{type(obj).__qualname__}",
+        }
+        metadata["compression"] = metadata["compression"] or entry["compression"]
+        metadata["nbytes"] += entry["nbytes"]
+        metadata["stored_nbytes"] += entry["stored_nbytes"]
+        metadata["side_files"] += entry["side_files"]
+    offset = fp.tell()
+    cp.dump({"header": header, "entries": index}, fp)
+    fp.write(offset.to_bytes(_OFFSET_LEN, "little"))
+    metadata["ratio"] = (
+        metadata["nbytes"] / metadata["stored_nbytes"]
+        if metadata["stored_nbytes"]
+        else 1.0
+    )
+    metadata["time"] = time.perf_counter() - start
+    return metadata
+
+
+def is_entries(head):
+    """Checks if the data (beginning of the file) were saved by ``dump_entries``"""
+    return head[: len(ENTRIES_MAGIC)] == ENTRIES_MAGIC
+
+
+class EntriesReader:
+    """
+    Reads the index and the entries saved by ``dump_entries``
+    from a file (``path``) or from bytes (``data``), entries are
+    read only when they are loaded. The offsets in the index are valid only
+    for the file it was read from, so loading fails if the file was replaced
+    or removed since.
+
+    ``nbytes`` is the uncompressed size of the index and the entries loaded
+    so far, ``on_load`` (if set) is called with the uncompressed size
+    of every loaded entry.
+    """
+
+    def __init__(self, path=None, data=None, side_path=None):
+        self.path = path
+        self.data = data
+        self.side_path = side_path
+        self.on_load = None
+        if path is not None:
+            with open(path, "rb") as fp:
+                self._identity = _file_identity(fp)
+                fp.seek(-_OFFSET_LEN, os.SEEK_END)
+                end = fp.tell()
+                offset = int.from_bytes(fp.read(_OFFSET_LEN), "little")
+                fp.seek(offset)
+                index = cp.loads(fp.read(end - offset))
+            self.nbytes = end - offset
+        else:
+            offset = int.from_bytes(data[-_OFFSET_LEN:], "little")
+            index = cp.loads(data[offset:-_OFFSET_LEN])
+            self.nbytes = len(data) - _OFFSET_LEN - offset
+        self.header = index["header"]
+        self.entries = index["entries"]
+
+    def load(self, name):
+        """Loads the entry"""
+        entry = self.entries[name]
+        start, stop = entry["offset"], entry["offset"] + entry["stored_nbytes"]
+        if self.path is not None:
+            with self._open() as fp:
+                fp.seek(start)
+                data = fp.read(stop - start)
+        else:
+            data = self.data[start:stop]
+        side_path = None if self.side_path is None else f"{self.side_path}.{name}"
+        obj = loads(data, side_path=side_path)
+        self.nbytes += entry["nbytes"]
+        if self.on_load is not None:
+            self.on_load(entry["nbytes"])
+        return obj
+
+    def _open(self):
+        """Opens the file, checking it is the file the index was read from"""
+        try:
+            fp = open(self.path, "rb")
+        except FileNotFoundError:
+            raise FileNotFoundError(
+                f"{self.path} was removed after its index was read, "
+                "the entries can't be loaded"
+            ) from None
+        if _file_identity(fp) != self._identity:
+            fp.close()
+            raise RuntimeError(
+                f"{self.path} was replaced after its index was read, "
+                "the entries must be read again"
+            )
+        return fp
+
+
+def _file_identity(fp):
+    stat = os.fstat(fp.fileno())
+    return stat.st_dev, stat.st_ino, stat.st_size
@@ -1,7 +1,16 @@
 import dataclasses as dc
-from pathlib import Path
+import itertools
+import os
+from pathlib import Path, PurePath
+import time
 import typing as ty
 
+# signatures of the files of the input fields are checked at most once within
+# the interval (in seconds), the files are always checked when a task is run
+FILE_CHECK_INTERVAL = 1.0
+
+_spec_versions = itertools.count()
+
 
 class File(Path):
     pass
@@ -11,6 +20,191 @@ class Directory(Path):
     pass
 
 
+def is_file_field(field):
+    """Check if the field holds a file or a list of files"""
+    return field.type in (File, ty.List[File])
+
+
+def is_dir_field(field):
+    """Check if the field holds a directory or a list of directories"""
+    return field.type in (Directory, ty.List[Directory])
+
+
+def is_immutable(value):
+    """Check if the value (and all its elements) can't be modified in place"""
+    if isinstance(value, (str, bytes, int, float, complex, type(None), PurePath)):
+        return True
+    elif isinstance(value, (tuple, frozenset)):
+        return all(is_immutable(el) for el in value)
+    return False
+
+
+class _Tracker:
+    """
+    Version of a tracked container and its nested containers,
+    increased by every modification in place
+    """
+
+    __slots__ = ("version", "trackable")
+
+    def __init__(self):
+        self.version = 0
+        # False if the containers hold mutable values that can't be tracked
+        self.trackable = True
+
+
+def track(value, tracker=None):
+    """
+    Returns the value with lists and dicts (also the nested ones) replaced by
+    tracked containers (``TrackedList``, ``TrackedDict``), so the modifications
+    in place invalidate the memoized hashes (see ``BaseSpec.hash``).
+    Containers nested in a tracked container share its tracker.
+    """
+    if type(value) in (list, TrackedList, dict, TrackedDict):
+        if isinstance(value, (TrackedList, TrackedDict)) and (
+            tracker is None or value._tracker is tracker
+        ):
+            return value
+        tracker = tracker or _Tracker()
+        klass = TrackedList if isinstance(value, list) else TrackedDict
+        return _rebuild_tracked(klass, value, tracker)
+    if tracker is not None and not is_immutable(value):
+        tracker.trackable = False
+    return value
+
+
+def _rebuild_tracked(klass, items, tracker):
+    obj = klass.__new__(klass)
+    obj._tracker = tracker
+    if klass is TrackedList:
+        list.extend(obj, (track(el, tracker) for el in items))
+    else:
+        dict.update(obj, ((key, track(el, tracker)) for key, el in items.items()))
+    return obj
+
+
+class TrackedList(list):
+    """List of an input field recording its modifications (see ``track``)"""
+
+    def __init__(self, iterable=()):
+        super().__init__()
+        self._tracker = _Tracker()
+        list.extend(self, (track(el, self._tracker) for el in iterable))
+
+    def __reduce_ex__(self, protocol):
+        return _rebuild_tracked, (TrackedList, list(self), self._tracker)
+
+    def _modified(self):
+        self._tracker.version += 1
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [track(el, self._tracker) for el in value]
+        else:
+            value = track(value, self._tracker)
+        super().__setitem__(index, value)
+        self._modified()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._modified()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self._modified()
+        return self
+
+    def append(self, value):
+        super().append(track(value, self._tracker))
+        self._modified()
+
+    def extend(self, iterable):
+        super().extend([track(el, self._tracker) for el in iterable])
+        self._modified()
+
+    def insert(self, index, value):
+        super().insert(index, track(value, self._tracker))
+        self._modified()
+
+    def pop(self, index=-1):
+        value = super().pop(index)
+        self._modified()
+        return value
+
+    def remove(self, value):
+        super().remove(value)
+        self._modified()
+
+    def clear(self):
+        super().clear()
+        self._modified()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._modified()
+
+    def reverse(self):
+        super().reverse()
+        self._modified()
+
+
+class TrackedDict(dict):
+    """Dict of an input field recording its modifications (see ``track``)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._tracker = _Tracker()
+        dict.update(
+            self,
+            (
+                (key, track(el, self._tracker))
+                for key, el in dict(*args, **kwargs).items()
+            ),
+        )
+
+    def __reduce_ex__(self, protocol):
+        return _rebuild_tracked, (TrackedDict, dict(self), self._tracker)
+
+    def _modified(self):
+        self._tracker.version += 1
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, track(value, self._tracker))
+        self._modified()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._modified()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._modified()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._modified()
+        return item
+
+    def clear(self):
+        super().clear()
+        self._modified()
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        super().update((key, track(el, self._tracker)) for key, el in items.items())
+        self._modified()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+
 @dc.dataclass
 class SpecInfo:
     name: str
@@ -22,23 +216,147 @@ class SpecInfo:
 class BaseSpec:
     """The base dataclass specs for all inputs and outputs"""
 
+    def __setattr__(self, name, value):
+        if not name.startswith("_"):
+            # modifications of lists and dicts in place are recorded
+            value = track(value)
+        super().__setattr__(name, value)
+        if name in ("_hash_memo", "_version"):
+            return
+        self._modified()
+        # a new value invalidates the memoized hash of the field
+        memo = self.__dict__.get("_hash_memo")
+        if memo is not None:
+            memo.pop(name, None)
+            memo.pop(None, None)
+
+    def _modified(self):
+        # versions are unique across the specs, so a new spec never reuses a key
+        self.__dict__["_version"] = next(_spec_versions)
+
+    def version_key(self):
+        """
+        Key changing with every modification of the fields (see ``track``),
+        it is checked without hashing anything; None if a field holds a value
+        that can't be tracked or files (their content is checked by ``hash`` only)
+        """
+        trackers = []
+        for field in self._hashed_fields():
+            value = getattr(self, field.name)
+            signature = _value_signature(value)
+            if signature is None or _field_paths(field, value) is not None:
+                return None
+            trackers.append(signature[1] if signature else None)
+        return self.__dict__.get("_version"), tuple(trackers)
+
     @property
     def hash(self):
-        """Compute a basic hash for any given set of fields"""
-        from .helpers import hash_function, hash_file
-
-        inp_dict = {
-            field.name: hash_file(getattr(self, field.name))
-            if field.type == File
-            else getattr(self, field.name)
-            for field in dc.fields(self)
-            if field.name not in ["_graph_checksums"]
-        }
-        inp_hash = hash_function(inp_dict)
+        """Compute a basic hash for any given set of fields
+
+        Every field is hashed separately and the hash is calculated
+        from the field hashes (see ``hash_fields``).
+        The hashes of the fields are memoized until the fields are set again
+        or their lists and dicts are modified in place (see ``track``).
+        Hashes of the file fields are memoized together with the stat
+        signatures of the files, which are checked at most once within
+        ``FILE_CHECK_INTERVAL`` (see ``invalidate_hash``).
+        Values that can't be tracked (e.g. arrays) are hashed every time.
+        """
+        from . import helpers_file
+
+        memo = self.__dict__.setdefault("_hash_memo", {})
+        now = time.monotonic()
+        field_hashes = {}
+        for field in self._hashed_fields():
+            value = getattr(self, field.name)
+            key = _value_signature(value)
+            files = _field_paths(field, value)
+            if key is not None and files is not None:
+                key = (key, helpers_file.HASH_ALGORITHM)
+            cached = memo.get(field.name)
+            files_signature = None
+            if key is not None and cached is not None and cached[0] == key:
+                if files is None or now - cached[2] < FILE_CHECK_INTERVAL:
+                    field_hashes[field.name] = cached[1]
+                    continue
+                files_signature = _files_signature(field, files)
+                if files_signature == cached[3]:
+                    memo[field.name] = (key, cached[1], now, files_signature)
+                    field_hashes[field.name] = cached[1]
+                    continue
+            elif key is not None and files is not None and not is_dir_field(field):
+                files_signature = _files_signature(field, files)
+            if key is not None and files is not None and is_dir_field(field):
+                # the signatures are collected while hashing the directories
+                field_hashes[field.name], files_signature = _hash_dirs(value)
+            else:
+                field_hashes[field.name] = self.hash_value(field, value)
+            if key is not None:
+                memo[field.name] = (key, field_hashes[field.name], now, files_signature)
+        key = tuple(field_hashes.items())
+        if memo.get(None, (None,))[0] != key:
+            memo[None] = (key, self.hash_fields(field_hashes))
+        return memo[None][1]
+
+    def invalidate_hash(self, files_only=False):
+        """
+        Drops the memoized hashes of the fields, e.g. after modifying
+        a value that can't be tracked; if ``files_only`` is set, only the stat
+        signatures of the files are checked again on the next use
+        """
+        memo = self.__dict__.get("_hash_memo")
+        if not memo:
+            return
+        if not files_only:
+            memo.clear()
+            self._modified()
+            return
+        for name, cached in list(memo.items()):
+            if name is not None and cached[3] is not None:
+                memo[name] = (cached[0], cached[1], float("-inf"), cached[3])
+
+    def _hashed_fields(self):
+        return [f for f in dc.fields(self) if f.name not in ["_graph_checksums"]]
+
+    @staticmethod
+    def hash_value(field, value):
+        """Hash of a single value of the field
+
+        Content of the files is hashed for the ``File`` fields, lists of files
+        are hashed in parallel, and directories are hashed as Merkle trees.
+        The name of the file hash algorithm is included,
+        so checksums calculated with different algorithms never match.
+        """
+        from .helpers import hash_function
+        from . import helpers_file
+
+        if is_dir_field(field):
+            if isinstance(value, (str, os.PathLike, list, tuple)):
+                return _hash_dirs(value)[0]
+            return hash_function(value)
+        elif is_file_field(field):
+            if isinstance(value, (str, os.PathLike)):
+                file_hash = helpers_file.hash_file(value)
+            elif isinstance(value, (list, tuple)) and all(
+                isinstance(el, (str, os.PathLike)) for el in value
+            ):
+                file_hash = helpers_file.hash_files(value)
+            else:
+                return hash_function(value)
+            return hash_function((helpers_file.HASH_ALGORITHM, file_hash))
+        return hash_function(value)
+
+    def hash_fields(self, field_hashes):
+        """
+        Combine hashes of all fields (ordered as the spec fields)
+        and the graph checksums (if present) into a single hash
+        """
+        from .helpers import hash_function
+
+        inp_hash = hash_function(field_hashes)
         if hasattr(self, "_graph_checksums"):
-            return hash_function((inp_hash, self._graph_checksums))
-        else:
-            return inp_hash
+            inp_hash = hash_function((inp_hash, self._graph_checksums))
+        return inp_hash
 
     def retrieve_values(self, wf, state_index=None):
         temp_values = {}
@@ -51,6 +369,58 @@ class BaseSpec:
             setattr(self, field, value)
 
 
+def _value_signature(value):
+    """
+    Signature of the value the memoized hash is valid for: version of a tracked
+    container, () for immutable values (the memo is dropped when the field is set)
+    and None if the value can be modified in place unnoticed
+    """
+    if isinstance(value, (TrackedList, TrackedDict)):
+        tracker = value._tracker
+        return (tracker, tracker.version) if tracker.trackable else None
+    return () if is_immutable(value) else None
+
+
+def _field_paths(field, value):
+    """Returns the paths of a file or directory field (None for other values)"""
+    if not (is_file_field(field) or is_dir_field(field)):
+        return None
+    if isinstance(value, (str, os.PathLike)):
+        return [value]
+    elif isinstance(value, (list, tuple)) and all(
+        isinstance(el, (str, os.PathLike)) for el in value
+    ):
+        return list(value)
+    return None
+
+
+def _hash_dirs(value):
+    """
+    Hash of a directory or a list of directories
+    and the stat signatures of the directories (see ``helpers_file.dir_signature``)
+    """
+    from .helpers import hash_function
+    from . import helpers_file
+
+    if isinstance(value, (str, os.PathLike)):
+        dir_hash, signature = helpers_file.hash_dir(value, return_signature=True)
+        signatures = (signature,)
+    else:
+        hashed = [helpers_file.hash_dir(el, return_signature=True) for el in value]
+        dir_hash = [el_hash for el_hash, _ in hashed]
+        signatures = tuple(signature for _, signature in hashed)
+    return hash_function((helpers_file.HASH_ALGORITHM, dir_hash)), signatures
+
+
+def _files_signature(field, paths):
+    """Stat signatures of the files, Merkle signatures of the directories"""
+    from . import helpers_file
+
+    if is_dir_field(field):
+        return tuple(helpers_file.dir_signature(path) for path in paths)
+    return tuple(helpers_file.file_signature(path) for path in paths)
+
+
 @dc.dataclass
 class Runtime:
     rss_peak_gb: ty.Optional[float] = None
@@ -63,29 +433,62 @@ class Result:
     output: ty.Optional[ty.Any] = None
     runtime: ty.Optional[Runtime] = None
     errored: bool = False
+    # wall time (in seconds) of the task execution
+    duration: ty.Optional[float] = None
+    # time (in seconds) the task waited for the lock of its checksum
+    lock_wait: ty.Optional[float] = None
 
     def __getstate__(self):
         state = self.__dict__.copy()
         if state["output"] is not None:
             fields = tuple(state["output"].__annotations__.items())
             state["output_spec"] = (state["output"].__class__.__name__, fields)
-            state["output"] = dc.asdict(state["output"])
+            # fields are not copied (unlike with dc.asdict)
+            state["output"] = {
+                field.name: getattr(state["output"], field.name)
+                for field in dc.fields(state["output"])
+            }
         return state
 
     def __setstate__(self, state):
         if "output_spec" in state:
             spec = list(state["output_spec"])
             del state["output_spec"]
-            klass = dc.make_dataclass(spec[0], list(spec[1]))
-            state["output"] = klass(**state["output"])
+            if "output_entries" in state:
+                # fields are loaded on the first access (see stores.dump_result)
+                klass = dc.make_dataclass(
+                    spec[0],
+                    list(spec[1]),
+                    bases=(BaseSpec,),
+                    namespace={"__getattr__": _load_output_field},
+                )
+                state["output"] = object.__new__(klass)
+                state["output"].__dict__["_output_entries"] = state.pop(
+                    "output_entries"
+                )
+            else:
+                klass = dc.make_dataclass(spec[0], list(spec[1]), bases=(BaseSpec,))
+                state["output"] = klass(**state["output"])
         self.__dict__.update(state)
 
 
+def _load_output_field(output, name):
+    """Loads a field of the output saved as a separate entry"""
+    entries = output.__dict__.get("_output_entries")
+    if entries is None or name not in entries.entries:
+        raise AttributeError(name)
+    value = output.__dict__[name] = entries.load(name)
+    return value
+
+
 @dc.dataclass
 class RuntimeSpec:
     outdir: ty.Optional[str] = None
     container: ty.Optional[str] = "shell"
     network: bool = False
+    # resources used by the task (see ``TaskBase.set_requirements``)
+    cpus: int = 1
+    mem_gb: ty.Optional[float] = None
     """
     from CWL:
     InlineJavascriptRequirement
@@ -23,6 +23,16 @@ class State:
         self.inputs_ind = []
         self.final_groups_mapping = {}
 
+    @property
+    def inputs_ind(self):
+        return self._inputs_ind
+
+    @inputs_ind.setter
+    def inputs_ind(self, inputs_ind):
+        self._inputs_ind = inputs_ind
+        # checksums of the states (set by the task) have to be recalculated
+        self.checksums_cache = None
+
     def __str__(self):
         return f"State for {self.name} with a splitter: {self.splitter} and combiner: {self.combiner}"
 
@@ -0,0 +1,525 @@
+"""Stores for results, tasks and errors saved in the cache locations"""
+import abc
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
+import io
+import os
+from pathlib import Path
+import shutil
+import threading
+import time
+
+from .cache import result_cache, cache_index
+from .helpers_file import file_signature, sqlite_connection
+from .serialization import dump, dumps, dump_entries, is_entries, load, loads
+from .serialization import EntriesReader, replaced
+from .specs import Result
+
+# store used for the locations without a configured store (see ``set_result_store``)
+RESULT_STORE = "directory"
+
+# minimal time (in seconds) between updates of the access time of an entry
+ACCESS_TIME_INTERVAL = 60.0
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+CacheEntry = namedtuple("CacheEntry", ["checksum", "nbytes", "accessed", "pinned"])
+
+
+class ResultStore(abc.ABC):
+    """
+    Base class for the stores of task results within a cache location.
+
+    Every entry is identified by the checksum of the task (or of a state
+    of the task) and can contain the result, the pickled task and the error.
+    """
+
+    def __init__(self, location):
+        self.location = Path(location)
+        self._accessed = {}
+
+    @abc.abstractmethod
+    def contains(self, checksum):
+        """Checks if the store has an entry for the checksum"""
+
+    @abc.abstractmethod
+    def load_result(self, checksum):
+        """Returns the result of the entry or None if the result is not saved"""
+
+    @abc.abstractmethod
+    def save(self, checksum, result=None, task=None, threshold=None):
+        """
+        Saves result and/or task
+
+        Returns metadata of the saved objects (see ``serialization.dump``),
+        ``threshold`` overrides the default compression threshold.
+        """
+
+    @abc.abstractmethod
+    def record_error(self, checksum, error):
+        """Saves the exception raised by the task"""
+
+    def has_results(self, checksums):
+        """
+        Returns the checksums with saved results, results of the runs that
+        raised an error are not included (the tasks are run again)
+        """
+        return {
+            checksum
+            for checksum in checksums
+            if self.contains(checksum) and self._has_result(checksum)
+        }
+
+    @abc.abstractmethod
+    def _has_result(self, checksum):
+        pass
+
+    @contextmanager
+    def batch(self):
+        """Context in which the store can postpone writes of saved entries"""
+        yield self
+
+    def finalize_dir(self, odir):
+        """Called after a task finished running in the output directory ``odir``"""
+
+    def touch(self, checksum):
+        """Records access to the entry (used by the cache garbage collection)"""
+        now = time.monotonic()
+        last = self._accessed.get(checksum)
+        if last is None or now - last >= ACCESS_TIME_INTERVAL:
+            self._accessed[checksum] = now
+            self._touch(checksum)
+
+    @abc.abstractmethod
+    def _touch(self, checksum):
+        pass
+
+    @abc.abstractmethod
+    def entries(self):
+        """Returns list of ``CacheEntry`` of all entries in the store"""
+
+    @abc.abstractmethod
+    def remove(self, checksum):
+        """Removes the entry"""
+
+    @abc.abstractmethod
+    def pin(self, checksum, pinned=True):
+        """Pins (or unpins) the entry, pinned entries are never garbage collected"""
+
+
+class DirectoryStore(ResultStore):
+    """
+    Default store: every entry is a directory named by the checksum
+    with ``_result.pklz``, ``_task.pklz`` and ``_error.pklz`` files.
+    Large arrays, bytes and buffers are saved in side files next to
+    the pickles (see ``serialization.dump``).
+    """
+
+    def contains(self, checksum):
+        # indexed locations (see ``cache.cache_index``) are not checked directly
+        if cache_index.is_indexed(self.location):
+            return cache_index.contains(self.location, checksum)
+        return (self.location / checksum).exists()
+
+    def load_result(self, checksum):
+        """
+        Results are kept in the process result cache (``cache.result_cache``),
+        so a result file is deserialized only once per process.
+        """
+        result_file = self.location / checksum / "_result.pklz"
+        signature = file_signature(result_file)
+        if signature is None and not (self.location / checksum).exists():
+            # entry removed after the location was indexed
+            cache_index.discard(self.location, checksum)
+            return None
+        if signature is None or signature[0] == 0:
+            return None
+        key = (checksum, str(result_file))
+        result = result_cache.get(key, signature)
+        if result is None:
+            side_path = result_file.with_suffix("")
+            with result_file.open("rb") as fp:
+                if is_entries(fp.peek(8)):
+                    reader = EntriesReader(path=result_file, side_path=side_path)
+                    result = _cached_result(key, signature, reader)
+                else:
+                    result = load(fp, side_path=side_path)
+                    result_cache.put(key, signature, result, nbytes=signature[0])
+        self.touch(checksum)
+        return result
+
+    def save(self, checksum, result=None, task=None, threshold=None):
+        task_path = self.location / checksum
+        task_path.mkdir(parents=True, exist_ok=True)
+        metadata = {}
+        # files are published by a rename, so results can be read without locking
+        if task:
+            with replaced(task_path / "_task.pklz") as path, path.open("wb") as fp:
+                metadata["task"] = dump(
+                    task, fp, threshold=threshold, side_path=task_path / "_task"
+                )
+        if result:
+            with replaced(task_path / "_result.pklz") as path, path.open("wb") as fp:
+                metadata["result"] = dump_result(
+                    result, fp, threshold=threshold, side_path=task_path / "_result"
+                )
+            if not result.errored:
+                # error of a previous run (the output directory was resumed)
+                try:
+                    (task_path / "_error.pklz").unlink()
+                except FileNotFoundError:
+                    pass
+            cache_index.add(self.location, checksum)
+        return metadata
+
+    def record_error(self, checksum, error):
+        error_file = self.location / checksum / "_error.pklz"
+        with replaced(error_file) as path, path.open("wb") as fp:
+            dump(error, fp)
+
+    def _has_result(self, checksum):
+        signature = file_signature(self.location / checksum / "_result.pklz")
+        if signature is None or signature[0] == 0:
+            return False
+        return not (self.location / checksum / "_error.pklz").exists()
+
+    def _touch(self, checksum):
+        try:
+            os.utime(self.location / checksum)
+        except OSError:
+            pass
+
+    def _entry_paths(self):
+        """
+        Yields checksums and directories of the entries, including
+        the directories with scripts of the distributed workers
+        """
+        try:
+            with os.scandir(self.location) as it:
+                dirs = [entry for entry in it if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            return
+        for entry in dirs:
+            if entry.name.endswith("_scripts"):
+                with os.scandir(entry.path) as it:
+                    for script_entry in it:
+                        if script_entry.is_dir(follow_symlinks=False):
+                            yield script_entry.name, Path(script_entry.path)
+            else:
+                yield entry.name, Path(entry.path)
+
+    def entries(self):
+        entries = {}
+        for checksum, path in self._entry_paths():
+            try:
+                accessed = path.stat().st_mtime
+                nbytes = _dir_nbytes(path)
+            except OSError:
+                # removed in the meantime
+                continue
+            pinned = (path / "_pinned").exists()
+            if checksum in entries:
+                entry = entries[checksum]
+                nbytes += entry.nbytes
+                accessed = max(accessed, entry.accessed)
+                pinned = pinned or entry.pinned
+            entries[checksum] = CacheEntry(checksum, nbytes, accessed, pinned)
+        return list(entries.values())
+
+    def remove(self, checksum):
+        """Removes the entry together with the directories of worker scripts"""
+        for path in [self.location / checksum] + list(
+            self.location.glob(f"*_scripts/{checksum}")
+        ):
+            shutil.rmtree(path, ignore_errors=True)
+        cache_index.discard(self.location, checksum)
+        self._accessed.pop(checksum, None)
+
+    def pin(self, checksum, pinned=True):
+        pin_file = self.location / checksum / "_pinned"
+        if pinned:
+            if pin_file.parent.exists():
+                pin_file.touch()
+        elif pin_file.exists():
+            pin_file.unlink()
+
+
+class SQLiteStore(ResultStore):
+    """
+    Store keeping all entries of the location in a single SQLite database.
+
+    Splitting a task over many values doesn't create any files,
+    output directories of the tasks are removed if the tasks didn't
+    write anything there. The database uses the write-ahead log
+    (except on shared filesystems, see ``helpers_file.sqlite_connection``),
+    so readers are not blocked by the processes writing results,
+    and saves within ``batch`` are written in a single transaction.
+    """
+
+    filename = "_pydra_results.sqlite"
+    _schema = (
+        "CREATE TABLE IF NOT EXISTS entries ("
+        "checksum TEXT PRIMARY KEY, result BLOB, task BLOB, error BLOB, "
+        "version INTEGER NOT NULL, accessed REAL, pinned INTEGER DEFAULT 0)"
+    )
+
+    def __init__(self, location, timeout=60.0):
+        super().__init__(location)
+        self.timeout = timeout
+        self.db_path = self.location / self.filename
+        self.location.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(self._schema)
+
+    def __getstate__(self):
+        return {"location": self.location, "timeout": self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _connection(self):
+        return sqlite_connection(self._local, self.db_path, self.timeout)
+
+    @contextmanager
+    def batch(self):
+        """
+        Writes within the context are kept in memory and written
+        in a single transaction at the end (the database is not locked
+        while the tasks run), they are not visible before the end
+        """
+        self._local.batch = getattr(self._local, "batch", 0) + 1
+        if self._local.batch == 1:
+            self._local.pending = []
+        try:
+            yield self
+        finally:
+            self._local.batch -= 1
+            if not self._local.batch:
+                pending, self._local.pending = self._local.pending, []
+                if pending:
+                    with self._connection() as conn:
+                        for statement, params in pending:
+                            conn.execute(statement, params)
+
+    def _write(self, statement, params):
+        if getattr(self._local, "batch", 0):
+            self._local.pending.append((statement, params))
+            return
+        conn = self._connection()
+        conn.execute(statement, params)
+        conn.commit()
+
+    def contains(self, checksum):
+        row = (
+            self._connection()
+            .execute("SELECT 1 FROM entries WHERE checksum=?", (checksum,))
+            .fetchone()
+        )
+        return row is not None
+
+    def load_result(self, checksum):
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT version, length(result) FROM entries WHERE checksum=?", (checksum,),
+        ).fetchone()
+        if row is None or not row[1]:
+            return None
+        key = (checksum, str(self.db_path))
+        result = result_cache.get(key, row[0])
+        if result is None:
+            (data,) = conn.execute(
+                "SELECT result FROM entries WHERE checksum=?", (checksum,)
+            ).fetchone()
+            if is_entries(data):
+                result = _cached_result(key, row[0], EntriesReader(data=data))
+            else:
+                result = loads(data)
+                result_cache.put(key, row[0], result, nbytes=row[1])
+        self.touch(checksum)
+        return result
+
+    def _upsert(self, checksum, column, data):
+        self._write(
+            f"INSERT INTO entries (checksum, {column}, version, accessed) "
+            "VALUES (?, ?, ?, ?) "
+            f"ON CONFLICT(checksum) DO UPDATE SET {column}=excluded.{column}, "
+            "version=excluded.version, accessed=excluded.accessed",
+            (checksum, data, time.time_ns(), time.time()),
+        )
+
+    def save(self, checksum, result=None, task=None, threshold=None):
+        metadata = {}
+        if result:
+            fp = io.BytesIO()
+            metadata["result"] = dump_result(result, fp, threshold=threshold)
+            self._upsert(checksum, "result", fp.getvalue())
+            if not result.errored:
+                self._write(
+                    "UPDATE entries SET error=NULL WHERE checksum=?", (checksum,)
+                )
+        if task:
+            data, metadata["task"] = dumps(task, threshold=threshold)
+            self._upsert(checksum, "task", data)
+        return metadata
+
+    def record_error(self, checksum, error):
+        self._upsert(checksum, "error", dumps(error)[0])
+
+    def load_task(self, checksum):
+        row = (
+            self._connection()
+            .execute("SELECT task FROM entries WHERE checksum=?", (checksum,))
+            .fetchone()
+        )
+        return loads(row[0]) if row and row[0] else None
+
+    def load_error(self, checksum):
+        row = (
+            self._connection()
+            .execute("SELECT error FROM entries WHERE checksum=?", (checksum,))
+            .fetchone()
+        )
+        return loads(row[0]) if row and row[0] else None
+
+    def finalize_dir(self, odir):
+        try:
+            odir.rmdir()
+        except OSError:
+            # the task wrote files in the directory
+            pass
+
+    def has_results(self, checksums):
+        checksums = list(checksums)
+        conn = self._connection()
+        available = set()
+        # number of the query parameters is limited
+        for i in range(0, len(checksums), 500):
+            chunk = checksums[i : i + 500]
+            rows = conn.execute(
+                "SELECT checksum FROM entries "
+                "WHERE result IS NOT NULL AND error IS NULL "
+                f"AND checksum IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            available.update(checksum for (checksum,) in rows)
+        return available
+
+    def _has_result(self, checksum):
+        return bool(self.has_results([checksum]))
+
+    def _touch(self, checksum):
+        self._write(
+            "UPDATE entries SET accessed=? WHERE checksum=?", (time.time(), checksum)
+        )
+
+    def entries(self):
+        rows = self._connection().execute(
+            "SELECT checksum, ifnull(length(result), 0) + ifnull(length(task), 0) "
+            "+ ifnull(length(error), 0), ifnull(accessed, 0), pinned FROM entries"
+        )
+        return [
+            CacheEntry(checksum, nbytes, accessed, bool(pinned))
+            for checksum, nbytes, accessed, pinned in rows
+        ]
+
+    def remove(self, checksum):
+        self._write("DELETE FROM entries WHERE checksum=?", (checksum,))
+        self._accessed.pop(checksum, None)
+
+    def pin(self, checksum, pinned=True):
+        self._write(
+            "UPDATE entries SET pinned=? WHERE checksum=?", (int(pinned), checksum)
+        )
+
+
+def dump_result(result, fp, **kwargs):
+    """
+    Saves the result with every output field as a separate entry
+    (see ``serialization.dump_entries``), so fields can be loaded one by one
+    """
+    state = result.__getstate__()
+    fields = state.pop("output") or {}
+    return dump_entries(state, fields, fp, **kwargs)
+
+
+def result_from_entries(reader):
+    """
+    Returns result saved by ``dump_result``, output fields are loaded
+    from the reader on the first access
+    """
+    state = dict(reader.header)
+    if "output_spec" in state:
+        state["output_entries"] = reader
+    else:
+        state["output"] = None
+    result = Result.__new__(Result)
+    result.__setstate__(state)
+    return result
+
+
+def _cached_result(key, identity, reader):
+    """
+    Returns result saved by ``dump_result`` and adds it to the result cache,
+    the uncompressed size of the output fields is counted as they are loaded
+    """
+    result = result_from_entries(reader)
+    result_cache.put(key, identity, result, nbytes=reader.nbytes)
+    reader.on_load = partial(result_cache.grow, key, identity)
+    return result
+
+
+def _dir_nbytes(path):
+    """Returns the total size of the files in the directory"""
+    nbytes = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                nbytes += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return nbytes
+
+
+RESULT_STORES = {"directory": DirectoryStore, "sqlite": SQLiteStore}
+
+
+def set_result_store(location, store=None):
+    """
+    Sets the store used for a cache location.
+
+    Parameters
+    ----------
+    location : str or Path
+        Cache location
+    store : str or ResultStore
+        Name of the store (see ``RESULT_STORES``) or a store instance,
+        if None ``RESULT_STORE`` is used
+    """
+    location = Path(location)
+    if not isinstance(store, ResultStore):
+        store = RESULT_STORES[store or RESULT_STORE](location)
+    with _stores_lock:
+        _stores[location] = store
+    return store
+
+
+def get_result_store(location):
+    """
+    Returns the store of the cache location.
+
+    Locations containing the SQLite database use ``SQLiteStore``
+    (so all processes detect the store), the others use the ``RESULT_STORE``.
+    """
+    location = Path(location)
+    store = _stores.get(location)
+    if store is None:
+        if (location / SQLiteStore.filename).exists():
+            store = SQLiteStore(location)
+        else:
+            store = RESULT_STORES[RESULT_STORE](location)
+        with _stores_lock:
+            store = _stores.setdefault(location, store)
+    return store
@@ -1,20 +1,51 @@
 import asyncio
+from collections import deque
+from copy import deepcopy
+import dataclasses as dc
+from functools import partial
+import heapq
+import inspect
+import itertools
 
 from .workers import SerialWorker, ConcurrentFuturesWorker, SlurmWorker
-from .core import is_workflow
+from .core import TaskChunk, is_workflow
 from .helpers import get_open_loop
+from .cache import CompletionRegistry
+from .specs import LazyField
 
 import logging
 
 logger = logging.getLogger("pydra.submitter")
 
+# default maximal number of state elements submitted at a time
+MAX_INFLIGHT = 1000
+# target duration (in seconds) of the chunks of state elements of the tasks
+# with the automatic chunk size (see ``TaskBase.chunk_size``)
+CHUNK_DURATION = 1.0
+
 
 class Submitter:
     # TODO: runnable in init or run
-    def __init__(self, plugin="cf", **kwargs):
+    def __init__(
+        self,
+        plugin="cf",
+        incremental=True,
+        priority=False,
+        max_inflight=MAX_INFLIGHT,
+        **kwargs,
+    ):
         self.loop = get_open_loop()
         self._own_loop = not self.loop.is_running()
         self.plugin = plugin
+        # only state elements without cached results are submitted
+        self.incremental = incremental
+        # ready nodes are dispatched in the order of their critical paths
+        self.priority = priority
+        # the jobs of the state elements are created and submitted in windows
+        # (None for no limit), so the memory doesn't grow with the number of states
+        self.max_inflight = max_inflight
+        # checksums of the results saved by the submitted tasks
+        self.completed = CompletionRegistry()
         if self.plugin == "serial":
             self.worker = SerialWorker()
         elif self.plugin == "cf":
@@ -28,19 +59,22 @@ class Submitter:
     def __call__(self, runnable, cache_locations=None):
         if cache_locations is not None:
             runnable.cache_locations = cache_locations
-        # creating all connections and calculating the checksum of the graph before running
-        if is_workflow(runnable):
-            for nd in runnable.graph.nodes:
-                runnable.create_connections(nd)
-                if nd.allow_cache_override:
-                    nd.cache_dir = runnable.cache_dir
-            runnable.inputs._graph_checksums = [
-                nd.checksum for nd in runnable.graph_sorted
-            ]
-        if is_workflow(runnable) and runnable.state is None:
-            self.loop.run_until_complete(self.submit_workflow(runnable))
-        else:
-            self.loop.run_until_complete(self.submit(runnable, wait=True))
+        runnable._completed = self.completed
+        try:
+            # creating all connections and calculating the checksum of the graph before running
+            if is_workflow(runnable):
+                for nd in runnable.graph.nodes:
+                    runnable.create_connections(nd)
+                    if nd.allow_cache_override:
+                        nd.cache_dir = runnable.cache_dir
+                runnable.inputs._graph_checksums = runnable.graph_checksums()
+            if is_workflow(runnable) and runnable.state is None:
+                self.loop.run_until_complete(self.submit_workflow(runnable))
+            else:
+                self.loop.run_until_complete(self.submit(runnable, wait=True))
+        finally:
+            # the registry is valid only during the run (results can be removed later)
+            _detach_completed(runnable)
         if is_workflow(runnable):
             # resetting all connections with LazyFields
             runnable._reset()
@@ -50,9 +84,9 @@ class Submitter:
         """Distributes or initiates workflow execution"""
         if workflow.plugin and workflow.plugin != self.plugin:
             # dj: this is not tested!!!
-            await self.worker.run_el(workflow)
+            return await self.worker.run_el(workflow)
         else:
-            await workflow._run(self)
+            return await workflow._run(self)
 
     async def submit(self, runnable, wait=False):
         """
@@ -78,28 +112,14 @@ class Submitter:
         """
         futures = set()
         if runnable.state:
-            runnable.state.prepare_states(runnable.inputs)
-            runnable.state.prepare_inputs()
-            logger.debug(
-                f"Expanding {runnable} into {len(runnable.state.states_val)} states"
-            )
-            for sidx in range(len(runnable.state.states_val)):
-                job = runnable.to_job(sidx)
-                logger.debug(
-                    f'Submitting runnable {job}{str(sidx) if sidx is not None else ""}'
-                )
-                if is_workflow(runnable):
-                    # job has no state anymore
-                    futures.add(self.submit_workflow(job))
-                else:
-                    # tasks are submitted to worker for execution
-                    futures.add(self.worker.run_el(job))
+            futures.add(self._run_states(runnable))
         else:
             if is_workflow(runnable):
                 await self._run_workflow(runnable)
             else:
                 # submit task to worker
-                futures.add(self.worker.run_el(runnable))
+                future = self.worker.run_el(runnable)
+                futures.add(self._track(future, runnable, [runnable.checksum]))
 
         if wait and futures:
             # run coroutines concurrently and wait for execution
@@ -126,27 +146,254 @@ class Submitter:
         # creating a copy of the graph that will be modified
         # the copy contains new lists with original runnable objects
         graph_copy = wf.graph.copy()
-        # keep track of pending futures
-        task_futures = set()
-        while not wf.done_all_tasks or len(task_futures):
-            tasks = get_runnable_tasks(graph_copy)
-            if not tasks and not task_futures:
-                raise Exception("Nothing queued or todo - something went wrong")
-            for task in tasks:
+        for task in graph_copy.nodes:
+            task._completed = self.completed
+        # nodes with cached results are not dispatched
+        self._remove_cached(wf, graph_copy)
+        scheduler = Scheduler(graph_copy, submitter=self, wf=wf, priority=self.priority)
+        while not scheduler.finished:
+            for task in scheduler.pop_ready():
                 # grab inputs if needed
                 logger.debug(f"Retrieving inputs for {task}")
-                # TODO: add state idx to retrieve values to reduce waiting
+                # (setting the inputs invalidates the memoized checksum)
                 task.inputs.retrieve_values(wf)
-                # checksum has to be updated, so resetting
-                task._checksum = None
                 if is_workflow(task) and not task.state:
-                    await self.submit_workflow(task)
+                    futures = {
+                        self._track(self.submit_workflow(task), task, [task.checksum])
+                    }
+                    scheduler.dispatched(task, futures)
+                elif task.state:
+                    # successors can follow the elements of the task
+                    jobs = self._state_jobs(task)
+                    scheduler.dispatched_states(task, jobs, len(task.state.states_val))
                 else:
-                    for fut in await self.submit(task):
-                        task_futures.add(fut)
-            task_futures = await self.worker.fetch_finished(task_futures)
+                    scheduler.dispatched(task, await self.submit(task))
+            if not scheduler.finished:
+                await scheduler.wait()
         return wf
 
+    def _state_jobs(self, runnable):
+        """
+        Returns a generator submitting the state elements of the runnable
+        (see ``_new_states``), the generator yields the state indices with
+        futures of the submitted elements (None for the elements not submitted).
+        The jobs are created only when the elements are requested.
+        """
+        runnable.state.prepare_states(runnable.inputs)
+        runnable.state.prepare_inputs()
+        nstates = len(runnable.state.states_val)
+        state_indices = set(self._new_states(runnable))
+        logger.debug(
+            f"Expanding {runnable} into {len(state_indices)} of {nstates} states"
+        )
+
+        def jobs():
+            chunk, probe = [], None
+            for sidx in range(nstates):
+                if sidx not in state_indices:
+                    yield sidx, None
+                    continue
+                chunk.append(sidx)
+                chunk_size = self._chunk_size(runnable)
+                if chunk_size is None:
+                    # the first element is run alone to measure the duration,
+                    # None is yielded until it finishes
+                    if probe is None:
+                        probe = yield from self._submit_chunk(runnable, chunk)
+                        chunk = []
+                        continue
+                    while inspect.isawaitable(probe) and not probe.done():
+                        yield None
+                    chunk_size = self._chunk_size(runnable) or 1
+                if len(chunk) >= chunk_size:
+                    yield from self._submit_chunk(runnable, chunk)
+                    chunk = []
+            if chunk:
+                yield from self._submit_chunk(runnable, chunk)
+
+        return jobs()
+
+    def _submit_chunk(self, runnable, state_indices):
+        """
+        Submits the state elements as a single job (see ``TaskChunk``),
+        yields the state indices with the (shared) future, returns the future
+        """
+        checksums = [runnable.checksum_states(sidx) for sidx in state_indices]
+        jobs = [
+            runnable.to_job(sidx, checksum=checksum)
+            for sidx, checksum in zip(state_indices, checksums)
+        ]
+        job = jobs[0] if len(jobs) == 1 else TaskChunk(jobs)
+        logger.debug(f"Submitting runnable {job}{state_indices}")
+        future = self._submit_job(job, checksums)
+        if inspect.isawaitable(future):
+            # the future is awaited once for all elements
+            future = asyncio.ensure_future(future)
+        for sidx in state_indices:
+            yield sidx, future
+        return future
+
+    def _chunk_size(self, runnable):
+        """
+        Returns number of the state elements run in one job, the automatic size
+        is set from the mean duration of the executed elements (see
+        ``DurationHistory``), so the chunks run for about ``CHUNK_DURATION``
+        (None if no duration is known yet)
+        """
+        chunk_size = runnable.chunk_size
+        if chunk_size == "auto":
+            duration = duration_history.get(runnable)
+            if duration is None:
+                return None
+            chunk_size = int(CHUNK_DURATION / max(duration, 1e-6))
+        chunk_size = max(chunk_size or 1, 1)
+        if self.max_inflight:
+            chunk_size = min(chunk_size, self.max_inflight)
+        return chunk_size
+
+    async def _run_states(self, runnable):
+        """
+        Runs the state elements of the runnable, at most ``max_inflight``
+        elements are submitted at a time, the results are not kept
+        """
+        pending = set()
+        for item in self._state_jobs(runnable):
+            if item is None:
+                # waiting for the first element (see ``_chunk_size``)
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    future.result()
+                continue
+            future = item[1]
+            if future is None or not inspect.isawaitable(future):
+                continue
+            # elements of a chunk share the future
+            pending.add(asyncio.ensure_future(future))
+            if self.max_inflight and len(pending) >= self.max_inflight:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    # raising errors of the failed elements
+                    future.result()
+        if pending:
+            await asyncio.gather(*pending)
+
+    def _submit_job(self, job, checksums):
+        if is_workflow(job):
+            # job has no state anymore
+            future = self.submit_workflow(job)
+        else:
+            # tasks (and chunks of tasks) are submitted to worker for execution
+            future = self.worker.run_el(job)
+        return self._track(future, job, checksums)
+
+    def _submit_element(self, wf, task, sidx):
+        """
+        Submits a state element of a task connected to a single split node,
+        the inputs are taken from the same element of the node, so the element
+        can run before the other elements of the node finish.
+        Returns the future, or None if the result of the element is cached.
+        """
+        job = deepcopy(task)
+        job.state = None
+        values = {}
+        for field in dc.fields(task.inputs):
+            value = getattr(task.inputs, field.name)
+            if isinstance(value, LazyField):
+                state_index = sidx if value.attr_type == "output" else None
+                values[field.name] = value.get_value(wf, state_index=state_index)
+        job.inputs = dc.replace(job.inputs, **values)
+        checksum = job.checksum
+        if self.incremental and self.completed.done([checksum], job.cache_locations):
+            return None
+        logger.debug(f"Submitting runnable {job}{sidx} (element of {task})")
+        return self._submit_job(job, [checksum])
+
+    def _prepare_state(self, wf, task):
+        """Sets the state of a task whose elements were submitted one by one"""
+        task.inputs.retrieve_values(wf)
+        task.state.prepare_states(task.inputs)
+        task.state.prepare_inputs()
+
+    def _track(self, future, job, checksums):
+        """
+        Records the checksums in the completion registry and the duration
+        of the job when the future resolves
+        """
+        if not inspect.isawaitable(future):
+            # executed by the serial worker
+            self.completed.add(job.cache_dir, checksums)
+            duration_history.add(job, future.result())
+            return future
+        return self._record_completion(future, job, checksums)
+
+    async def _record_completion(self, future, job, checksums):
+        result = await future
+        self.completed.add(job.cache_dir, checksums)
+        duration_history.add(job, result)
+        return result
+
+    def _new_states(self, runnable):
+        """
+        Returns indices of the state elements that have to be run,
+        in the incremental mode the elements with cached results are skipped
+        (e.g. only new elements are run after extending the splitter inputs),
+        and the combined outputs are collected from all elements.
+        """
+        nstates = len(runnable.state.states_val)
+        if not self.incremental:
+            return list(range(nstates))
+        checksums = runnable.checksum_states()
+        available = self.completed.available(checksums, runnable.cache_locations)
+        return [
+            sidx for sidx, checksum in enumerate(checksums) if checksum not in available
+        ]
+
+    def _remove_cached(self, wf, graph):
+        """
+        Planning pass over the workflow graph: inputs and checksums of the nodes
+        are resolved in topological order (as long as all predecessors are cached)
+        and the cache locations are checked in bulk for every generation of nodes.
+        Nodes with all results cached are removed from the graph, so they are never
+        dispatched to the workers.
+        """
+        cached = set()
+        for generation in graph_generations(graph):
+            checksums = {}
+            for task in generation:
+                if not all(
+                    pred.name in cached for pred in graph.predecessors[task.name]
+                ):
+                    continue
+                task.inputs.retrieve_values(wf)
+                if task.state:
+                    task.state.prepare_states(task.inputs)
+                    task.state.prepare_inputs()
+                    checksums[task] = task.checksum_states()
+                else:
+                    checksums[task] = [task.checksum]
+            if not checksums:
+                break
+            # checksums are checked together for tasks sharing cache locations
+            locations = {}
+            for task, task_checksums in checksums.items():
+                locations.setdefault(tuple(task.cache_locations), []).extend(
+                    task_checksums
+                )
+            available = set()
+            for cache_locations, loc_checksums in locations.items():
+                available |= self.completed.available(loc_checksums, cache_locations)
+            for task, task_checksums in checksums.items():
+                if all(checksum in available for checksum in task_checksums):
+                    cached.add(task.name)
+                    graph.remove_nodes(task)
+                    graph.remove_nodes_connections(task)
+        if cached:
+            logger.debug(f"Results of {len(cached)} tasks of {wf} are cached")
+
     def __enter__(self):
         return self
 
@@ -160,34 +407,270 @@ class Submitter:
         self.worker.close()
 
 
-def get_runnable_tasks(graph):
-    """Parse a graph and return all runnable tasks"""
-    tasks = []
-    to_remove = []
-    for tsk in graph.sorted_nodes:
-        # since the list is sorted (breadth-first) we can stop
-        # when we find a task that depends on any task that is already in tasks
-        if set(graph.predecessors[tsk.name]).intersection(set(tasks)):
-            break
-        if is_runnable(graph, tsk):
-            tasks.append(tsk)
-            to_remove.append(tsk)
-    # removing tasks that are ready to run from the graph
-    for nd in to_remove:
-        graph.remove_nodes(nd)
-    return tasks
-
-
-def is_runnable(graph, obj):
-    """Check if a task within a graph is runnable"""
-    connections_to_remove = []
-    for pred in graph.predecessors[obj.name]:
-        is_done = pred.done
-        if not is_done:
-            return False
+def graph_generations(graph):
+    """
+    Returns nodes of the graph grouped in generations, nodes of every generation
+    depend only on the nodes of the previous generations
+    """
+    generation_of = {}
+    generations = []
+    for task in graph.sorted_nodes:
+        generation = max(
+            [generation_of[pred.name] + 1 for pred in graph.predecessors[task.name]],
+            default=0,
+        )
+        generation_of[task.name] = generation
+        if generation == len(generations):
+            generations.append([])
+        generations[generation].append(task)
+    return generations
+
+
+def _detach_completed(runnable):
+    """Detaches the completion registry from the runnable (and workflow nodes)"""
+    runnable._completed = None
+    if is_workflow(runnable):
+        for task in runnable.graph.nodes:
+            _detach_completed(task)
+
+
+class Scheduler:
+    """
+    Event-driven scheduler of the workflow nodes.
+
+    Numbers of unfinished predecessors are kept for all nodes, and the
+    completions of the dispatched futures decrement the numbers of
+    the successors, so the nodes are ready as soon as all predecessors finish.
+    The graph is never rescanned, and no results are loaded to decide
+    if a node can run.
+
+    Nodes whose state comes only from their single (split) predecessor
+    follow the predecessor per state element: element i is submitted
+    (see ``Submitter._submit_element``) as soon as element i
+    of the predecessor finishes.
+
+    With ``priority`` set, the ready nodes are dispatched in the order of
+    the lengths of their remaining critical paths (see
+    ``DiGraph.calculate_critical_paths``), weighted by the durations
+    of the previous executions of the nodes (see ``DurationHistory``),
+    so the long chains of nodes are started first when the workers are limited.
+    """
+
+    def __init__(self, graph, submitter=None, wf=None, priority=False):
+        self.graph = graph
+        self.submitter = submitter
+        self.wf = wf
+        self.remaining = {
+            nd.name: len(graph.predecessors[nd.name]) for nd in graph.nodes
+        }
+        self.priorities = {}
+        if priority:
+            graph.calculate_critical_paths(duration_history.weights(graph.nodes))
+            self.priorities = graph.critical_paths
+        # heap of the ready nodes, (-priority, order, node)
+        self.ready = []
+        self._order = itertools.count()
+        for nd in graph.sorted_nodes:
+            if not self.remaining[nd.name]:
+                self._push_ready(nd)
+        # successors of the nodes run per state element
+        self.elementwise = {}
+        if submitter is not None:
+            for nd in graph.nodes:
+                predecessors = graph.predecessors[nd.name]
+                if len(predecessors) == 1 and follows_elements(predecessors[0], nd):
+                    self.elementwise.setdefault(predecessors[0].name, []).append(nd)
+        self.followers = {nd.name for nds in self.elementwise.values() for nd in nds}
+        # numbers of unfinished futures (or state elements) of the dispatched nodes
+        self.pending = {}
+        # generators of the state elements (see ``Submitter._state_jobs``),
+        # elements are requested while less than max_inflight are unfinished
+        self._sources = deque()
+        self.inflight = 0
+        self.max_inflight = submitter.max_inflight if submitter is not None else None
+        self.nunfinished = len(graph.nodes)
+        self._completions = deque()
+        self._event = asyncio.Event()
+
+    @property
+    def finished(self):
+        return self.nunfinished == 0
+
+    def pop_ready(self):
+        """Yields nodes ready to run (including nodes that become ready meanwhile)"""
+        while self.ready:
+            yield heapq.heappop(self.ready)[-1]
+
+    def _push_ready(self, task):
+        heapq.heappush(
+            self.ready, (-self.priorities.get(task.name, 0), next(self._order), task)
+        )
+
+    def dispatched(self, task, futures):
+        """Registers execution futures of the node"""
+        futures = [fut for fut in futures if inspect.isawaitable(fut)]
+        if not futures:
+            # e.g. executed by the serial worker
+            self._node_done(task)
+            return
+        self.pending[task.name] = len(futures)
+        for fut in futures:
+            self._register(task, None, fut)
+
+    def dispatched_states(self, task, jobs, nstates):
+        """
+        Registers the state elements of the node, ``jobs`` yields the state
+        indices with the futures of the elements (None for the elements that
+        are cached or executed by the serial worker)
+        """
+        self._expect_elements(task, nstates)
+        self._sources.append((task, jobs))
+        self._fill()
+
+    def _fill(self):
+        """
+        Requests state elements from the generators up to max_inflight,
+        generators yielding None wait for a completion
+        """
+        waiting = 0
+        while (
+            self._sources
+            and waiting < len(self._sources)
+            and (not self.max_inflight or self.inflight < self.max_inflight)
+        ):
+            task, jobs = self._sources[0]
+            try:
+                item = next(jobs)
+            except StopIteration:
+                self._sources.popleft()
+                continue
+            if item is None:
+                self._sources.rotate(-1)
+                waiting += 1
+                continue
+            waiting = 0
+            self._register(task, *item)
+
+    def _expect_elements(self, task, nstates):
+        if nstates == 0:
+            self._node_done(task)
+        else:
+            self.pending[task.name] = nstates
+        for follower in self.elementwise.get(task.name, []):
+            self._expect_elements(follower, nstates)
+
+    def _register(self, task, sidx, future):
+        if sidx is not None:
+            self.inflight += 1
+        if future is None or not inspect.isawaitable(future):
+            self._completions.append((task, sidx, None))
+            self._event.set()
         else:
-            connections_to_remove.append(pred)
-    # removing nodes that are done from connections
-    for nd in connections_to_remove:
-        graph.remove_nodes_connections(nd)
-    return True
+            future = asyncio.ensure_future(future)
+            future.add_done_callback(partial(self._future_done, task, sidx))
+
+    def _future_done(self, task, sidx, future):
+        self._completions.append((task, sidx, future))
+        self._event.set()
+
+    async def wait(self):
+        """
+        Waits for any completion, submits the state elements that can run
+        and raises errors of the failed nodes
+        """
+        if not self.pending and not self.ready and not self._completions:
+            raise Exception("Nothing queued or todo - something went wrong")
+        if not self.ready and not self._completions:
+            await self._event.wait()
+        self._event.clear()
+        while self._completions:
+            task, sidx, future = self._completions.popleft()
+            if future is not None:
+                if future.cancelled():
+                    raise asyncio.CancelledError(f"{task} was cancelled")
+                elif future.exception() is not None:
+                    raise future.exception()
+            if sidx is not None:
+                self.inflight -= 1
+                for follower in self.elementwise.get(task.name, []):
+                    future = self.submitter._submit_element(self.wf, follower, sidx)
+                    self._register(follower, sidx, future)
+            self.pending[task.name] -= 1
+            if not self.pending[task.name]:
+                del self.pending[task.name]
+                self._node_done(task)
+            self._fill()
+
+    def _node_done(self, task):
+        if task.name in self.followers:
+            self.submitter._prepare_state(self.wf, task)
+        self.nunfinished -= 1
+        for successor in self.graph.successors[task.name]:
+            if successor.name in self.followers:
+                continue
+            self.remaining[successor.name] -= 1
+            if not self.remaining[successor.name]:
+                self._push_ready(successor)
+
+
+def follows_elements(node, task):
+    """
+    Checks if every state element of the task depends only on the same element
+    of the node (the state of the task comes only from the node without a combiner)
+    """
+    return (
+        node.state is not None
+        and not node.state.combiner
+        and task.state is not None
+        and task.state.splitter == f"_{node.name}"
+        and list(task.state.other_states) == [node.name]
+    )
+
+
+class DurationHistory:
+    """
+    Durations of the task executions (by the names of the tasks) within
+    the process, the durations are taken from the results of the tasks
+    """
+
+    def __init__(self):
+        # name -> (sum of durations, number of executions)
+        self._durations = {}
+
+    def add(self, task, result):
+        if isinstance(result, list):
+            # results of a chunk of state elements
+            for res in result:
+                self.add(task, res)
+            return
+        duration = getattr(result, "duration", None)
+        if duration is None:
+            return
+        total, count = self._durations.get(task.name, (0.0, 0))
+        self._durations[task.name] = (total + duration, count + 1)
+
+    def get(self, task):
+        """Returns the mean duration of the task (None if not known)"""
+        if task.name not in self._durations:
+            return None
+        total, count = self._durations[task.name]
+        return total / count
+
+    def weights(self, nodes):
+        """
+        Returns weights of the nodes for the critical paths, nodes that were
+        not executed yet get the mean duration of the known nodes
+        """
+        known = {}
+        for nd in nodes:
+            duration = self.get(nd)
+            if duration is not None:
+                known[nd.name] = duration
+        default = sum(known.values()) / len(known) if known else 1
+        return {nd.name: known.get(nd.name, default) for nd in nodes}
+
+    def clear(self):
+        self._durations.clear()
+
+
+duration_history = DurationHistory()
@@ -0,0 +1,307 @@
+import os
+from pathlib import Path
+import shutil
+
+from .utils import multiply, gen_basic_wf
+from ... import cache as pydra_cache
+from .. import cache, helpers, stores
+from ..cache import ResultCache, CacheLocationIndex, CacheManager, CompletionRegistry
+from ..cache import result_cache, cache_index
+from ..locks import get_lock
+from ..submitter import Submitter
+
+
+def test_result_cache_lru():
+    cache = ResultCache(max_bytes=100)
+    cache.put("a", 1, "result_a", nbytes=40)
+    cache.put("b", 1, "result_b", nbytes=40)
+    assert cache.get("a", 1) == "result_a"
+    # "b" is the least recently used
+    cache.put("c", 1, "result_c", nbytes=40)
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == "result_a"
+    assert cache.get("c", 1) == "result_c"
+    assert cache.nbytes == 80
+    # identity of the file has changed
+    assert cache.get("a", 2) is None
+    # too big to be cached
+    cache.put("d", 1, "result_d", nbytes=200)
+    assert cache.get("d", 1) is None
+    assert cache.stats() == {
+        "hits": 3,
+        "misses": 3,
+        "evictions": 1,
+        "entries": 2,
+        "nbytes": 80,
+        "max_bytes": 100,
+    }
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_result_cache_grow():
+    cache = ResultCache(max_bytes=100)
+    cache.put("a", 1, "result_a", nbytes=40)
+    cache.put("b", 1, "result_b", nbytes=40)
+    cache.grow("a", 1, 10)
+    assert cache.nbytes == 90
+    # a result read from another file is not changed
+    cache.grow("a", 2, 10)
+    assert cache.nbytes == 90
+    # "b" is the least recently used, the result that grows is used again
+    cache.grow("a", 1, 20)
+    assert cache.get("b", 1) is None
+    assert cache.nbytes == 70
+    # too big to be cached
+    cache.grow("a", 1, 40)
+    assert cache.get("a", 1) is None
+    assert cache.nbytes == 0
+
+
+def test_load_result_cached(tmpdir, monkeypatch):
+    cache_dir = Path(tmpdir)
+    nn = multiply(name="mult", x=2, y=3, cache_dir=cache_dir)
+    nn()
+    result_cache.clear()
+
+    loads = []
+    orig_load = stores.result_from_entries
+
+    def load_logged(reader):
+        loads.append(reader)
+        return orig_load(reader)
+
+    monkeypatch.setattr(stores, "result_from_entries", load_logged)
+    res = helpers.load_result(nn.checksum, [cache_dir])
+    assert res.output.out == 6
+    assert helpers.load_result(nn.checksum, [cache_dir]) is res
+    assert nn.result() is res
+    assert len(loads) == 1
+
+    # a new result file is read again
+    helpers.save(cache_dir / nn.checksum, result=res)
+    assert helpers.load_result(nn.checksum, [cache_dir]).output.out == 6
+    assert len(loads) == 2
+
+
+def test_cache_index(tmpdir, monkeypatch):
+    location = Path(tmpdir) / "cache"
+    location.mkdir()
+    (location / "checksum_1").mkdir()
+    index = CacheLocationIndex(refresh_interval=1000)
+    index.register(location)
+    assert index.is_indexed(location)
+    assert index.contains(location, "checksum_1")
+
+    # no filesystem calls for known entries and recent misses
+    def no_scandir(*args, **kwargs):
+        raise AssertionError("location was scanned")
+
+    monkeypatch.setattr(cache.os, "scandir", no_scandir)
+    monkeypatch.setattr(cache.os, "stat", no_scandir)
+    assert index.contains(location, "checksum_1")
+    assert not index.contains(location, "checksum_2")
+    # entries saved by the process are added to the index
+    index.add(location, "checksum_2")
+    assert index.contains(location, "checksum_2")
+    monkeypatch.undo()
+
+    # the location is scanned again after refresh_interval
+    (location / "checksum_3").mkdir()
+    assert not index.contains(location, "checksum_3")
+    index.refresh_interval = 0
+    assert index.contains(location, "checksum_3")
+
+
+def test_cache_index_writable(tmpdir):
+    location = Path(tmpdir)
+    index = CacheLocationIndex()
+    index.register(location)
+    index.set_writable(location)
+    assert not index.is_indexed(location)
+    index.register(location)
+    assert not index.is_indexed(location)
+
+
+def test_load_result_cache_locations(tmpdir):
+    cache_dir = Path(tmpdir) / "cache"
+    cache_dir_new = Path(tmpdir) / "cache_new"
+    cache_dir.mkdir()
+    cache_dir_new.mkdir()
+    nn = multiply(name="mult", x=2, y=3, cache_dir=cache_dir)
+    nn()
+    # cache_dir is used only as an additional (indexed) location
+    nn_new = multiply(
+        name="mult", x=2, y=3, cache_dir=cache_dir_new, cache_locations=cache_dir
+    )
+    assert cache_index.is_indexed(cache_dir) is False
+    assert nn_new.result().output.out == 6
+    assert helpers.load_result("missing", nn_new.cache_locations) is None
+
+
+def _run_tasks(cache_dir, values):
+    tasks = []
+    for x in values:
+        nn = multiply(name="mult", x=x, y=x, cache_dir=cache_dir)
+        nn()
+        tasks.append(nn)
+    return tasks
+
+
+def _set_accessed(cache_dir, task, accessed):
+    os.utime(cache_dir / task.checksum, (accessed, accessed))
+
+
+def test_cache_manager_gc(tmpdir):
+    cache_dir = Path(tmpdir)
+    tasks = _run_tasks(cache_dir, [1, 2, 3, 4])
+    for i, task in enumerate(tasks):
+        _set_accessed(cache_dir, task, 1000 + i)
+    manager = CacheManager(cache_dir, min_age=0)
+    nbytes, nentries = manager.usage()
+    assert nentries == 4
+    # pinned and locked entries are not removed
+    manager.pin(tasks[0].checksum)
+    lock = get_lock(cache_dir / (tasks[1].checksum + ".lock")).acquire()
+    removed = manager.gc(max_entries=2, dry_run=True)
+    assert [entry.checksum for entry in removed] == [t.checksum for t in tasks[2:]]
+    assert manager.usage()[1] == 4
+    removed = manager.gc(max_entries=2)
+    assert [entry.checksum for entry in removed] == [t.checksum for t in tasks[2:]]
+    assert tasks[0].result().output.out == 1
+    assert tasks[2].result() is None
+    assert manager.usage()[1] == 2
+
+    # byte budget
+    lock.release()
+    manager.unpin(tasks[0].checksum)
+    manager.gc(max_bytes=0)
+    assert manager.usage() == (0, 0)
+
+
+def test_cache_manager_gc_recent(tmpdir):
+    cache_dir = Path(tmpdir)
+    tasks = _run_tasks(cache_dir, [1, 2])
+    manager = CacheManager(cache_dir, max_entries=0)
+    # entries accessed within min_age are kept
+    assert manager.gc() == []
+    _set_accessed(cache_dir, tasks[0], 1000)
+    assert [entry.checksum for entry in manager.gc()] == [tasks[0].checksum]
+
+
+def test_cache_manager_access_time(tmpdir, monkeypatch):
+    cache_dir = Path(tmpdir)
+    nn, nn_old = _run_tasks(cache_dir, [1, 2])
+    _set_accessed(cache_dir, nn, 1000)
+    _set_accessed(cache_dir, nn_old, 2000)
+    monkeypatch.setattr(stores, "ACCESS_TIME_INTERVAL", 0)
+    # loading the result updates the access time
+    assert nn.result().output.out == 1
+    removed = CacheManager(cache_dir, min_age=0).gc(max_entries=1)
+    assert [entry.checksum for entry in removed] == [nn_old.checksum]
+
+
+def test_cache_manager_pin_workflow(tmpdir):
+    cache_dir = Path(tmpdir)
+    wf = gen_basic_wf()
+    wf.cache_dir = cache_dir
+    wf.inputs.x = 1
+    with Submitter(plugin="cf") as sub:
+        sub(wf)
+    manager = CacheManager(cache_dir, min_age=0)
+    manager.pin_task(wf)
+    pinned = {entry.checksum for entry in manager.entries() if entry.pinned}
+    # workflow and the node connected to the output are pinned
+    assert len(pinned) == 2 and wf.checksum in pinned
+    (node_checksum,) = pinned - {wf.checksum}
+    assert helpers.load_result(node_checksum, [cache_dir]).output.out == 5
+    assert manager.usage()[1] == 3
+    manager.gc(max_entries=0)
+    assert {entry.checksum for entry in manager.entries()} == pinned
+    assert wf.result().output.out == 5
+
+
+def test_cache_manager_sqlite(tmpdir):
+    cache_dir = Path(tmpdir)
+    stores.set_result_store(cache_dir, "sqlite")
+    tasks = _run_tasks(cache_dir, [1, 2, 3])
+    manager = CacheManager(cache_dir, min_age=0)
+    assert manager.usage()[1] == 3
+    manager.pin(tasks[1].checksum)
+    manager.gc(max_entries=0)
+    assert [entry.checksum for entry in manager.entries()] == [tasks[1].checksum]
+
+
+def test_cache_cli(tmpdir, capsys):
+    cache_dir = Path(tmpdir)
+    tasks = _run_tasks(cache_dir, [1, 2])
+    for task in tasks:
+        _set_accessed(cache_dir, task, 1000)
+    (cache_dir / "old.lock").touch()
+    os.utime(cache_dir / "old.lock", (1000, 1000))
+    assert pydra_cache.main(["usage", str(cache_dir)]) == 0
+    assert capsys.readouterr().out.startswith("2 entries")
+    pydra_cache.main(["pin", str(cache_dir), tasks[0].checksum])
+    pydra_cache.main(["gc", str(cache_dir), "--max-bytes", "0", "--stale-locks", "60"])
+    out = capsys.readouterr().out
+    assert "removed stale lock old.lock" in out
+    assert f"removed {tasks[1].checksum}" in out
+    assert not (cache_dir / "old.lock").exists()
+    assert [entry.checksum for entry in CacheManager(cache_dir).entries()] == [
+        tasks[0].checksum
+    ]
+    assert pydra_cache.parse_size("1.5K") == 1536
+    assert pydra_cache.parse_size("10GB") == 10 * 2 ** 30
+
+
+def test_completion_registry(tmpdir):
+    cache_dir = Path(tmpdir)
+    tasks = _run_tasks(cache_dir, [1, 2])
+    registry = CompletionRegistry()
+    registry.add(cache_dir, [tasks[0].checksum])
+    assert registry.missing([tasks[0].checksum, tasks[1].checksum], [cache_dir]) == [
+        tasks[1].checksum
+    ]
+    # checksums of other locations are not recorded
+    assert registry.missing([tasks[0].checksum], [cache_dir / "other"]) == [
+        tasks[0].checksum
+    ]
+    # results found in the location are recorded
+    assert registry.done([tasks[0].checksum, tasks[1].checksum], [cache_dir])
+    assert len(registry) == 2
+    assert not registry.done(["missing"], [cache_dir])
+    assert len(registry) == 2
+
+
+def test_done_from_registry(tmpdir, monkeypatch):
+    wf = gen_basic_wf()
+    wf.cache_dir = tmpdir
+    with Submitter("cf") as sub:
+        sub(wf)
+    assert len(sub.completed) == len(wf.graph.nodes)
+    for nd in wf.graph.nodes:
+        nd.inputs.retrieve_values(wf)
+    checksums = [nd.checksum for nd in wf.graph.nodes]
+
+    def has_results(store, checksums):
+        raise AssertionError("completed tasks are recorded in the registry")
+
+    monkeypatch.setattr(stores.DirectoryStore, "has_results", has_results)
+    assert sub.completed.done(checksums, [wf.cache_dir])
+
+
+def test_registry_detached_after_run(tmpdir):
+    wf = gen_basic_wf()
+    wf.cache_dir = tmpdir
+    with Submitter("cf") as sub:
+        sub(wf)
+    assert wf._completed is None
+    assert all(nd._completed is None for nd in wf.graph.nodes)
+    for nd in wf.graph.nodes:
+        nd.inputs.retrieve_values(wf)
+    assert wf.done_all_tasks
+    # results removed after the run are not reported by the registry
+    nd = next(iter(wf.graph.nodes))
+    shutil.rmtree(nd.output_dir)
+    assert not nd.done
+    assert not wf.done_all_tasks
@@ -388,3 +388,17 @@ def test_copy_1():
     assert id(graph.nodes[0]) == id(graph_copy.nodes[0])
     assert graph.edges == graph_copy.edges
     assert id(graph.edges) != (graph_copy.edges)
+
+
+def test_critical_paths_1():
+    """a -> b -> c; a -> c; d -> b"""
+    graph = DiGraph(nodes=[B, A, C, D], edges=[(A, B), (B, C), (A, C), (D, B)])
+    graph.calculate_critical_paths()
+    assert graph.critical_paths == {"a": 3, "b": 2, "c": 1, "d": 3}
+
+
+def test_critical_paths_2():
+    """a -> b -> c; d (weighted)"""
+    graph = DiGraph(nodes=[B, A, C, D], edges=[(A, B), (B, C)])
+    graph.calculate_critical_paths(weights={"a": 1.0, "b": 0.5, "d": 4.0})
+    assert graph.critical_paths == {"a": 2.5, "b": 1.5, "c": 1, "d": 4.0}
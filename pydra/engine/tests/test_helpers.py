@@ -26,8 +26,7 @@ def test_save(tmpdir):
     helpers.save(outdir, result=res)
     del res
     # load saved result
-    res_pkl = outdir / "_result.pklz"
-    res = cp.loads(res_pkl.read_bytes())
+    res = helpers.load_result(outdir.name, [outdir.parent])
     assert res.output.out == 2
 
 
@@ -49,3 +48,49 @@ def test_hash_file(tmpdir):
         helpers.hash_file(outdir / "test.file")
         == "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
     )
+
+
+def test_hash_function():
+    # dictionaries and sets don't depend on the order of elements
+    assert helpers.hash_function({"a": 1, "b": [1, 2]}) == helpers.hash_function(
+        {"b": [1, 2], "a": 1}
+    )
+    assert helpers.hash_function({1, 2, 3}) == helpers.hash_function({3, 1, 2})
+    # types are part of the structure
+    assert helpers.hash_function([1, 2]) != helpers.hash_function((1, 2))
+    assert helpers.hash_function(1) != helpers.hash_function("1")
+    assert helpers.hash_function(True) != helpers.hash_function(1)
+    assert helpers.hash_function([1, [2]]) != helpers.hash_function([[1], 2])
+
+
+def test_hash_function_numpy():
+    np = pytest.importorskip("numpy")
+    arr = np.arange(10000)
+    arr_mod = arr.copy()
+    arr_mod[5000] = -1
+    # str() representation of both arrays is the same
+    assert str(arr) == str(arr_mod)
+    assert helpers.hash_function(arr) != helpers.hash_function(arr_mod)
+    assert helpers.hash_function(arr) == helpers.hash_function(arr.copy())
+    # non-contiguous arrays
+    assert helpers.hash_function(arr[::2]) == helpers.hash_function(arr[::2].copy())
+    assert helpers.hash_function(arr) != helpers.hash_function(arr.astype(float))
+    assert helpers.hash_function(arr) != helpers.hash_function(arr.reshape(100, 100))
+    assert helpers.hash_function(np.float64(2.5)) == helpers.hash_function(2.5)
+
+
+def test_register_hasher():
+    class Subject:
+        def __init__(self, sid):
+            self.sid = sid
+
+    # default representation contains the object id
+    assert helpers.hash_function(Subject("01")) != helpers.hash_function(Subject("01"))
+
+    @helpers.register_hasher(Subject)
+    def bytes_repr_subject(obj):
+        yield b"Subject:"
+        yield from helpers.bytes_repr(obj.sid)
+
+    assert helpers.hash_function(Subject("01")) == helpers.hash_function(Subject("01"))
+    assert helpers.hash_function(Subject("01")) != helpers.hash_function(Subject("02"))
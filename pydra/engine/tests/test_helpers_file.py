@@ -0,0 +1,202 @@
+import os
+from pathlib import Path
+import time
+
+import pytest
+
+from .. import helpers_file
+from ..helpers_file import FileHashIndex, file_signature, hash_file
+
+
+@pytest.fixture
+def hash_index(tmpdir):
+    helpers_file.set_hash_index(Path(tmpdir) / "index" / "hashes.sqlite")
+    yield helpers_file.get_hash_index()
+    helpers_file.set_hash_index(None)
+
+
+def _old_file(path, content):
+    """creating a file with a modification time older than RACY_WINDOW"""
+    path.write_text(content)
+    mtime = time.time() - 100
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_hash_index_hit(tmpdir, hash_index, monkeypatch):
+    afile = _old_file(Path(tmpdir) / "test.file", "test")
+    digest = hash_file(afile)
+    assert digest == "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
+    assert hash_index.lookup(afile, "sha256") == digest
+
+    # the file should not be read again
+    def no_open(*args, **kwargs):
+        raise AssertionError("file was read")
+
+    monkeypatch.setattr(helpers_file, "open", no_open, raising=False)
+    assert hash_file(afile) == digest
+
+
+def test_hash_index_persistent(tmpdir, hash_index):
+    afile = _old_file(Path(tmpdir) / "test.file", "test")
+    digest = hash_file(afile)
+    # a new index (e.g. in a new process) reads the hash from the database
+    index_new = FileHashIndex(hash_index.path)
+    assert index_new.lookup(afile, "sha256") == digest
+    assert index_new.lookup(afile, "md5") is None
+
+
+def test_hash_index_invalidation(tmpdir, hash_index):
+    afile = _old_file(Path(tmpdir) / "test.file", "test")
+    digest = hash_file(afile)
+    _old_file(afile, "test_changed")
+    assert hash_index.lookup(afile, "sha256") is None
+    digest_new = hash_file(afile)
+    assert digest_new != digest
+    assert hash_index.lookup(afile, "sha256") == digest_new
+    afile.unlink()
+    assert hash_index.prune() == 1
+
+
+def test_hash_index_recent_file(tmpdir, hash_index):
+    """files modified very recently are hashed, but not stored in the index"""
+    afile = Path(tmpdir) / "test.file"
+    afile.write_text("test")
+    assert hash_file(afile) is not None
+    assert hash_index.lookup(afile, "sha256") is None
+    # file changed while hashing
+    signature = file_signature(afile)
+    _old_file(afile, "test2")
+    assert not hash_index.store(afile, "sha256", "digest", signature)
+
+
+def test_hash_index_disabled(tmpdir):
+    helpers_file.set_hash_index(False)
+    try:
+        assert helpers_file.get_hash_index() is None
+        afile = _old_file(Path(tmpdir) / "test.file", "test")
+        assert hash_file(afile) is not None
+    finally:
+        helpers_file.set_hash_index(None)
+
+
+def test_hash_index_default_path(tmpdir, monkeypatch):
+    from .. import core
+
+    monkeypatch.setattr(core, "_session_cache_root", Path(tmpdir))
+    helpers_file.set_hash_index(None)
+    assert helpers_file.get_hash_index().path == Path(tmpdir) / "file_hashes.sqlite"
+
+
+@pytest.mark.parametrize("fstype, journal_mode", [("ext4", "wal"), ("nfs", "delete")])
+def test_hash_index_journal_mode(tmpdir, monkeypatch, fstype, journal_mode):
+    # the write-ahead log doesn't work on the filesystems shared between hosts
+    monkeypatch.setattr(helpers_file, "filesystem_type", lambda path: fstype)
+    index = FileHashIndex(Path(tmpdir) / "hashes.sqlite")
+    conn = index._connection()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == journal_mode
+
+
+def test_hash_algorithm(tmpdir, hash_index):
+    afile = _old_file(Path(tmpdir) / "test.file", "test")
+    digest_sha = hash_file(afile)
+    digest_blake = hash_file(afile, crypto="blake2b")
+    assert digest_blake != digest_sha
+    assert len(digest_blake) == 128
+    # both hashes are kept in the index
+    assert hash_index.lookup(afile, "sha256") == digest_sha
+    assert hash_index.lookup(afile, "blake2b") == digest_blake
+    # a small read buffer gives the same hash
+    assert hash_file(afile, chunk_len=3, use_index=False) == digest_sha
+    with pytest.raises(ValueError):
+        hash_file(afile, crypto="unknown_algorithm")
+
+
+def test_set_hash_algorithm(tmpdir):
+    afile = _old_file(Path(tmpdir) / "test.file", "test")
+    try:
+        helpers_file.set_hash_algorithm("blake2b")
+        assert hash_file(afile) == hash_file(afile, crypto="blake2b")
+    finally:
+        helpers_file.set_hash_algorithm("sha256")
+    with pytest.raises(ValueError):
+        helpers_file.set_hash_algorithm("unknown_algorithm")
+    assert helpers_file.HASH_ALGORITHM == "sha256"
+
+
+def test_hash_files(tmpdir, hash_index):
+    files = [_old_file(Path(tmpdir) / f"test_{i}.file", f"test {i}") for i in range(20)]
+    hashes = helpers_file.hash_files(files, max_workers=4)
+    assert hashes == [hash_file(afile, use_index=False) for afile in files]
+    assert len(set(hashes)) == 20
+
+
+def _old_tree(root):
+    """creating a small directory tree with old modification times"""
+    for rel in ["sub-01/anat/T1w.nii", "sub-01/func/bold.nii", "sub-02/anat/T1w.nii"]:
+        (root / rel).parent.mkdir(parents=True, exist_ok=True)
+        _old_file(root / rel, rel)
+    _old_file(root / "dataset_description.json", "{}")
+    return root
+
+
+def test_hash_dir(tmpdir, hash_index):
+    root = _old_tree(Path(tmpdir) / "ds")
+    digest = helpers_file.hash_dir(root)
+    assert digest == helpers_file.hash_dir(root, use_index=False)
+    # the hash doesn't depend on the location of the directory
+    copy = _old_tree(Path(tmpdir) / "ds_copy")
+    assert helpers_file.hash_dir(copy) == digest
+    # content, names and structure are part of the hash
+    _old_file(copy / "sub-02" / "anat" / "T1w.nii", "modified")
+    assert helpers_file.hash_dir(copy) != digest
+    (root / "sub-02" / "anat" / "T1w.nii").rename(root / "sub-02" / "T1w.nii")
+    assert helpers_file.hash_dir(root) != digest
+    assert helpers_file.hash_dir(Path(tmpdir) / "missing") is None
+
+
+def test_hash_dir_symlinks(tmpdir, hash_index):
+    root = _old_tree(Path(tmpdir) / "ds")
+    # a link to the parent directory forms a loop
+    os.symlink("..", root / "sub-01" / "loop")
+    os.symlink("dataset_description.json", root / "link.json")
+    digest, signature = helpers_file.hash_dir(root, return_signature=True)
+    assert digest == helpers_file.hash_dir(root, use_index=False)
+    assert signature == helpers_file.dir_signature(root)
+    # the links are followed, modified targets change the hash and the signature
+    _old_file(root / "dataset_description.json", '{"Name": "ds"}')
+    assert helpers_file.hash_dir(root) != digest
+    assert helpers_file.dir_signature(root) != signature
+    digest = helpers_file.hash_dir(root)
+    (root / "link.json").unlink()
+    os.symlink("sub-01", root / "link.json")
+    assert helpers_file.hash_dir(root) != digest
+    # a linked directory is hashed as its copy
+    copy = _old_tree(Path(tmpdir) / "ds_copy")
+    (copy / "sub-01" / "anat" / "T1w.nii").unlink()
+    os.symlink(
+        root / "sub-01" / "anat" / "T1w.nii", copy / "sub-01" / "anat" / "T1w.nii"
+    )
+    assert helpers_file.hash_dir(copy, use_index=False) == helpers_file.hash_dir(
+        _old_tree(Path(tmpdir) / "ds_plain"), use_index=False
+    )
+
+
+def test_hash_dir_incremental(tmpdir, hash_index, monkeypatch):
+    root = _old_tree(Path(tmpdir) / "ds")
+    digest = helpers_file.hash_dir(root)
+
+    read_files = []
+
+    def open_logged(afile, *args, **kwargs):
+        read_files.append(Path(afile).name)
+        return open(afile, *args, **kwargs)
+
+    monkeypatch.setattr(helpers_file, "open", open_logged, raising=False)
+    # nothing changed, the cached root hash is used
+    assert helpers_file.hash_dir(root) == digest
+    assert read_files == []
+    # only the modified file is hashed again
+    _old_file(root / "sub-01" / "func" / "bold.nii", "modified")
+    assert helpers_file.hash_dir(root) != digest
+    assert read_files == ["bold.nii"]
@@ -0,0 +1,138 @@
+import json
+import os
+from pathlib import Path
+import socket
+import threading
+import time
+
+import pytest
+
+from .utils import multiply
+from .. import locks
+from ..cache import CacheManager
+from ..locks import get_lock, FlockLock, HeartbeatLock, LockTimeout
+
+backends = ["heartbeat"] + (["flock"] if locks.fcntl else [])
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_lock_acquire_release(tmpdir, backend):
+    lockfile = Path(tmpdir) / "task.lock"
+    lock = get_lock(lockfile, backend=backend)
+    with lock:
+        assert lockfile.exists()
+        assert lock.wait_time < 1
+        assert not lock.is_stale()
+        with pytest.raises(LockTimeout):
+            get_lock(lockfile, backend=backend).acquire(timeout=0)
+    # lock files are removed on release
+    assert not lockfile.exists()
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_lock_waiter_woken_on_release(tmpdir, backend, monkeypatch):
+    # waiting for releases of other processes would take longer
+    monkeypatch.setattr(locks, "POLL_INTERVAL", 10)
+    lockfile = Path(tmpdir) / "task.lock"
+    holder = get_lock(lockfile, backend=backend).acquire()
+    waiter = get_lock(lockfile, backend=backend)
+    thread = threading.Thread(target=waiter.acquire)
+    thread.start()
+    time.sleep(0.5)
+    holder.release()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert 0.5 <= waiter.wait_time < 3
+    waiter.release()
+
+
+def test_heartbeat_lock_stale(tmpdir):
+    lockfile = Path(tmpdir) / "task.lock"
+    # lock of a dead process of this host
+    lockfile.write_text(
+        json.dumps({"host": socket.gethostname(), "pid": 2 ** 22 + 1, "id": "a"})
+    )
+    lock = HeartbeatLock(lockfile)
+    assert lock.is_stale()
+    lock.acquire(timeout=0)
+    assert json.loads(lockfile.read_text())["pid"] == os.getpid()
+    lock.release()
+    # lock of another host without a heartbeat
+    lockfile.write_text(json.dumps({"host": "other", "pid": 1, "id": "b"}))
+    assert not lock.is_stale()
+    os.utime(lockfile, (1000, 1000))
+    assert lock.is_stale()
+    lock.acquire(timeout=0).release()
+    assert not lockfile.exists()
+
+
+def test_heartbeat_lock_beats(tmpdir):
+    lockfile = Path(tmpdir) / "task.lock"
+    with HeartbeatLock(lockfile, interval=0.1, timeout=1):
+        os.utime(lockfile, (1000, 1000))
+        time.sleep(0.3)
+        assert time.time() - lockfile.stat().st_mtime < 1
+        assert not HeartbeatLock(lockfile, timeout=1).is_stale()
+
+
+@pytest.mark.skipif(not locks.fcntl, reason="requires flock")
+def test_flock_lock_stale(tmpdir):
+    lockfile = Path(tmpdir) / "task.lock"
+    # lock files of killed processes are not locked
+    lockfile.touch()
+    lock = FlockLock(lockfile)
+    assert lock.is_stale()
+    lock.acquire(timeout=0).release()
+    assert not lockfile.exists()
+
+
+def test_get_lock_backend(tmpdir, monkeypatch):
+    monkeypatch.setattr(locks, "filesystem_type", lambda path: "nfs4")
+    assert isinstance(get_lock(Path(tmpdir) / "a.lock"), HeartbeatLock)
+    if locks.fcntl:
+        monkeypatch.setattr(locks, "filesystem_type", lambda path: "ext4")
+        assert isinstance(get_lock(Path(tmpdir) / "a.lock"), FlockLock)
+    with pytest.raises(ValueError):
+        get_lock(Path(tmpdir) / "a.lock", backend="unknown")
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_task_lock(tmpdir, backend, monkeypatch):
+    monkeypatch.setattr(locks, "LOCK_BACKEND", backend)
+    nn = multiply(name="mult", x=2, y=3, cache_dir=tmpdir)
+    result = nn()
+    assert result.output.out == 6
+    assert result.lock_wait is not None
+    assert not list(Path(tmpdir).glob("*.lock"))
+    # stale lock files of killed tasks are removed
+    lockfile = Path(tmpdir) / (nn.checksum + ".lock")
+    lockfile.touch()
+    os.utime(lockfile, (1000, 1000))
+    assert CacheManager(tmpdir).remove_stale_locks(60) == [lockfile.name]
+    assert not lockfile.exists()
+
+
+def test_task_lock_wait_saved(tmpdir):
+    # the task runs in a worker process, the wait is read from the saved result
+    nn = multiply(name="mult", x=2, y=3, cache_dir=tmpdir)
+    nn(plugin="cf")
+    assert nn.result().lock_wait is not None
+
+
+def test_lock_abstract(tmpdir):
+    with pytest.raises(TypeError):
+        locks.Lock(Path(tmpdir) / "a.lock")
+
+
+def test_cached_task_not_locked(tmpdir, monkeypatch):
+    from .. import core
+
+    nn = multiply(name="mult", x=2, y=3, cache_dir=tmpdir)
+    nn()
+
+    def get_lock(path, backend=None):
+        raise AssertionError("cached results are read without the lock")
+
+    monkeypatch.setattr(core, "get_lock", get_lock)
+    nn = multiply(name="mult", x=2, y=3, cache_dir=tmpdir)
+    assert nn().output.out == 6
@@ -6,6 +6,7 @@ import pytest
 from .utils import fun_addtwo, fun_addvar, moment, fun_div
 
 from ..core import TaskBase
+from ..specs import BaseSpec
 from ..submitter import Submitter
 
 if bool(shutil.which("sbatch")):
@@ -145,6 +146,55 @@ def test_task_init_4b():
     assert str(excinfo.value) == "splitter has been already set"
 
 
+def test_task_checksum_states():
+    """ checksums of the states are the same as checksums of the jobs,
+        and are cached in the state until the inputs change
+    """
+    nn = fun_addvar(name="NA", a=[3, 5, 3], b=10).split(splitter="a")
+    nn.state.prepare_states(nn.inputs)
+    nn.state.prepare_inputs()
+    checksums = nn.checksum_states()
+    assert checksums == [nn.to_job(i).checksum for i in range(3)]
+    # the same element value gives the same checksum
+    assert checksums[0] == checksums[2] != checksums[1]
+    assert nn.checksum_states(1) == checksums[1]
+    assert nn.state.checksums_cache[1] == checksums
+
+    nn.inputs.b = 20
+    checksums_new = nn.checksum_states()
+    assert checksums_new == [nn.to_job(i).checksum for i in range(3)]
+    assert set(checksums_new).isdisjoint(checksums)
+
+
+def test_task_to_job(monkeypatch):
+    """ jobs are created without copying the state and all elements of the inputs,
+        the known checksum of the element is used without hashing the inputs
+    """
+    nn = fun_addvar(name="NA", a=[3, 5, 3], b=10).split(splitter="a")
+    nn.state.prepare_states(nn.inputs)
+    nn.state.prepare_inputs()
+    checksums = nn.checksum_states()
+    state, inputs = nn.state, nn.inputs
+
+    def no_deepcopy(self, memo):
+        raise AssertionError("state was copied")
+
+    def no_hash(self):
+        raise AssertionError("inputs were hashed")
+
+    monkeypatch.setattr(type(nn.state), "__deepcopy__", no_deepcopy, raising=False)
+    monkeypatch.setattr(BaseSpec, "hash", property(no_hash))
+    job = nn.to_job(1, checksum=checksums[1])
+    assert job.state is None
+    assert (job.inputs.a, job.inputs.b) == (5, 10)
+    assert job.checksum == checksums[1]
+    monkeypatch.undo()
+    # the task is not changed
+    assert nn.state is state and nn.inputs is inputs
+    assert nn.inputs.a == [3, 5, 3]
+    assert job.checksum == checksums[1]
+
+
 def test_task_error():
     func = fun_div(name="div", a=1, b=0)
     with pytest.raises(ZeroDivisionError):
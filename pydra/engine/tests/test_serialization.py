@@ -0,0 +1,152 @@
+import gzip
+import io
+from pathlib import Path
+import pickle
+
+import pytest
+
+from .utils import multiply, fun_addvar
+from .. import helpers, serialization
+from ..serialization import dump, dumps, load_file, loads
+
+
+@pytest.mark.parametrize("compression", ["gzip", "bz2", "xz", "zstd", "lz4"])
+def test_dump_compression(compression):
+    try:
+        serialization.check_compression(compression)
+    except ValueError:
+        pytest.skip(f"{compression} is not installed")
+    obj = [{"a": i, "b": "text" * 10} for i in range(10000)]
+    data, metadata = dumps(obj, compression=compression, threshold=0)
+    assert data.startswith(serialization.CODECS[compression][0])
+    assert metadata["compression"] == compression
+    assert metadata["stored_nbytes"] == len(data)
+    assert metadata["ratio"] > 1
+    assert metadata["time"] > 0
+    assert loads(data) == obj
+
+
+def test_dump_threshold():
+    obj = list(range(10))
+    data, metadata = dumps(obj, compression="gzip", threshold=2 ** 10)
+    # small objects are not compressed
+    assert metadata["compression"] is None and metadata["ratio"] == 1.0
+    assert loads(data) == obj
+    obj = list(range(10000))
+    data, metadata = dumps(obj, compression="gzip", threshold=2 ** 10)
+    assert metadata["compression"] == "gzip"
+    assert gzip.decompress(data) and loads(data) == obj
+
+
+@pytest.mark.parametrize("compression, threshold", [(None, 0), ("gzip", float("inf"))])
+def test_dump_uncompressed_written_through(compression, threshold):
+    fp = io.BytesIO()
+    writer = serialization._CompressedWriter(fp, compression, None, threshold)
+    # nothing is buffered if the data are never compressed
+    writer.write(b"data" * 1000)
+    assert fp.getvalue() == b"data" * 1000
+    writer.close()
+    assert writer.nbytes == writer.stored_nbytes == 4000
+    assert fp.getvalue() == b"data" * 1000
+
+
+def test_set_compression(monkeypatch):
+    with pytest.raises(ValueError):
+        serialization.set_compression("unknown")
+    monkeypatch.setattr(serialization, "COMPRESSION", "gzip")
+    monkeypatch.setattr(serialization, "COMPRESSION_THRESHOLD", 0)
+    serialization.set_compression(None)
+    assert dumps([1, 2])[1]["compression"] is None
+
+
+def test_save_compressed(tmpdir, monkeypatch):
+    monkeypatch.setattr(serialization, "COMPRESSION_THRESHOLD", 0)
+    cache_dir = Path(tmpdir)
+    nn = fun_addvar(name="add", a=list(range(1000)), b=[1], cache_dir=cache_dir)
+    res = nn()
+    task_file = cache_dir / nn.checksum / "_task.pklz"
+    assert task_file.read_bytes().startswith(b"\x1f\x8b")
+    assert helpers.load_result(nn.checksum, [cache_dir]).output.out == res.output.out
+
+    # per-task threshold
+    nn = fun_addvar(name="add", a=[1], b=[2], cache_dir=cache_dir)
+    nn.compression_threshold = 2 ** 20
+    nn()
+    task_file = cache_dir / nn.checksum / "_task.pklz"
+    assert not task_file.read_bytes().startswith(b"\x1f\x8b")
+    assert helpers.load_result(nn.checksum, [cache_dir]).output.out == [1, 2]
+
+
+def test_load_task(tmpdir):
+    outdir = Path(tmpdir)
+    foo = multiply(name="mult", x=1, y=2)
+    metadata = helpers.save(outdir, task=foo, compression_threshold=0)
+    assert metadata["task"]["compression"] == serialization.COMPRESSION
+    foo = helpers.load_task(outdir / "_task.pklz")
+    assert foo.inputs.x == 1 and foo.inputs.y == 2
+    with (outdir / "obj.pklz").open("wb") as fp:
+        dump({"a": 1}, fp, compression=None)
+    assert load_file(outdir / "obj.pklz") == {"a": 1}
+
+
+class BufferObject:
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        return BufferObject, (pickle.PickleBuffer(self.data),)
+
+
+@pytest.mark.skipif(serialization.PROTOCOL < 5, reason="requires pickle protocol 5")
+def test_side_files(tmpdir, monkeypatch):
+    np = pytest.importorskip("numpy")
+    monkeypatch.setattr(serialization, "SIDE_FILE_THRESHOLD", 2 ** 10)
+    outdir = Path(tmpdir)
+    obj = {
+        "array": np.arange(1000.0),
+        "small": np.arange(3),
+        "objects": np.array([{}] * 1000, dtype=object),
+        "bytes": b"x" * 2000,
+        "buffer": BufferObject(bytearray(b"y" * 2000)),
+    }
+    with (outdir / "_result.pklz").open("wb") as fp:
+        metadata = dump(obj, fp, side_path=outdir / "_result")
+    assert metadata["side_files"] == [
+        "_result.0.npy",
+        "_result.1.bin",
+        "_result.buffers",
+    ]
+    assert metadata["nbytes"] < 2 ** 10 * 10
+    loaded = load_file(outdir / "_result.pklz")
+    # large arrays are memory mapped
+    assert isinstance(loaded["array"], np.memmap)
+    assert not loaded["array"].flags.writeable
+    assert np.array_equal(loaded["array"], obj["array"])
+    assert not isinstance(loaded["small"], np.memmap)
+    assert np.array_equal(loaded["small"], obj["small"])
+    assert len(loaded["objects"]) == 1000
+    assert loaded["bytes"] == obj["bytes"]
+    # out-of-band buffers are memory mapped
+    assert isinstance(loaded["buffer"].data, memoryview)
+    assert loaded["buffer"].data == obj["buffer"].data
+
+    # buffers file is removed when the object is saved again without buffers
+    with (outdir / "_result.pklz").open("wb") as fp:
+        dump({"bytes": b"x"}, fp, side_path=outdir / "_result")
+    assert not (outdir / "_result.buffers").exists()
+    assert load_file(outdir / "_result.pklz") == {"bytes": b"x"}
+
+
+def test_save_side_files(tmpdir, monkeypatch):
+    np = pytest.importorskip("numpy")
+    monkeypatch.setattr(serialization, "SIDE_FILE_THRESHOLD", 2 ** 10)
+    cache_dir = Path(tmpdir)
+    nn = multiply(name="mult", x=np.arange(1000), y=2, cache_dir=cache_dir)
+    nn()
+    assert (cache_dir / nn.checksum / "_result.out.0.npy").exists()
+    assert (cache_dir / nn.checksum / "_task.0.npy").exists()
+    res = helpers.load_result(nn.checksum, [cache_dir])
+    assert isinstance(res.output.out, np.memmap)
+    assert np.array_equal(res.output.out, np.arange(1000) * 2)
+    task = helpers.load_task(cache_dir / nn.checksum / "_task.pklz")
+    assert np.array_equal(task.inputs.x, np.arange(1000))
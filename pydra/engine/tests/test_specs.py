@@ -1,10 +1,16 @@
+from copy import deepcopy
 from pathlib import Path
 import typing as ty
 
+import cloudpickle as cp
+
+from .. import specs
+
 from ..specs import (
     BaseSpec,
     SpecInfo,
     File,
+    Directory,
     RuntimeSpec,
     Runtime,
     Result,
@@ -21,7 +27,7 @@ import pytest
 def test_basespec():
     spec = BaseSpec()
     assert (
-        spec.hash == "44136fa355b3678a1146ad16f7e8649e94fb4fc21fe77e8310c060f61caaff8a"
+        spec.hash == "0c9d324c35ef44780df01be935a55da1cbcf9f35a4f466215d38da790cbeb8f8"
     )
 
 
@@ -158,7 +164,7 @@ def test_file_hash(tmpdir):
     inputs = make_klass(input_spec)
     assert (
         inputs(str(outfile)).hash
-        == "1384a1eb11cd94a5b826a82b948313b9237a0956d406ccff59e79ec92b3c935f"
+        == "a795dab2f64a00fdd69d9329b3b4f4e645a4600fadc5cc33c1731e5d40ff190a"
     )
     with open(outfile, "wt") as fp:
         fp.write("test")
@@ -167,5 +173,227 @@ def test_file_hash(tmpdir):
     inputs = make_klass(input_spec)
     assert (
         inputs(outfile).hash
-        == "088625131e6718a00170ad445a9c295244dffd4e5d847c8ee4b1606d623dacb1"
+        == "5787370c365feb17257958902d7747bfdd39f2e26bd61c0747d17710a408e210"
+    )
+
+
+def test_hash_memoized(monkeypatch):
+    fields = [("a", int), ("b", ty.Any)]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)(a=1, b=(1, 2))
+    hash_1 = inputs.hash
+
+    from .. import helpers
+
+    calls = []
+    orig_hash_function = helpers.hash_function
+
+    def hash_function_counted(obj):
+        calls.append(obj)
+        return orig_hash_function(obj)
+
+    monkeypatch.setattr(helpers, "hash_function", hash_function_counted)
+    # the hash is not recalculated if the fields are not changed
+    assert inputs.hash == hash_1
+    assert calls == []
+    # setting a field invalidates the memoized hash
+    inputs.a = 2
+    hash_2 = inputs.hash
+    assert hash_2 != hash_1
+    assert calls
+    inputs.a = 1
+    assert inputs.hash == hash_1
+
+
+def test_hash_mutable_field():
+    fields = [("a", int), ("b", ty.Any)]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)(a=1, b=[1, 2])
+    hash_1 = inputs.hash
+    # modifications of lists and dicts in place are tracked
+    inputs.b[0] = 100
+    assert inputs.hash != hash_1
+    inputs.b[0] = 1
+    assert inputs.hash == hash_1
+    inputs.b = {"key": [1]}
+    hash_2 = inputs.hash
+    inputs.b["key"].append(2)
+    assert inputs.hash != hash_2
+
+
+def test_hash_tracked_containers_memoized(monkeypatch):
+    fields = [("a", ty.List[int]), ("b", ty.Any)]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)(a=list(range(100)), b={"key": [1, 2]})
+    hash_1 = inputs.hash
+    calls = []
+    orig_hash_value = BaseSpec.hash_value
+
+    def hash_value_counted(field, value):
+        calls.append(field.name)
+        return orig_hash_value(field, value)
+
+    monkeypatch.setattr(BaseSpec, "hash_value", staticmethod(hash_value_counted))
+    # unchanged lists and dicts are not hashed again
+    assert inputs.hash == hash_1
+    assert calls == []
+    inputs.b["key"].append(3)
+    inputs.b["key"].pop()
+    assert inputs.hash == hash_1
+    assert calls == ["b"]
+    # the tracked containers are hashed as the plain ones
+    assert (
+        inputs.hash
+        == make_klass(input_spec)(a=list(range(100)), b={"key": [1, 2]}).hash
     )
+    # values that can't be tracked are hashed every time
+    inputs.b = {1, 2}
+    hash_2 = inputs.hash
+    inputs.b.add(3)
+    assert inputs.hash != hash_2
+
+
+def test_version_key():
+    fields = [("a", ty.List[int]), ("b", ty.Any)]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)(a=[1, 2], b={"key": [1, 2]})
+    key = inputs.version_key()
+    assert inputs.version_key() == key
+    # in place changes and new values change the key
+    inputs.b["key"].append(3)
+    assert inputs.version_key() != key
+    key = inputs.version_key()
+    inputs.a = [1, 2]
+    assert inputs.version_key() != key
+    # a new spec with the same values doesn't reuse the key
+    assert make_klass(input_spec)(a=[1, 2], b={"key": [1, 2]}).version_key() != key
+    # values that can't be tracked have no key
+    inputs.b = {1, 2}
+    assert inputs.version_key() is None
+
+
+def test_hash_tracked_containers_copied():
+    fields = [("a", ty.List[int])]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)(a=[1, 2])
+    hash_1 = inputs.hash
+    for inputs_copy in [deepcopy(inputs), cp.loads(cp.dumps(inputs))]:
+        assert inputs_copy.a == [1, 2]
+        assert inputs_copy.hash == hash_1
+        inputs_copy.a.append(3)
+        assert inputs_copy.hash != hash_1
+    assert inputs.hash == hash_1
+
+
+def test_file_hash_memoized(tmpdir, monkeypatch):
+    from .. import helpers_file
+
+    tmpdir.chdir()
+    outfile = Path("test.file")
+    outfile.write_text("test")
+    fields = [("in_file", File)]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)(outfile)
+    hash_1 = inputs.hash
+    stats = []
+    orig_file_signature = helpers_file.file_signature
+
+    def file_signature_counted(path):
+        stats.append(path)
+        return orig_file_signature(path)
+
+    monkeypatch.setattr(helpers_file, "file_signature", file_signature_counted)
+    # the files are not checked again within FILE_CHECK_INTERVAL
+    assert inputs.hash == hash_1
+    assert stats == []
+    outfile.write_text("test_modified")
+    assert inputs.hash == hash_1
+    # modifying the file changes the signature, so the hash is recalculated
+    inputs.invalidate_hash(files_only=True)
+    assert inputs.hash != hash_1
+    assert stats
+
+
+@pytest.fixture
+def check_files(monkeypatch):
+    """The files of the input fields are checked on every use of the hash"""
+    monkeypatch.setattr(specs, "FILE_CHECK_INTERVAL", 0)
+
+
+def test_file_list_hash(tmpdir, check_files):
+    tmpdir.chdir()
+    files = []
+    for i in range(3):
+        Path(f"test_{i}.file").write_text(f"test {i}")
+        files.append(f"test_{i}.file")
+    fields = [("in_files", ty.List[File])]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)(files)
+    hash_1 = inputs.hash
+    # the content of the files is hashed
+    Path("test_1.file").write_text("test modified")
+    assert inputs.hash != hash_1
+
+
+def test_file_hash_algorithm(tmpdir):
+    from .. import helpers_file
+
+    tmpdir.chdir()
+    Path("test.file").write_text("test")
+    fields = [("in_file", File)]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)("test.file")
+    hash_sha = inputs.hash
+    try:
+        helpers_file.set_hash_algorithm("blake2b")
+        hash_blake = make_klass(input_spec)("test.file").hash
+        # the memoized hash of the old algorithm is not used
+        assert inputs.hash == hash_blake
+    finally:
+        helpers_file.set_hash_algorithm("sha256")
+    # the algorithm is a part of the hash
+    assert hash_sha != hash_blake
+    assert inputs.hash == hash_sha
+
+
+def test_dir_hash(tmpdir, check_files):
+    tmpdir.chdir()
+    Path("dir").mkdir()
+    Path("dir/test.file").write_text("test")
+    fields = [("in_dir", Directory)]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)("dir")
+    hash_1 = inputs.hash
+    # the content of the directory is hashed
+    Path("dir/test.file").write_text("test modified")
+    assert inputs.hash != hash_1
+    Path("dir/test.file").write_text("test")
+    assert inputs.hash == hash_1
+    Path("dir/test_new.file").write_text("test")
+    assert inputs.hash != hash_1
+
+
+def test_dir_hash_memoized(tmpdir, monkeypatch, check_files):
+    from .. import helpers_file
+
+    tmpdir.chdir()
+    Path("dir").mkdir()
+    Path("dir/test.file").write_text("test")
+    fields = [("in_dir", Directory)]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)("dir")
+    hash_1 = inputs.hash
+    calls = []
+    orig_hash_dir = helpers_file.hash_dir
+
+    def hash_dir_counted(dirpath, *args, **kwargs):
+        calls.append(dirpath)
+        return orig_hash_dir(dirpath, *args, **kwargs)
+
+    monkeypatch.setattr(helpers_file, "hash_dir", hash_dir_counted)
+    # the directory is not hashed again if its signature is not changed
+    assert inputs.hash == hash_1
+    assert calls == []
+    Path("dir/test_new.file").write_text("test")
+    assert inputs.hash != hash_1
+    assert calls == ["dir"]
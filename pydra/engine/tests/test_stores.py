@@ -0,0 +1,281 @@
+import dataclasses as dc
+from pathlib import Path
+import shutil
+import sqlite3
+import typing as ty
+
+import cloudpickle as cp
+import pytest
+
+from .utils import multiply, fun_addvar
+from ... import mark
+from .. import helpers
+from ..cache import result_cache
+from ..core import TaskChunk, Workflow
+from ..serialization import EntriesReader, replaced
+from ..submitter import Submitter
+from ..stores import (
+    DirectoryStore,
+    ResultStore,
+    SQLiteStore,
+    get_result_store,
+    set_result_store,
+)
+
+
+def test_default_store(tmpdir):
+    store = get_result_store(tmpdir)
+    assert isinstance(store, DirectoryStore)
+    assert get_result_store(Path(tmpdir)) is store
+
+
+def test_sqlite_store(tmpdir):
+    store = set_result_store(tmpdir, "sqlite")
+    assert isinstance(store, SQLiteStore)
+    assert not store.contains("checksum")
+    assert store.load_result("checksum") is None
+
+    foo = multiply(name="mult", x=1, y=2)
+    store.save("checksum", task=foo)
+    assert store.contains("checksum")
+    # only the task was saved
+    assert store.load_result("checksum") is None
+    assert store.load_task("checksum").inputs.x == 1
+
+    res = foo()
+    store.save("checksum", result=res)
+    assert store.load_result("checksum").output.out == 2
+    store.record_error("checksum", ValueError("error"))
+    assert isinstance(store.load_error("checksum"), ValueError)
+    # nothing is saved in the directory apart from the database
+    assert [p for p in Path(tmpdir).iterdir() if p.is_dir()] == []
+
+    # the store is detected by other processes
+    store_new = cp.loads(cp.dumps(SQLiteStore(tmpdir)))
+    assert store_new.load_result("checksum").output.out == 2
+
+
+def test_sqlite_store_batch(tmpdir):
+    store = SQLiteStore(tmpdir)
+    res = multiply(name="mult", x=1, y=2)()
+    with store.batch():
+        for i in range(10):
+            store.save(f"checksum_{i}", result=res)
+        # the transaction is not committed yet
+        conn = sqlite3.connect(str(store.db_path))
+        assert conn.execute("SELECT count(*) FROM entries").fetchone() == (0,)
+    assert conn.execute("SELECT count(*) FROM entries").fetchone() == (10,)
+
+
+@mark.task
+def count_entries(db_path, x):
+    conn = sqlite3.connect(db_path)
+    return conn.execute("SELECT count(*) FROM entries").fetchone()[0]
+
+
+def test_sqlite_store_chunk(tmpdir):
+    cache_dir = Path(tmpdir)
+    store = set_result_store(cache_dir, "sqlite")
+    db_path = str(store.db_path)
+    jobs = [count_entries(db_path=db_path, x=x, cache_dir=cache_dir) for x in range(5)]
+    results = TaskChunk(jobs)._run()
+    # the results of the elements are written together after the chunk
+    assert [res.output.out for res in results] == [0] * 5
+    assert count_entries(db_path=db_path, x=5)._run().output.out == 5
+    assert all(job.result() is not None for job in jobs)
+
+
+def test_result_store_abstract():
+    class IncompleteStore(ResultStore):
+        def contains(self, checksum):
+            return False
+
+    with pytest.raises(TypeError):
+        IncompleteStore("location")
+
+
+def test_sqlite_store_task(tmpdir):
+    cache_dir = Path(tmpdir)
+    set_result_store(cache_dir, "sqlite")
+    nn = multiply(name="mult", x=2, y=3, cache_dir=cache_dir)
+    assert nn().output.out == 6
+    # empty output directory is removed
+    assert not (cache_dir / nn.checksum).exists()
+    assert helpers.load_result(nn.checksum, [cache_dir]).output.out == 6
+
+    # cache_dir is used as an additional cache location
+    nn_new = multiply(
+        name="mult", x=2, y=3, cache_dir=cache_dir / "new", cache_locations=cache_dir
+    )
+    assert nn_new.result().output.out == 6
+
+
+def test_sqlite_store_state(tmpdir):
+    cache_dir = Path(tmpdir)
+    # the database file is used to detect the store in workers
+    SQLiteStore(cache_dir)
+    nn = fun_addvar(name="add", a=[1, 2, 3], b=10, cache_dir=cache_dir).split("a")
+    with Submitter(plugin="cf") as sub:
+        sub(nn)
+    assert [res.output.out for res in nn.result()] == [11, 12, 13]
+    assert [p.name for p in cache_dir.iterdir() if p.is_dir()] == []
+
+
+def test_sqlite_store_error(tmpdir):
+    cache_dir = Path(tmpdir)
+    store = set_result_store(cache_dir, "sqlite")
+    nn = fun_addvar(name="add", a=1, b="a", cache_dir=cache_dir)
+    with pytest.raises(TypeError):
+        nn()
+    assert isinstance(store.load_error(nn.checksum), TypeError)
+    assert store.load_result(nn.checksum).errored
+
+
+@mark.task
+def read_number(path):
+    return int(Path(path).read_text())
+
+
+@pytest.mark.parametrize("store", ["directory", "sqlite"])
+def test_errored_result_rerun(tmpdir, store):
+    set_result_store(tmpdir, store)
+    number_file = Path(tmpdir) / "number.txt"
+    number_file.write_text("x")
+    nn = read_number(path=str(number_file), cache_dir=tmpdir)
+    with pytest.raises(ValueError):
+        nn()
+    assert nn.result().errored
+    assert not nn.done
+    number_file.write_text("1")
+    assert nn().output.out == 1
+    assert nn.done
+
+
+@pytest.mark.parametrize("store", ["directory", "sqlite"])
+def test_result_fields_loaded_lazily(tmpdir, monkeypatch, store):
+    cache_dir = Path(tmpdir)
+    set_result_store(cache_dir, store)
+
+    @mark.task
+    def image_metric(x) -> ty.NamedTuple("Output", [("image", list), ("metric", int)]):
+        return list(range(x)), x
+
+    nn = image_metric(x=10000, cache_dir=cache_dir)
+    nn()
+    result_cache.clear()
+    loaded = []
+    orig_load = EntriesReader.load
+
+    def load_logged(self, name):
+        loaded.append(name)
+        return orig_load(self, name)
+
+    monkeypatch.setattr(EntriesReader, "load", load_logged)
+    result = nn.result()
+    # uncompressed size of the loaded fields is counted by the result cache
+    nbytes = result_cache.nbytes
+    assert result.output.metric == 10000
+    assert loaded == ["metric"]
+    assert result_cache.nbytes > nbytes
+    nbytes = result_cache.nbytes
+    # fields are loaded once
+    assert result.output.metric == 10000
+    assert result.output.image == list(range(10000))
+    assert loaded == ["metric", "image"]
+    entry = result.output.__dict__["_output_entries"].entries["image"]
+    assert result_cache.nbytes - nbytes == entry["nbytes"] >= entry["stored_nbytes"]
+    assert dc.asdict(result.output) == {"image": list(range(10000)), "metric": 10000}
+    with pytest.raises(AttributeError):
+        result.output.missing
+    # results with lazy fields can be pickled
+    assert cp.loads(cp.dumps(result)).output.metric == 10000
+
+
+def test_lazy_field_file_replaced(tmpdir):
+    @mark.task
+    def image_metric(x) -> ty.NamedTuple("Output", [("image", list), ("metric", int)]):
+        return list(range(x)), x
+
+    cache_dir = Path(tmpdir)
+    nn = image_metric(x=100, cache_dir=cache_dir)
+    nn()
+    result_file = cache_dir / nn.checksum / "_result.pklz"
+    result_cache.clear()
+    result = nn.result()
+    assert result.output.metric == 100
+    # the same content saved again is a different file
+    with replaced(result_file) as path:
+        path.write_bytes(result_file.read_bytes())
+    with pytest.raises(RuntimeError, match="replaced"):
+        result.output.image
+    # the new file is read by a new result
+    result_cache.clear()
+    assert nn.result().output.image == list(range(100))
+    # entries removed by the garbage collection
+    result_cache.clear()
+    result = nn.result()
+    shutil.rmtree(cache_dir / nn.checksum)
+    with pytest.raises(FileNotFoundError, match="removed"):
+        result.output.image
+
+
+def test_lazy_field_loads_single_field(tmpdir, monkeypatch):
+    @mark.task
+    def image_metric(x) -> ty.NamedTuple("Output", [("image", list), ("metric", int)]):
+        return list(range(x)), x
+
+    wf = Workflow(name="wf", input_spec=["x"], x=100, cache_dir=tmpdir)
+    wf.add(image_metric(name="im", x=wf.lzin.x))
+    wf.add(fun_addvar(name="addvar", a=wf.im.lzout.metric, b=1))
+    wf.set_output([("out", wf.addvar.lzout.out)])
+    loaded = []
+    orig_load = EntriesReader.load
+
+    def load_logged(self, name):
+        loaded.append(name)
+        return orig_load(self, name)
+
+    monkeypatch.setattr(EntriesReader, "load", load_logged)
+    with Submitter(plugin="cf") as sub:
+        sub(wf)
+    assert wf.result().output.out == 101
+    assert "metric" in loaded and "image" not in loaded
+
+
+@pytest.mark.parametrize("store", ["directory", "sqlite"])
+def test_results_available(tmpdir, store):
+    cache_dir = Path(tmpdir) / "cache"
+    cache_dir_other = Path(tmpdir) / "other"
+    cache_dir_other.mkdir()
+    set_result_store(cache_dir, store)
+    nn = multiply(name="mult", x=2, y=3, cache_dir=cache_dir)
+    nn()
+    nn_other = multiply(name="mult", x=2, y=4, cache_dir=cache_dir_other)
+    nn_other()
+    checksums = [nn.checksum, nn_other.checksum, "missing"]
+    assert helpers.results_available(checksums, [cache_dir]) == {nn.checksum}
+    assert helpers.results_available(checksums, [cache_dir, cache_dir_other]) == {
+        nn.checksum,
+        nn_other.checksum,
+    }
+
+
+def test_directory_store_atomic_save(tmpdir, monkeypatch):
+    from .. import stores
+
+    store = DirectoryStore(tmpdir)
+    result_file = Path(tmpdir) / "checksum" / "_result.pklz"
+    orig_dump_result = stores.dump_result
+
+    def dump_result(result, fp, **kwargs):
+        # the result is not visible to the readers while it is written
+        assert not result_file.exists()
+        assert store.load_result("checksum") is None
+        return orig_dump_result(result, fp, **kwargs)
+
+    monkeypatch.setattr(stores, "dump_result", dump_result)
+    nn = multiply(name="mult", x=1, y=2, cache_dir=tmpdir)
+    res = nn._run()
+    store.save("checksum", result=res)
+    assert store.load_result("checksum").output.out == 2
+    assert [path.name for path in result_file.parent.iterdir()] == ["_result.pklz"]
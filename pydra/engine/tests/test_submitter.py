@@ -1,4 +1,6 @@
 from dateutil import parser
+import asyncio
+from pathlib import Path
 import re
 import shutil
 import subprocess as sp
@@ -6,9 +8,13 @@ import time
 
 import pytest
 
-from .utils import gen_basic_wf
-from ..core import Workflow
-from ..submitter import Submitter
+from .utils import gen_basic_wf, add2, fun_addvar, fun_div
+from ..core import TaskBase, TaskChunk, Workflow
+from ..helpers import get_open_loop
+from ..specs import Result, RuntimeSpec
+from ..workers import ResourceBudget
+from .. import submitter
+from ..submitter import DurationHistory, Scheduler, Submitter
 from ... import mark
 
 # list of (plugin, available)
@@ -161,6 +167,37 @@ def test_slurm_wf(tmpdir):
     assert len([sd for sd in script_dir.listdir() if sd.isdir()]) == 2
 
 
+def test_slurm_job_result(tmpdir, monkeypatch):
+    """results of the finished slurm jobs are loaded for the submitter"""
+    from .. import workers
+
+    async def sbatch(*cmd, hide_display=False):
+        return 0, "Submitted batch job 1", ""
+
+    async def poll_job(self, jobid):
+        return True
+
+    monkeypatch.setattr(workers, "read_and_display", sbatch)
+    monkeypatch.setattr(workers.SlurmWorker, "_poll_job", poll_job)
+    # jobs run outside of the submitter
+    jobs = [fun_addvar(name="add", a=a, b=1, cache_dir=tmpdir) for a in range(2)]
+    for job in jobs:
+        job()
+    worker = workers.SlurmWorker(poll_delay=0)
+    loop = get_open_loop()
+    result = loop.run_until_complete(
+        worker._submit_job(jobs[0], Path(tmpdir) / "job.sh")
+    )
+    assert isinstance(result, Result) and result.output.out == 1
+    results = loop.run_until_complete(
+        worker._submit_job(TaskChunk(jobs), Path(tmpdir) / "chunk.sh")
+    )
+    assert [result.output.out for result in results] == [1, 2]
+    history = DurationHistory()
+    history.add(jobs[0], results)
+    assert history.get(jobs[0]) is not None
+
+
 @pytest.mark.skipif(not plugins["slurm"], reason="slurm not installed")
 def test_slurm_wf_cf(tmpdir):
     # submit entire workflow as single job executing with cf worker
@@ -233,3 +270,381 @@ def test_slurm_max_jobs(tmpdir):
             prev = et
             continue
         assert (prev - et).seconds >= 2
+
+
+def _counting_submitter(monkeypatch, plugin="cf", **kwargs):
+    """Submitter recording the jobs (tasks or chunks) submitted to the worker"""
+    sub = Submitter(plugin, **kwargs)
+    submitted = []
+    orig_run_el = sub.worker.run_el
+
+    def run_el(task, **kwargs):
+        submitted.append(task)
+        return orig_run_el(task, **kwargs)
+
+    monkeypatch.setattr(sub.worker, "run_el", run_el)
+    return sub, submitted
+
+
+def test_wf_cached_nodes_not_submitted(tmpdir, monkeypatch):
+    def gen_wf(nnodes):
+        wf = Workflow("wf", input_spec=["x"], x=[1, 2], cache_dir=tmpdir)
+        wf.add(add2(name="task0", x=wf.lzin.x).split("x"))
+        for i in range(1, nnodes):
+            wf.add(add2(name=f"task{i}", x=getattr(wf, f"task{i - 1}").lzout.out))
+        wf.set_output([("out", getattr(wf, f"task{nnodes - 1}").lzout.out)])
+        return wf
+
+    wf = gen_wf(3)
+    with Submitter("cf") as sub:
+        sub(wf)
+    assert wf.result().output.out == [7, 8]
+
+    # only the new node is submitted
+    wf = gen_wf(4)
+    sub, submitted = _counting_submitter(monkeypatch)
+    with sub:
+        sub(wf)
+    assert wf.result().output.out == [9, 10]
+    assert [job.name for job in submitted] == ["task3", "task3"]
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+def test_split_new_states_submitted(tmpdir, monkeypatch, incremental):
+    task = add2(name="add2", x=[1, 2, 3], cache_dir=tmpdir).split("x")
+    with Submitter("cf") as sub:
+        sub(task)
+
+    task = add2(name="add2", x=[1, 2, 3, 4, 5], cache_dir=tmpdir).split("x")
+    sub, submitted = _counting_submitter(monkeypatch, incremental=incremental)
+    with sub:
+        results = sub(task)
+    assert [res.output.out for res in results] == [3, 4, 5, 6, 7]
+    assert len(submitted) == (2 if incremental else 5)
+
+
+def test_wf_split_combine_incremental(tmpdir, monkeypatch):
+    def gen_wf(x):
+        wf = Workflow("wf", input_spec=["x"], x=x, cache_dir=tmpdir)
+        wf.add(add2(name="add2", x=wf.lzin.x).split("x").combine("x"))
+        wf.set_output([("out", wf.add2.lzout.out)])
+        return wf
+
+    wf = gen_wf([1, 2])
+    with Submitter("cf") as sub:
+        sub(wf)
+    assert wf.result().output.out == [[3, 4]]
+
+    # the new element is run and merged with the cached ones
+    wf = gen_wf([1, 2, 10])
+    sub, submitted = _counting_submitter(monkeypatch)
+    with sub:
+        sub(wf)
+    assert wf.result().output.out == [[3, 4, 12]]
+    assert [job.name for job in submitted] == ["add2"]
+
+
+def test_scheduler_ready_order():
+    # A --> C <-- B, C --> D
+    wf = Workflow("wf", input_spec=["x"], x=1)
+    wf.add(add2(name="a", x=wf.lzin.x))
+    wf.add(add2(name="b", x=wf.lzin.x))
+    wf.add(fun_addvar(name="c", a=wf.a.lzout.out, b=wf.b.lzout.out))
+    wf.add(add2(name="d", x=wf.c.lzout.out))
+    for nd in wf.graph.nodes:
+        wf.create_connections(nd)
+    scheduler = Scheduler(wf.graph.copy())
+    assert [nd.name for nd in scheduler.pop_ready()] == ["a", "b"]
+    scheduler.dispatched(wf.a, [])
+    assert list(scheduler.pop_ready()) == []
+    scheduler.dispatched(wf.b, [])
+    assert [nd.name for nd in scheduler.pop_ready()] == ["c"]
+    scheduler.dispatched(wf.c, [])
+    assert [nd.name for nd in scheduler.pop_ready()] == ["d"]
+    assert not scheduler.finished
+    scheduler.dispatched(wf.d, [])
+    assert scheduler.finished
+
+
+def test_wf_readiness_without_results(tmpdir, monkeypatch):
+    def done(task):
+        raise AssertionError("results are not loaded to check readiness")
+
+    monkeypatch.setattr(TaskBase, "done", property(done))
+    wf = gen_basic_wf()
+    wf.cache_dir = tmpdir
+    with Submitter("cf") as sub:
+        sub(wf)
+    assert wf.result().output.out == 9
+
+
+def test_wf_node_error():
+    wf = Workflow("wf", input_spec=["x"], x=0)
+    wf.add(fun_div(name="div", a=1, b=wf.lzin.x))
+    wf.add(add2(name="add2", x=wf.div.lzout.out))
+    wf.set_output([("out", wf.add2.lzout.out)])
+    with pytest.raises(ZeroDivisionError):
+        with Submitter("cf") as sub:
+            sub(wf)
+
+
+@mark.task
+def started(x):
+    return time.time()
+
+
+def _wait_until(condition, timeout):
+    """Polls the condition, returns if it was met within the timeout"""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@mark.task
+def wait_marker(x, marker_dir):
+    # the element waits for the element x - 1 of the next task (see ``mark_started``)
+    marker = Path(marker_dir) / str(x - 1)
+    if x > 0 and not _wait_until(marker.exists, 60):
+        raise TimeoutError(f"{marker} was not created")
+    return x
+
+
+@mark.task
+def mark_started(x, marker_dir):
+    (Path(marker_dir) / str(x)).touch()
+    return x
+
+
+def test_wf_split_elementwise(tmpdir):
+    # the element 1 of a runs until the element 0 of b started,
+    # so the workflow finishes only if b doesn't wait for all elements of a
+    marker_dir = Path(tmpdir) / "markers"
+    marker_dir.mkdir()
+    wf = Workflow("wf", input_spec=["x"], x=[0, 1], cache_dir=tmpdir)
+    wf.add(wait_marker(name="a", x=wf.lzin.x, marker_dir=str(marker_dir)).split("x"))
+    wf.add(mark_started(name="b", x=wf.a.lzout.out, marker_dir=str(marker_dir)))
+    wf.add(fun_addvar(name="c", a=wf.b.lzout.out, b=1).combine("a.x"))
+    wf.set_output([("b_out", wf.b.lzout.out), ("c_out", wf.c.lzout.out)])
+    with Submitter("cf", n_procs=2) as sub:
+        for nd in wf.graph.nodes:
+            wf.create_connections(nd)
+        scheduler = Scheduler(wf.graph.copy(), submitter=sub, wf=wf)
+        assert scheduler.elementwise == {"a": [wf.b]}
+        sub(wf)
+    res = wf.result()
+    assert res.output.b_out == [0, 1]
+    assert res.output.c_out == [[1, 2]]
+    # elements are cached as the equivalent tasks without a state
+    for x in [0, 1]:
+        nn = mark_started(name="b", x=x, marker_dir=str(marker_dir), cache_dir=tmpdir)
+        assert nn.result().output.out == x
+
+
+def _chain_wf(**kwargs):
+    # d; a --> b --> c
+    wf = Workflow("wf", input_spec=["x"], x=1, **kwargs)
+    wf.add(started(name="d", x=0))
+    wf.add(started(name="a", x=wf.lzin.x))
+    wf.add(started(name="b", x=wf.a.lzout.out))
+    wf.add(started(name="c", x=wf.b.lzout.out))
+    wf.set_output([("a_out", wf.a.lzout.out), ("d_out", wf.d.lzout.out)])
+    for nd in wf.graph.nodes:
+        wf.create_connections(nd)
+    return wf
+
+
+def test_scheduler_priority(monkeypatch):
+    history = DurationHistory()
+    monkeypatch.setattr(submitter, "duration_history", history)
+    wf = _chain_wf()
+    scheduler = Scheduler(wf.graph.copy())
+    assert [nd.name for nd in scheduler.pop_ready()] == ["d", "a"]
+    # the longest chain is dispatched first
+    scheduler = Scheduler(wf.graph.copy(), priority=True)
+    assert scheduler.priorities == {"a": 3, "b": 2, "c": 1, "d": 1}
+    assert [nd.name for nd in scheduler.pop_ready()] == ["a", "d"]
+
+    # the critical paths are weighted by the durations of the previous executions
+    for name, duration in [("a", 1.0), ("b", 1.0), ("c", 1.0), ("d", 10.0)]:
+        history.add(getattr(wf, name), Result(duration=duration))
+    scheduler = Scheduler(wf.graph.copy(), priority=True)
+    assert [nd.name for nd in scheduler.pop_ready()] == ["d", "a"]
+
+
+def test_wf_priority(tmpdir, monkeypatch):
+    history = DurationHistory()
+    monkeypatch.setattr(submitter, "duration_history", history)
+    wf = _chain_wf(cache_dir=tmpdir)
+    with Submitter("cf", n_procs=1, priority=True) as sub:
+        sub(wf)
+    res = wf.result()
+    assert res.output.a_out < res.output.d_out
+    assert res.duration is not None
+    # durations of the executed nodes are recorded
+    assert all(history.get(getattr(wf, name)) is not None for name in "abcd")
+
+
+@mark.task
+def overlapping(x, marker_dir):
+    # returns if other elements run while the element runs (markers are checked
+    # for 0.5 seconds, long enough for the elements to start when run together)
+    marker_dir = Path(marker_dir)
+    (marker_dir / f"started_{x}").touch()
+
+    def others_running():
+        return any(
+            not path.with_name(path.name.replace("started", "finished")).exists()
+            for path in marker_dir.glob("started_*")
+            if path.name != f"started_{x}"
+        )
+
+    running = _wait_until(others_running, 0.5)
+    (marker_dir / f"finished_{x}").touch()
+    return running
+
+
+def test_task_requirements():
+    nn = add2(name="a", x=1)
+    checksum = nn.checksum
+    assert nn.set_requirements(cpus=2, mem_gb=1.5) is nn
+    assert (nn._runtime_requirements.cpus, nn._runtime_requirements.mem_gb) == (2, 1.5)
+    assert nn.checksum == checksum
+    # requirements of other tasks are not changed
+    assert add2(name="b", x=1)._runtime_requirements == RuntimeSpec()
+
+
+def test_resource_budget():
+    async def run(budget, started, name, cpus, mem_gb):
+        async with budget.reserve(cpus, mem_gb):
+            started.append(name)
+            await asyncio.sleep(0.1)
+
+    async def main():
+        budget = ResourceBudget(cpus=2, mem_gb=4)
+        started = []
+        jobs = [
+            asyncio.ensure_future(run(budget, started, name, cpus, mem_gb))
+            for name, cpus, mem_gb in [
+                ("heavy1", 1, 3),
+                ("heavy2", 1, 3),
+                ("light", 1, 1),
+                ("huge", 4, 8),
+            ]
+        ]
+        await asyncio.sleep(0.05)
+        # the light task is not held back by the heavy one
+        assert started == ["heavy1", "light"]
+        assert (budget.used_cpus, budget.used_mem_gb) == (2, 4)
+        await asyncio.gather(*jobs)
+        # the task larger than the budget runs alone
+        assert started == ["heavy1", "light", "heavy2", "huge"]
+        assert (budget.used_cpus, budget.used_mem_gb, budget.running) == (0, 0, 0)
+
+    get_open_loop().run_until_complete(main())
+
+
+def test_wf_requirements(tmpdir):
+    marker_dir = Path(tmpdir) / "markers"
+    marker_dir.mkdir()
+    wf = Workflow("wf", input_spec=["x"], x=[1, 2], cache_dir=tmpdir)
+    wf.add(
+        overlapping(name="a", x=wf.lzin.x, marker_dir=str(marker_dir))
+        .split("x")
+        .set_requirements(mem_gb=3)
+    )
+    wf.set_output([("out", wf.a.lzout.out)])
+    with Submitter("cf", n_procs=2, max_mem_gb=4) as sub:
+        sub(wf)
+    # the elements don't fit into the memory budget together
+    assert wf.result().output.out == [False, False]
+
+
+def _bounded_submitter(monkeypatch, **kwargs):
+    """Submitter running the jobs in the event loop, counting the unfinished jobs"""
+    counts = {"jobs": 0, "unfinished": 0, "max_unfinished": 0}
+    orig_to_job = TaskBase.to_job
+
+    def to_job(self, ind, checksum=None):
+        counts["jobs"] += 1
+        counts["unfinished"] += 1
+        counts["max_unfinished"] = max(counts["max_unfinished"], counts["unfinished"])
+        return orig_to_job(self, ind, checksum=checksum)
+
+    async def run_el(job):
+        await asyncio.sleep(0.001)
+        counts["unfinished"] -= 1
+        return job._run()
+
+    monkeypatch.setattr(TaskBase, "to_job", to_job)
+    sub = Submitter("cf", **kwargs)
+    monkeypatch.setattr(sub.worker, "run_el", run_el)
+    return sub, counts
+
+
+@pytest.mark.parametrize("in_wf", [False, True])
+def test_split_bounded_submission(tmpdir, monkeypatch, in_wf):
+    if in_wf:
+        wf = Workflow("wf", input_spec=["a"], a=list(range(50)), cache_dir=tmpdir)
+        wf.add(fun_addvar(name="addvar", a=wf.lzin.a, b=1).split("a"))
+        wf.set_output([("out", wf.addvar.lzout.out)])
+        runnable = wf
+    else:
+        runnable = fun_addvar(name="addvar", a=list(range(50)), b=1, cache_dir=tmpdir)
+        runnable.split("a")
+    sub, counts = _bounded_submitter(monkeypatch, max_inflight=5)
+    with sub:
+        sub(runnable)
+    # the jobs are created lazily, at most max_inflight at a time
+    assert counts["jobs"] == 50
+    assert counts["max_unfinished"] == 5
+    if in_wf:
+        assert wf.result().output.out == list(range(1, 51))
+    else:
+        assert [res.output.out for res in runnable.result()] == list(range(1, 51))
+
+
+@pytest.mark.parametrize("plugin", ["serial", "cf"])
+def test_split_chunks(tmpdir, monkeypatch, plugin):
+    nn = fun_addvar(name="addvar", a=list(range(10)), b=1, cache_dir=tmpdir)
+    nn.split("a").chunk_size = 4
+    sub, jobs = _counting_submitter(monkeypatch, plugin)
+    with sub:
+        sub(nn)
+    assert [len(job.jobs) for job in jobs] == [4, 4, 2]
+    assert [res.output.out for res in nn.result()] == list(range(1, 11))
+    # the elements are cached separately
+    assert fun_addvar(a=9, b=1, cache_dir=tmpdir).result().output.out == 10
+
+
+@pytest.mark.parametrize("plugin", ["serial", "cf"])
+def test_wf_split_chunks_auto(tmpdir, monkeypatch, plugin):
+    history = DurationHistory()
+    monkeypatch.setattr(submitter, "duration_history", history)
+    monkeypatch.setattr(submitter, "CHUNK_DURATION", 3600)
+    wf = Workflow("wf", input_spec=["a"], a=list(range(10)), cache_dir=tmpdir)
+    wf.add(fun_addvar(name="addvar", a=wf.lzin.a, b=1).split("a"))
+    wf.addvar.chunk_size = "auto"
+    wf.add(add2(name="add2", x=wf.addvar.lzout.out))
+    wf.set_output([("out", wf.add2.lzout.out)])
+    sub, jobs = _counting_submitter(monkeypatch, plugin)
+    with sub:
+        sub(wf)
+    # the first element is run alone to measure the duration
+    addvar_jobs = [job for job in jobs if job.name == "addvar"]
+    assert isinstance(addvar_jobs[0], TaskBase)
+    assert [len(job.jobs) for job in addvar_jobs[1:]] == [9]
+    assert history.get(wf.addvar) is not None
+    assert wf.result().output.out == list(range(3, 13))
+
+
+def test_task_chunk_error(tmpdir):
+    jobs = [fun_div(a=1, b=b, cache_dir=tmpdir) for b in [0, 2]]
+    chunk = TaskChunk(jobs)
+    with pytest.raises(ZeroDivisionError):
+        chunk._run()
+    # the elements after the failed one are run
+    assert jobs[1].result().output.out == 0.5
+    assert chunk.result()[0].errored
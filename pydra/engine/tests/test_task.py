@@ -3,11 +3,13 @@
 import typing as ty
 import os
 import pytest
+import cloudpickle as cp
+from copy import deepcopy
 
 from ... import mark
 from ..task import AuditFlag, ShellCommandTask, ContainerTask, DockerTask
 from ...utils.messenger import FileMessenger, PrintMessenger, collect_messages
-from .utils import gen_basic_wf
+from .utils import gen_basic_wf, fun_div
 
 
 @mark.task
@@ -21,6 +23,56 @@ def test_output():
     assert res.output.out == 5
 
 
+def test_checksum_memoized():
+    nn = funaddtwo(a=3)
+    checksum = nn.checksum
+    assert nn.checksum == checksum
+    # changing inputs or the splitter invalidates the checksum
+    nn.inputs.a = 4
+    assert nn.checksum != checksum
+    nn.inputs.a = 3
+    assert nn.checksum == checksum
+    nn.split("a")
+    assert nn.checksum != checksum
+
+
+@mark.task
+def sum_list(a):
+    return sum(a)
+
+
+def test_checksum_mutable_input(tmpdir):
+    nn = sum_list(a=[1, 2], cache_dir=tmpdir)
+    checksum = nn.checksum
+    assert nn(plugin="cf").output.out == 3
+    # modifying the input in place changes the checksum
+    nn.inputs.a[0] = 100
+    assert nn.checksum != checksum
+    assert nn.result() is None
+    assert nn(plugin="cf").output.out == 102
+
+
+def test_session_cache_root(monkeypatch, tmpdir):
+    from .. import core
+
+    monkeypatch.setattr(core, "_session_cache_root", None)
+    mkdtemp_calls = []
+
+    def mkdtemp(**kwargs):
+        mkdtemp_calls.append(kwargs)
+        return str(tmpdir)
+
+    monkeypatch.setattr(core, "mkdtemp", mkdtemp)
+    nn = funaddtwo(a=3)
+    # tasks without a cache_dir share a root created on the first use
+    assert mkdtemp_calls == []
+    assert nn.cache_dir == funaddtwo(a=4).cache_dir == tmpdir
+    assert deepcopy(nn).cache_dir == tmpdir
+    assert len(mkdtemp_calls) == 1
+    # pickled tasks keep the root of the process (e.g. run by the workers)
+    assert cp.loads(cp.dumps(funaddtwo(a=5)))._cache_dir == tmpdir
+
+
 @pytest.mark.xfail(reason="cp.dumps(func) depends on the system/setup, TODO!!")
 def test_checksum():
     nn = funaddtwo(a=3)
@@ -285,6 +337,16 @@ def test_exception_func():
     assert pytest.raises(Exception, bad_funk)
 
 
+def test_exception_func_rerun():
+    # errored results in the session cache are not reused
+    for _ in range(2):
+        nn = fun_div(a=1, b=0)
+        with pytest.raises(ZeroDivisionError):
+            nn()
+        assert nn.result().errored
+        assert not nn.done
+
+
 def test_audit_prov(tmpdir):
     @mark.task
     def testfunc(a: int, b: float = 0.1) -> ty.NamedTuple("Output", [("out", float)]):
@@ -319,7 +381,7 @@ def test_audit_all(tmpdir):
     from glob import glob
 
     assert len(glob(str(tmpdir / funky.checksum / "proc*.log"))) == 1
-    assert len(glob(str(message_path / "*.jsonld"))) == 6
+    assert len(glob(str(message_path / "*.jsonld"))) == 8
 
     # commented out to speed up testing
     collect_messages(tmpdir / funky.checksum, message_path, ld_op="compact")
@@ -428,7 +490,7 @@ def test_taskhooks(tmpdir, capsys):
     bar.hooks = foo.hooks
     # and workflows
     wf = gen_basic_wf()
-    wf.tmpdir = tmpdir
+    wf.cache_dir = tmpdir
     wf.hooks = bar.hooks
     assert foo.hooks == bar.hooks == wf.hooks
 
@@ -1,4 +1,7 @@
 import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import os
 import sys
 import re
 from tempfile import gettempdir
@@ -24,31 +27,6 @@ class Worker:
     def close(self):
         pass
 
-    async def fetch_finished(self, futures):
-        """
-        Awaits asyncio `Tasks` until one is finished.
-
-        Parameters
-        ----------
-        futures : set of asyncio awaitables
-            Task execution coroutines or asyncio `Tasks`
-
-        Returns
-        -------
-        pending : set
-            Pending asyncio `Task`s
-        """
-        done = set()
-        try:
-            done, pending = await asyncio.wait(
-                futures, return_when=asyncio.FIRST_COMPLETED
-            )
-        except ValueError:
-            # nothing pending!
-            pending = set()
-        logger.debug(f"Tasks finished: {len(done)}")
-        return pending
-
 
 class DistributedWorker(Worker):
     """Base Worker for distributed execution"""
@@ -56,7 +34,16 @@ class DistributedWorker(Worker):
     def __init__(self, loop=None, max_jobs=None):
         super().__init__(loop=loop)
         self.max_jobs = max_jobs
-        self._jobs = 0
+        self._job_slots = None
+
+    async def _limit_jobs(self, job):
+        """Awaits the job coroutine when less than max_jobs jobs are submitted"""
+        if not self.max_jobs:
+            return await job
+        if self._job_slots is None:
+            self._job_slots = asyncio.Semaphore(self.max_jobs)
+        async with self._job_slots:
+            return await job
 
     def _prepare_runscripts(self, task, interpreter="/bin/sh"):
         script_dir = (
@@ -64,7 +51,8 @@ class DistributedWorker(Worker):
         )
         script_dir.mkdir(parents=True, exist_ok=True)
         if not (script_dir / "_task.pkl").exists():
-            save(script_dir, task=task)
+            # scripts always read the task from the directory
+            save(script_dir, task=task, store="directory")
         pyscript = create_pyscript(script_dir, task.checksum)
         batchscript = script_dir / f"batchscript_{task.checksum}.sh"
         bcmd = "\n".join(
@@ -78,41 +66,6 @@ class DistributedWorker(Worker):
             fp.writelines(bcmd)
         return script_dir, pyscript, batchscript
 
-    async def fetch_finished(self, futures):
-        """
-        Awaits asyncio `Task`s until one is finished.
-        Limits number of submissions based on max_jobs attr.
-
-        Parameters
-        ----------
-        futures : set of asyncio awaitables
-            Task execution coroutines or asyncio `Task`s
-
-        Returns
-        -------
-        pending : set
-            Pending asyncio `Task`s
-        """
-        done, unqueued = set(), set()
-        job_slots = self.max_jobs - self._jobs if self.max_jobs else float("inf")
-        if len(futures) > job_slots:
-            # convert to list to simplify indexing
-            logger.warning(f"Reducing queued jobs due to max jobs ({self.max_jobs})")
-            futures = list(futures)
-            futures, unqueued = set(futures[:job_slots]), set(futures[job_slots:])
-        try:
-            self._jobs += len(futures)
-            done, pending = await asyncio.wait(
-                futures, return_when=asyncio.FIRST_COMPLETED
-            )
-        except ValueError:
-            # nothing pending!
-            pending = set()
-        self._jobs -= len(done)
-        logger.debug(f"Tasks finished: {len(done)}")
-        # ensure pending + unqueued tasks persist
-        return pending.union(unqueued)
-
 
 class SerialPool:
     """ a simply class to imitate a pool like in cf"""
@@ -140,13 +93,97 @@ class SerialWorker(Worker):
         pass
 
 
+class ResourceBudget:
+    """
+    Admits tasks while the sums of their declared CPUs and memory
+    stay within the budget.
+
+    Waiting tasks are admitted in the order of submission, but a task
+    that fits into the remaining budget is not held back by a larger task
+    waiting before it. A task requiring more than the whole budget is
+    admitted when nothing else is running.
+    """
+
+    def __init__(self, cpus=None, mem_gb=None):
+        self.cpus = cpus
+        self.mem_gb = mem_gb
+        self.used_cpus = 0
+        self.used_mem_gb = 0.0
+        self.running = 0
+        # (cpus, mem_gb, future) of the waiting tasks
+        self._waiters = deque()
+
+    def fits(self, cpus, mem_gb):
+        if not self.running:
+            return True
+        if self.cpus is not None and self.used_cpus + cpus > self.cpus:
+            return False
+        if self.mem_gb is not None and self.used_mem_gb + mem_gb > self.mem_gb:
+            return False
+        return True
+
+    @asynccontextmanager
+    async def reserve(self, cpus=1, mem_gb=None):
+        """Waits until the resources are available and holds them"""
+        mem_gb = mem_gb or 0.0
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append((cpus, mem_gb, future))
+        self._admit()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._waiters.remove((cpus, mem_gb, future))
+            else:
+                self._release(cpus, mem_gb)
+            raise
+        try:
+            yield
+        finally:
+            self._release(cpus, mem_gb)
+
+    def _admit(self):
+        for waiter in list(self._waiters):
+            cpus, mem_gb, future = waiter
+            if self.fits(cpus, mem_gb):
+                self._waiters.remove(waiter)
+                self.used_cpus += cpus
+                self.used_mem_gb += mem_gb
+                self.running += 1
+                future.set_result(None)
+
+    def _release(self, cpus, mem_gb):
+        self.used_cpus -= cpus
+        self.used_mem_gb -= mem_gb
+        self.running -= 1
+        self._admit()
+
+
+def default_budget(n_procs=None):
+    """Returns budget of the CPUs and the memory of the system"""
+    try:
+        # the profiler requires psutil
+        from ..utils.profiler import get_system_total_memory_gb
+
+        mem_gb = get_system_total_memory_gb()
+    except Exception:
+        mem_gb = None
+    return ResourceBudget(cpus=n_procs or os.cpu_count(), mem_gb=mem_gb)
+
+
 class ConcurrentFuturesWorker(Worker):
-    def __init__(self, n_procs=None):
+    def __init__(self, n_procs=None, max_cpus=None, max_mem_gb=None):
         super(ConcurrentFuturesWorker, self).__init__()
         self.n_procs = n_procs
         # added cpu_count to verify, remove once confident and let PPE handle
         self.pool = cf.ProcessPoolExecutor(self.n_procs)
         # self.loop = asyncio.get_event_loop()
+        # tasks are run only while their declared resources fit into the budget
+        self.budget = default_budget(n_procs)
+        if max_cpus is not None:
+            self.budget.cpus = max_cpus
+        if max_mem_gb is not None:
+            self.budget.mem_gb = max_mem_gb
         logger.debug("Initialize ConcurrentFuture")
 
     def run_el(self, runnable, **kwargs):
@@ -154,7 +191,9 @@ class ConcurrentFuturesWorker(Worker):
         return self.exec_as_coro(runnable)
 
     async def exec_as_coro(self, runnable):
-        res = await self.loop.run_in_executor(self.pool, runnable._run)
+        requirements = runnable._runtime_requirements
+        async with self.budget.reserve(requirements.cpus, requirements.mem_gb):
+            res = await self.loop.run_in_executor(self.pool, runnable._run)
         return res
 
     def close(self):
@@ -194,7 +233,7 @@ class SlurmWorker(DistributedWorker):
         script_dir, _, batch_script = self._prepare_runscripts(runnable)
         if (script_dir / script_dir.parts[1]) == gettempdir():
             logger.warning("Temporary directories may not be shared across computers")
-        return self._submit_job(runnable, batch_script)
+        return self._limit_jobs(self._submit_job(runnable, batch_script))
 
     async def _submit_job(self, task, batchscript):
         """Coroutine that submits task runscript and polls job until completion or error."""
@@ -207,6 +246,14 @@ class SlurmWorker(DistributedWorker):
         if not output:
             output = str(batchscript.parent / "slurm-%j.out")
             sargs.append(f"--output={output}")
+        # resources declared by the task are requested from slurm
+        requirements = task._runtime_requirements
+        if requirements.cpus > 1 and not re.search(
+            r"(^|\s)(-c|--cpus-per-task)", self.sbatch_args
+        ):
+            sargs.append(f"--cpus-per-task={requirements.cpus}")
+        if requirements.mem_gb and not re.search(r"(^|\s)--mem", self.sbatch_args):
+            sargs.append(f"--mem={int(requirements.mem_gb * 1024)}M")
         sargs.append(str(batchscript))
         # TO CONSIDER: add random sleep to avoid overloading calls
         _, stdout, _ = await read_and_display("sbatch", *sargs, hide_display=True)
@@ -222,7 +269,9 @@ class SlurmWorker(DistributedWorker):
             # Exception: Polling / job failure
             done = await self._poll_job(jobid)
             if done:
-                return task
+                # results (a list for a chunk) are loaded from the cache,
+                # so the submitter records the completion and the durations
+                return task.result()
             await asyncio.sleep(self.poll_delay)
 
     async def _poll_job(self, jobid):